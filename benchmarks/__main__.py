@@ -0,0 +1,109 @@
+"""
+Measure dump, archive and restore throughput against local stand-ins for the database tools.
+Run as python -m benchmarks from the repository root.
+
+Usage:
+  benchmarks run [options] [<benchmark>...]
+  benchmarks compare [--threshold=<PERCENT>] <baseline> <current>
+  benchmarks list
+  benchmarks -h | --help
+
+Run Options:
+     --output=<FILE>       Write the JSON report here instead of stdout.
+     --repeat=<N>          Run every benchmark this often and report the median. [default: 3]
+     --sql-size=<MB>       Size of the SQL stream the fake dump tools emit. [default: 256]
+     --files=<N>           Number of files in directory workloads. [default: 10000]
+     --file-size=<KB>      Size of each file in directory workloads. [default: 16]
+     --rate=<MB/s>         Limit the fake tools to this rate, 0 means unlimited. [default: 0]
+     --compression=<CODEC>  Compression to dump SQL with. [default: none]
+     --workdir=<DIR>       Where to create workloads, e.g. to benchmark a specific file system.
+
+Compare Options:
+     --threshold=<PERCENT>  Slowdown in MB/s that counts as a regression. [default: 10]
+"""
+
+import json
+import statistics
+import sys
+from docopt import docopt
+
+from .suite import benchmarks, run_benchmark
+
+def _median_run(name, parameters, repeat):
+    runs = [run_benchmark(name, parameters) for _ in range(repeat)]
+    if any('seconds' not in run for run in runs):
+        return next(run for run in runs if 'seconds' not in run)
+    median_seconds = statistics.median_low(run['seconds'] for run in runs)
+    result = next(run for run in runs if run['seconds'] == median_seconds)
+    result['peak_rss_kib'] = max(run['peak_rss_kib'] for run in runs)
+    result['runs'] = [run['seconds'] for run in runs]
+    return result
+
+def run(arguments):
+    names = arguments['<benchmark>'] or list(benchmarks)
+    unknown = set(names) - set(benchmarks)
+    if unknown:
+        sys.exit("Unknown benchmarks: %s" % ', '.join(sorted(unknown)))
+    
+    parameters = dict(
+        sql_bytes=int(float(arguments['--sql-size']) * (1 << 20)),
+        files=int(arguments['--files']),
+        file_size=int(float(arguments['--file-size']) * (1 << 10)),
+        rate=int(float(arguments['--rate']) * (1 << 20)),
+        compression=arguments['--compression'],
+        workdir=arguments['--workdir'],
+    )
+    report = dict(parameters=parameters, results=dict())
+    for name in names:
+        result = _median_run(name, parameters, int(arguments['--repeat']))
+        report['results'][name] = result
+        print("%-28s %s" % (name, _summary(result)), file=sys.stderr)
+    
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if arguments['--output']:
+        with open(arguments['--output'], 'w') as report_file:
+            report_file.write(output + '\n')
+    else:
+        print(output)
+
+def _summary(result):
+    if 'seconds' not in result:
+        return result.get('skipped') and "skipped: %s" % result['skipped'] or "failed: %s" % result['error']
+    return "%8.2fs %9.1f MB/s %10.1f files/s %8d KiB peak RSS" % (
+        result['seconds'], result['mb_per_second'], result['files_per_second'], result['peak_rss_kib'])
+
+def compare(arguments):
+    with open(arguments['<baseline>']) as baseline_file, open(arguments['<current>']) as current_file:
+        baseline, current = json.load(baseline_file), json.load(current_file)
+    if baseline['parameters'] != current['parameters']:
+        print("Warning: reports were run with different parameters", file=sys.stderr)
+    
+    threshold = float(arguments['--threshold']) / 100
+    regressions = []
+    for name in sorted(set(baseline['results']) & set(current['results'])):
+        before, after = baseline['results'][name], current['results'][name]
+        if 'seconds' not in before or 'seconds' not in after:
+            continue
+        change = after['mb_per_second'] / before['mb_per_second'] - 1
+        rss_change = after['peak_rss_kib'] / before['peak_rss_kib'] - 1
+        regressed = change < -threshold
+        print("%-28s %9.1f -> %9.1f MB/s (%+6.1f%%), peak RSS %+6.1f%%%s" % (
+            name, before['mb_per_second'], after['mb_per_second'], change * 100, rss_change * 100,
+            '  REGRESSION' if regressed else ''))
+        if regressed:
+            regressions.append(name)
+    
+    if regressions:
+        sys.exit("Regressions: %s" % ', '.join(regressions))
+
+def main():
+    arguments = docopt(__doc__)
+    if arguments['list']:
+        print('\n'.join(benchmarks))
+    elif arguments['run']:
+        run(arguments)
+    elif arguments['compare']:
+        compare(arguments)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+"""
+Stand-in for mysqldump, pg_dumpall, mysql and psql, installed under those names.
+
+Dump tools write REDUMPSTER_BENCH_DUMP_BYTES of SQL to stdout, restore tools read
+their input (a `source` statement, --file or stdin) and discard it. Both move at most
+REDUMPSTER_BENCH_RATE bytes per second, 0 means as fast as possible. Listing the
+databases prints REDUMPSTER_BENCH_DATABASES.
+"""
+
+import os
+import sys
+import time
+
+BLOCK_SIZE = 1 << 20
+
+def sql_block():
+    line = b"INSERT INTO fnord (id, name, payload) VALUES (%d, 'fnord', 'lorem ipsum dolor sit amet');\n"
+    lines, size = [], 0
+    while size < BLOCK_SIZE:
+        lines.append(line % len(lines))
+        size += len(lines[-1])
+    return b''.join(lines)[:BLOCK_SIZE]
+
+class RateLimit(object):
+    def __init__(self, rate):
+        self.rate = rate
+        self.start = time.monotonic()
+        self.moved = 0
+    
+    def moving(self, size):
+        self.moved += size
+        if self.rate:
+            ahead = self.moved / self.rate - (time.monotonic() - self.start)
+            if ahead > 0:
+                time.sleep(ahead)
+
+def emit(size, rate):
+    block = sql_block()
+    limit = RateLimit(rate)
+    output = sys.stdout.fileno()
+    while size > 0:
+        data = memoryview(block)[:min(size, len(block))]
+        while data:
+            written = os.write(output, data)
+            data = data[written:]
+        size -= len(block)
+        limit.moving(len(block))
+
+def consume(stream, rate):
+    limit = RateLimit(rate)
+    for data in iter(lambda: stream.read(BLOCK_SIZE), b''):
+        limit.moving(len(data))
+
+def option(arguments, name):
+    for argument in arguments:
+        if argument.startswith(name + '='):
+            return argument.split('=', 1)[1]
+    return None
+
+def main():
+    tool = os.path.basename(sys.argv[0])
+    arguments = sys.argv[1:]
+    rate = int(os.environ.get('REDUMPSTER_BENCH_RATE', 0))
+    
+    if tool in ('mysqldump', 'pg_dumpall'):
+        return emit(int(os.environ.get('REDUMPSTER_BENCH_DUMP_BYTES', 0)), rate)
+    
+    query = option(arguments, '--execute') or option(arguments, '--command') or ''
+    if query.startswith('SHOW DATABASES') or query.startswith('SELECT datname'):
+        print('\n'.join(os.environ.get('REDUMPSTER_BENCH_DATABASES', 'fnord').split(',')))
+    elif query.startswith('source '):
+        with open(query[len('source '):], 'rb') as source:
+            consume(source, rate)
+    elif option(arguments, '--file'):
+        with open(option(arguments, '--file'), 'rb') as source:
+            consume(source, rate)
+    else:
+        consume(sys.stdin.buffer, rate)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,211 @@
+from collections import OrderedDict
+from contextlib import contextmanager
+from os.path import join
+import multiprocessing
+import resource
+import sh
+import shutil
+import tempfile
+import time
+
+from redumpster.datapath import DirectFileWriter
+from redumpster.manifest import HashingWriter
+from redumpster.archivers import Archiver, AtticArchiver, ChunkingArchiver
+from redumpster.sql_dumps import MySQLDump, PostgreSQLDump
+from redumpster.copy_directory import CopyDirectory
+from redumpster.restorers import RestoreFromDirectory, RestoreFromAttic, RestoreFromChunkStore
+
+from .workloads import make_tree, install_fake_tools, configure_fake_tools
+
+BACKUP_NAME = 'mysql-bench-2015-01-20_14-24-29'
+
+benchmarks = OrderedDict()
+
+def benchmark(*required_tools):
+    def register(function):
+        benchmarks[function.__name__] = (function, required_tools)
+        return function
+    return register
+
+
+def _dump_options(parameters):
+    return dict(compression=parameters['compression'])
+
+def _mysql_dump(directory, parameters):
+    dump = MySQLDump(directory, _dump_options(parameters))
+    dump.dump()
+    dump.write_dump_config()
+    return dump
+
+@benchmark()
+def mysql_dump(workdir, parameters, measure):
+    with measure(bytes=parameters['sql_bytes'], files=1):
+        _mysql_dump(join(workdir, 'dump'), parameters)
+
+@benchmark()
+def mysql_restore(workdir, parameters, measure):
+    dump = _mysql_dump(join(workdir, 'dump'), parameters)
+    restore = MySQLDump(dump.directory, dict())
+    restore.load_dump_config()
+    with measure(bytes=parameters['sql_bytes'], files=1):
+        restore.restore()
+
+@benchmark()
+def postgres_dump(workdir, parameters, measure):
+    with measure(bytes=parameters['sql_bytes'], files=1):
+        dump = PostgreSQLDump(join(workdir, 'dump'), _dump_options(parameters))
+        dump.dump()
+        dump.write_dump_config()
+
+@benchmark()
+def postgres_restore(workdir, parameters, measure):
+    dump = PostgreSQLDump(join(workdir, 'dump'), _dump_options(parameters))
+    dump.dump()
+    dump.write_dump_config()
+    restore = PostgreSQLDump(dump.directory, dict())
+    restore.load_dump_config()
+    with measure(bytes=parameters['sql_bytes'], files=1):
+        restore.restore()
+
+# Tool output into a hashed dump file, through Python (how dumps were written before
+# DirectFileWriter) and straight from the tool into the file.
+@benchmark()
+def datapath_python_writer(workdir, parameters, measure):
+    with measure(bytes=parameters['sql_bytes'], files=1):
+        with HashingWriter(join(workdir, 'dump.sql')) as out:
+            sh.mysqldump(_out=out, _out_bufsize=1 << 20)
+
+@benchmark()
+def datapath_direct_file(workdir, parameters, measure):
+    with measure(bytes=parameters['sql_bytes'], files=1):
+        with DirectFileWriter(join(workdir, 'dump.sql')) as out:
+            sh.mysqldump(_out=out)
+
+@benchmark('rsync')
+def copydir_dump(workdir, parameters, measure):
+    source = join(workdir, 'source')
+    size = make_tree(source, parameters['files'], parameters['file_size'])
+    with measure(bytes=size, files=parameters['files']):
+        dump = CopyDirectory(join(workdir, 'dump'), dict(source=source))
+        dump.dump()
+        dump.write_dump_config()
+
+@benchmark()
+def copydir_native_dump(workdir, parameters, measure):
+    source = join(workdir, 'source')
+    size = make_tree(source, parameters['files'], parameters['file_size'])
+    with measure(bytes=size, files=parameters['files']):
+        dump = CopyDirectory(join(workdir, 'dump'), dict(source=source, copy_engine='native'))
+        dump.dump()
+        dump.write_dump_config()
+
+def _tree_dump(workdir, parameters):
+    source = join(workdir, 'dump')
+    size = make_tree(source, parameters['files'], parameters['file_size'])
+    return source + '/', size
+
+# Archiver.commit needs names from the data interfaces, the archivers are measured
+# on what commit does for each of them.
+@benchmark('rsync')
+def archiver_commit(workdir, parameters, measure):
+    source, size = _tree_dump(workdir, parameters)
+    archiver = Archiver(join(workdir, 'archive'), [])
+    with measure(bytes=size, files=parameters['files']):
+        archiver.commit_data_interface(BACKUP_NAME, source)
+
+@benchmark()
+def chunking_archiver_commit(workdir, parameters, measure):
+    source, size = _tree_dump(workdir, parameters)
+    archiver = ChunkingArchiver(join(workdir, 'archive'), [])
+    try:
+        with measure(bytes=size, files=parameters['files']):
+            archiver.commit_data_interface(BACKUP_NAME, source)
+    finally:
+        archiver.chunker.close()
+
+@benchmark('attic')
+def attic_archiver_commit(workdir, parameters, measure):
+    source, size = _tree_dump(workdir, parameters)
+    archiver = AtticArchiver(join(workdir, 'archive'), [])
+    archiver.sh.attic('init', archiver.directory)
+    with measure(bytes=size, files=parameters['files']):
+        archiver.commit_data_interface(BACKUP_NAME, source)
+
+def _restore(restorer, parameters, measure):
+    try:
+        with measure(bytes=parameters['sql_bytes'], files=1):
+            restorer.restore()
+    finally:
+        restorer.cleanup()
+
+@benchmark()
+def restore_from_directory(workdir, parameters, measure):
+    _mysql_dump(join(workdir, 'archive', BACKUP_NAME), parameters)
+    _restore(RestoreFromDirectory(join(workdir, 'archive'), BACKUP_NAME), parameters, measure)
+
+@benchmark()
+def restore_from_chunk_store(workdir, parameters, measure):
+    dump = _mysql_dump(join(workdir, 'dump'), parameters)
+    archiver = ChunkingArchiver(join(workdir, 'archive'), [])
+    archiver.commit_data_interface(BACKUP_NAME, dump.directory + '/')
+    archiver.chunker.close()
+    _restore(RestoreFromChunkStore(archiver.directory, BACKUP_NAME), parameters, measure)
+
+@benchmark('attic')
+def restore_from_attic(workdir, parameters, measure):
+    dump = _mysql_dump(join(workdir, 'dump'), parameters)
+    archiver = AtticArchiver(join(workdir, 'archive'), [])
+    archiver.sh.attic('init', archiver.directory)
+    archiver.commit_data_interface(BACKUP_NAME, dump.directory + '/')
+    _restore(RestoreFromAttic(archiver.directory, BACKUP_NAME), parameters, measure)
+
+
+def _peak_rss_kib():
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+@contextmanager
+def _measuring(result, bytes, files):
+    start = time.perf_counter()
+    yield
+    seconds = time.perf_counter() - start
+    result.update(
+        seconds=seconds, bytes=bytes, files=files,
+        mb_per_second=bytes / seconds / 1e6, gb_per_second=bytes / seconds / 1e9,
+        files_per_second=files / seconds,
+    )
+
+def _run_in_this_process(name, parameters):
+    function, required_tools = benchmarks[name]
+    missing = [tool for tool in required_tools if shutil.which(tool) is None]
+    if missing:
+        return dict(skipped="%s not installed" % ', '.join(missing))
+    
+    workdir = tempfile.mkdtemp(prefix='redumpster-benchmark-', dir=parameters['workdir'])
+    try:
+        install_fake_tools(join(workdir, 'bin'))
+        configure_fake_tools(parameters['sql_bytes'], parameters['rate'])
+        result = dict()
+        function(workdir, parameters, lambda **sizes: _measuring(result, **sizes))
+        # The whole process only ran this benchmark. Tools are waited for, so they count
+        # as children, but only the largest single process is known, not their sum.
+        result['peak_rss_kib'] = _peak_rss_kib()
+        return result
+    finally:
+        shutil.rmtree(workdir)
+
+def _child(name, parameters, results):
+    try:
+        results.put(_run_in_this_process(name, parameters))
+    except Exception as error:
+        results.put(dict(error=repr(error)))
+
+def run_benchmark(name, parameters):
+    # A fresh process per run, so peak RSS belongs to this benchmark alone.
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    process = context.Process(target=_child, args=(name, parameters, results))
+    process.start()
+    result = results.get()
+    process.join()
+    return result
@@ -0,0 +1,38 @@
+from os.path import join, dirname
+import os
+import random
+import sys
+
+FAKE_TOOLS = ('mysqldump', 'pg_dumpall', 'mysql', 'psql')
+
+def make_tree(directory, files, file_size, files_per_directory=100, seed=23):
+    # Same seed, same tree, so runs on different commits compare the same work.
+    # Files get mostly random content and a shared tail, like real data tends to.
+    generator = random.Random(seed)
+    shared = generator.randbytes(file_size // 4)
+    for number in range(files):
+        subdirectory = join(directory, 'd%04d' % (number // files_per_directory))
+        if number % files_per_directory == 0:
+            os.makedirs(subdirectory, exist_ok=True)
+        with open(join(subdirectory, 'f%06d' % number), 'wb') as output:
+            output.write(generator.randbytes(file_size - len(shared)) + shared)
+    return files * file_size
+
+def install_fake_tools(directory):
+    # The tools run with this interpreter, whatever is first on PATH.
+    os.makedirs(directory, exist_ok=True)
+    with open(join(dirname(__file__), 'fake_tool.py')) as source:
+        script = '#!%s\n%s' % (sys.executable, source.read())
+    for tool in FAKE_TOOLS:
+        path = join(directory, tool)
+        with open(path, 'w') as output:
+            output.write(script)
+        os.chmod(path, 0o755)
+    os.environ['PATH'] = directory + os.pathsep + os.environ['PATH']
+
+def configure_fake_tools(dump_bytes, rate=0, databases=('fnord',)):
+    os.environ.update(
+        REDUMPSTER_BENCH_DUMP_BYTES=str(dump_bytes),
+        REDUMPSTER_BENCH_RATE=str(rate),
+        REDUMPSTER_BENCH_DATABASES=','.join(databases),
+    )
@@ -1,21 +1,49 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from logging import getLogger
-from os.path import join, abspath, normpath
+from os.path import join, abspath, normpath, exists
+import errno
+import json
 import os
+import shutil
+import stat
+import tempfile
+import time
 import sh
 
+from .catalog import TIMESTAMP_FORMAT
+from .chunking import Chunker, ChunkStore, sha256_hexdigest
 from .data_interfaces import DataInterface
-from .utils import change_working_directory_to, looks_like_attic_directory, partition
+from .manifest import write_json_line, has_manifest, read_manifest
+from .metrics import Metrics
+from .utils import change_working_directory_to, looks_like_attic_directory
+
+# Sessions are attic archives holding the dumps of a whole run, each below its backup
+# name. The dot keeps session names from looking like backup names.
+SESSION_ARCHIVE_PREFIX = 'session.'
+SESSION_INDEX_FILE = 'session.json'
+# in-place dumps are written below this prefix and renamed once complete, so restores
+# never see a partial dump under a valid backup name
+PARTIAL_PREFIX = '.partial-'
 
 class UnknownAtticArchive(Exception):
     pass
 
 # REFACT: rename DirectoryArchiver
 class Archiver(object):
-    def __init__(self, directory, data_interfaces, sh=sh):
+    # Without staging, archive() skips writing every dump twice: data interfaces dump
+    # straight into the archive. Archivers that can't take a dump in place commit each
+    # one right after dumping it and remove it again, so only one dump is staged at a time.
+    WRITES_IN_PLACE = True
+    
+    def __init__(self, directory, data_interfaces, sh=sh, catalog=None, metrics=None, staging=True):
         self.log = getLogger(__name__)
         self.directory = abspath(normpath(directory))
         self.data_interfaces = data_interfaces
         self.sh = sh
+        self.catalog = catalog
+        self.metrics = metrics or Metrics()
+        self.staging = staging
     
     @classmethod
     def with_data_interfaces(cls, directory, sh=sh, **data_interface_spec):
@@ -26,48 +54,294 @@ class Archiver(object):
             data_interfaces.append(data_interface)
         return cls(directory, data_interfaces, sh=sh)
     
+    def _dump(self, data_interface):
+        data_interface.dump()
+        data_interface.write_dump_config()
+    
     def dump_all(self):
         for data_interface in self.data_interfaces:
-            data_interface.dump()
-            data_interface.write_dump_config()
+            self._dump(data_interface)
+    
+    def _commit(self, data_interface):
+        name = data_interface.dump_name()
+        source = data_interface.directory + '/'
+        with self.metrics.measure(name, 'commit', source, data_interface.INTERFACE_NAME):
+            self.commit_data_interface(name, source)
+        self._record(name, source)
+    
+    def _record(self, name, source):
+        if self.catalog is not None:
+            self.catalog.record(self.directory, name, self._committed_size(name, source))
     
     def commit(self):
         for data_interface in self.data_interfaces:
-            name = data_interface.dump_name()
-            source = data_interface.directory + '/'
-            self.commit_data_interface(name, source)
+            self._commit(data_interface)
+    
+    def archive(self):
+        if self.staging:
+            self.dump_all()
+            return self.commit()
+        
+        for data_interface in self.data_interfaces:
+            if self.WRITES_IN_PLACE:
+                self._dump_in_place(data_interface)
+            else:
+                self._dump(data_interface)
+                try:
+                    self._commit(data_interface)
+                finally:
+                    shutil.rmtree(data_interface.directory)
+    
+    def _dump_in_place(self, data_interface):
+        name = data_interface.dump_name()
+        partial = join(self.directory, PARTIAL_PREFIX + name)
+        data_interface.dump_into(partial)
+        try:
+            self._dump(data_interface)
+        except BaseException:
+            shutil.rmtree(partial, ignore_errors=True)
+            raise
+        destination = join(self.directory, name)
+        os.rename(partial, destination)
+        data_interface.dump_into(destination)
+        self._record(name, destination + '/')
+    
+    def _committed_size(self, name, source):
+        if not has_manifest(source):
+            return None
+        return sum(entry['size'] for entry in read_manifest(source))
     
     def _files_to_archive_in_directory(self, directory):
-        files = os.listdir(directory)
-        other, symlinks = partition(lambda f: os.path.islink(join(directory, f)), files)
-        symlinks = [os.readlink(join(directory, link)) for link in symlinks]
-        files = sorted(symlinks + list(other))
-        return files
+        # Top level entries of directory, symlinks replaced by what they point to. Streamed
+        # from scandir, dump directories mirroring large trees can have many of them.
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_symlink():
+                    yield os.readlink(entry.path)
+                else:
+                    yield entry.name
+    
+    def _file_list(self, files):
+        # for --files-from=- --from0, in chunks instead of one large string
+        for path in files:
+            yield os.fsencode(path) + b'\0'
     
     def commit_data_interface(self, name, source):
         destination = join(self.directory, name)
-        files = self._files_to_archive_in_directory(source)
         os.mkdir(destination)
         
-        with change_working_directory_to(source):
-            files.append(destination)
-            self.sh.rsync(
-                archive=True, acls=True, xattrs=True, numeric_ids=True, relative=True,
-                *files
-            )
-    
+        # paths stay relative to source, symlinks to absolute paths are archived with
+        # their absolute path below destination, like rsync --relative does
+        relative = lambda path: not os.path.isabs(path)
+        passes = [('.', relative)]
+        if any(os.path.isabs(path) for path in self._files_to_archive_in_directory(source)):
+            passes.append(('/', os.path.isabs))
+        for root, select in passes:
+            with change_working_directory_to(source):
+                files = (path.lstrip('/') for path in self._files_to_archive_in_directory(source) if select(path))
+                self.sh.rsync(
+                    root, destination,
+                    archive=True, acls=True, xattrs=True, numeric_ids=True, recursive=True,
+                    files_from='-', from0=True,
+                    _in=self._file_list(files),
+                )
+
 
 class AtticArchiver(Archiver):
-    def commit(self):
+    # attic archives paths, and restores need dump.conf next to the data, so dumps are
+    # staged one at a time instead of streamed into attic create
+    WRITES_IN_PLACE = False
+    
+    # Every attic create locks the repository and syncs the chunk cache, which takes
+    # minutes on large repositories. With session=True, commit() runs attic create once
+    # for all data interfaces, into one session archive. RestoreFromAttic finds backups
+    # in sessions by their name as before.
+    def __init__(self, directory, data_interfaces, sh=sh, catalog=None, metrics=None, staging=True, session=False):
+        super().__init__(directory, data_interfaces, sh=sh, catalog=catalog, metrics=metrics,
+            staging=staging or session)
+        self.session = session
+    
+    def _ensure_repository(self):
         if not looks_like_attic_directory(self.directory):
             self.sh.attic('init', self.directory)
-        
+    
+    def commit(self):
+        self._ensure_repository()
+        if self.session and self.data_interfaces:
+            return self._commit_session()
         super().commit()
     
+    def archive(self):
+        self._ensure_repository()
+        super().archive()
+    
+    def _commit_session(self):
+        session = SESSION_ARCHIVE_PREFIX + time.strftime(TIMESTAMP_FORMAT)
+        names = [data_interface.dump_name() for data_interface in self.data_interfaces]
+        parent = os.path.dirname(os.path.abspath(self.data_interfaces[0].directory))
+        moved = []
+        # the dumps are renamed to their backup names below one directory for attic create,
+        # and moved back afterwards
+        with tempfile.TemporaryDirectory(dir=parent, prefix='.session-') as session_directory:
+            try:
+                for name, data_interface in zip(names, self.data_interfaces):
+                    target = join(session_directory, name)
+                    os.rename(data_interface.directory, target)
+                    moved.append((data_interface.directory, target))
+            except OSError as error:
+                if error.errno != errno.EXDEV:
+                    raise
+                self.log.warning("Dumps are on different file systems, committing them one by one.")
+                self._move_back(moved)
+                return super().commit()
+            
+            try:
+                with open(join(session_directory, SESSION_INDEX_FILE), 'w') as index:
+                    json.dump(names, index)
+                with change_working_directory_to(session_directory), \
+                        self.metrics.measure(session, 'commit', session_directory, 'attic'):
+                    self.sh.attic('create', "{0}::{1}".format(self.directory, session), SESSION_INDEX_FILE, *names)
+            finally:
+                self._move_back(moved)
+        
+        for name, data_interface in zip(names, self.data_interfaces):
+            self._record(name, data_interface.directory + '/')
+        self.log.info("Committed %s in session %s.", ', '.join(names), session)
+    
+    def _move_back(self, moved):
+        for original, target in reversed(moved):
+            os.rename(target, original)
+    
+    def _arguments_fit(self, arguments):
+        # attic can't read paths from stdin, so large file lists have to be avoided
+        limit = os.sysconf('SC_ARG_MAX') - sum(len(key) + len(value) + 2 for key, value in os.environ.items())
+        return sum(len(os.fsencode(argument)) + 1 for argument in arguments) < limit // 2
+    
+    def _symlink_targets(self, directory):
+        with os.scandir(directory) as entries:
+            return [os.readlink(entry.path) for entry in entries if entry.is_symlink()]
+    
     def commit_data_interface(self, name, source):
+        # Top level symlinks are archived as what they point to, which takes an argument
+        # per entry. Without them, or when the entries don't fit, attic archives the
+        # directory itself.
         archive_name = "{0}::{1}".format(self.directory, name)
-        files = self._files_to_archive_in_directory(source)
+        targets = self._symlink_targets(source)
+        if not targets:
+            paths = ['.']
+        elif self._arguments_fit(self._files_to_archive_in_directory(source)):
+            paths = sorted(self._files_to_archive_in_directory(source))
+        else:
+            self.log.warning("%s has too many top level entries to pass to attic create, archiving the "
+                "directory, its symlinks are archived next to what they point to.", source)
+            paths = ['.'] + sorted(targets)
         
         with change_working_directory_to(source):
-            
-            self.sh.attic('create', archive_name, *files)
+            self.sh.attic('create', archive_name, *paths)
+
+
+class ChunkingArchiver(Archiver):
+    MANIFEST_DIRECTORY = 'manifests'
+    WRITES_IN_PLACE = False
+    
+    def __init__(self, directory, data_interfaces, sh=sh, chunker=None, jobs=None, catalog=None, metrics=None,
+            staging=True):
+        super().__init__(directory, data_interfaces, sh=sh, catalog=catalog, metrics=metrics, staging=staging)
+        self.jobs = jobs or os.cpu_count()
+        self.chunker = chunker or Chunker(jobs=self.jobs)
+        self.store = ChunkStore(self.directory)
+    
+    def commit(self):
+        try:
+            super().commit()
+        finally:
+            self.chunker.close()
+    
+    def archive(self):
+        try:
+            super().archive()
+        finally:
+            self.chunker.close()
+    
+    def _walk(self, top):
+        yield top
+        if not os.path.isdir(top) or os.path.islink(top):
+            return
+        for directory, directories, files in os.walk(top):
+            for name in sorted(directories + files):
+                yield join(directory, name)
+            directories.sort()
+    
+    def _store_file(self, path, hashers):
+        digests = []
+        # bound the chunks in flight, so memory use doesn't grow with the file size
+        in_flight = deque()
+        
+        def store_oldest():
+            future, data = in_flight.popleft()
+            digest = future.result()
+            if self.store.add(digest, data):
+                self.stored_bytes += len(data)
+            digests.append(digest)
+        
+        self.committed_bytes += os.path.getsize(path)
+        with open(path, 'rb') as source:
+            for offset, length in self.chunker.boundaries(path):
+                data = source.read(length)
+                in_flight.append((hashers.submit(sha256_hexdigest, data), data))
+                if len(in_flight) > 2 * self.jobs:
+                    store_oldest()
+        while in_flight:
+            store_oldest()
+        return digests
+    
+    def _manifest_entry(self, path, hashers):
+        status = os.lstat(path)
+        entry = dict(path=path, mode=stat.S_IMODE(status.st_mode), mtime_ns=status.st_mtime_ns,
+            uid=status.st_uid, gid=status.st_gid)
+        if stat.S_ISDIR(status.st_mode):
+            entry.update(type='directory')
+        elif stat.S_ISLNK(status.st_mode):
+            entry.update(type='symlink', target=os.readlink(path))
+        elif stat.S_ISREG(status.st_mode):
+            entry.update(type='file', size=status.st_size, chunks=self._store_file(path, hashers))
+        else:
+            self.log.warning("Skipping special file %s.", path)
+            return None
+        return entry
+    
+    def commit_data_interface(self, name, source):
+        manifest_path = join(self.directory, self.MANIFEST_DIRECTORY, name)
+        assert not exists(manifest_path), "Manifest %s already exists" % manifest_path
+        os.makedirs(join(self.directory, self.MANIFEST_DIRECTORY), exist_ok=True)
+        self.stored_bytes = 0
+        self.committed_bytes = 0
+        
+        partial_manifest_path = manifest_path + '.partial'
+        with change_working_directory_to(source), \
+                open(partial_manifest_path, 'w') as manifest, \
+                ThreadPoolExecutor(max_workers=self.jobs) as hashers:
+            for top in self._files_to_archive_in_directory(source):
+                for path in self._walk(top):
+                    entry = self._manifest_entry(path, hashers)
+                    if entry is not None:
+                        write_json_line(manifest, entry)
+        os.rename(partial_manifest_path, manifest_path)
+        self.log.info("Committed %s, stored %d new bytes.", name, self.stored_bytes)
+    
+    def _dump_in_place(self, data_interface):
+        name = data_interface.dump_name()
+        partial = join(self.directory, PARTIAL_PREFIX + name)
+        data_interface.dump_into(partial)
+        try:
+            self._dump(data_interface)
+        except BaseException:
+            shutil.rmtree(partial, ignore_errors=True)
+            raise
+        destination = join(self.directory, name)
+        os.rename(partial, destination)
+        data_interface.dump_into(destination)
+        self._record(name, destination + '/')
+    
+    def _committed_size(self, name, source):
+        return self.committed_bytes
@@ -0,0 +1,129 @@
+from os.path import abspath, dirname, expanduser
+import os
+import re
+import sqlite3
+import threading
+import time
+
+DEFAULT_CATALOG = '~/.cache/redumpster/catalog.sqlite'
+BACKUP_NAME_PATTERN = re.compile(r'([a-zA-Z0-9]+)-([a-zA-Z0-9-]*)-(\d{4}-\d{2}-\d{2}_\d{2}-\d{2}-\d{2})')
+# the third group of BACKUP_NAME_PATTERN
+TIMESTAMP_FORMAT = '%Y-%m-%d_%H-%M-%S'
+# a container changed again within this many seconds may not have a new mtime yet
+MTIME_RESOLUTION = 2
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS containers (
+    location TEXT PRIMARY KEY,
+    mtime_ns INTEGER
+);
+CREATE TABLE IF NOT EXISTS backups (
+    location TEXT NOT NULL,
+    name TEXT NOT NULL,
+    interface TEXT,
+    backup_name TEXT,
+    timestamp TEXT,
+    size INTEGER,
+    PRIMARY KEY (location, name)
+);
+CREATE INDEX IF NOT EXISTS backups_by_prefix ON backups (location, interface, backup_name, timestamp);
+'''
+
+def parse_backup_name(name):
+    return BACKUP_NAME_PATTERN.match(name)
+
+def _prefix_upper_bound(prefix):
+    # names starting with prefix sort in [prefix, upper bound), which lets sqlite use the primary key
+    if not prefix:
+        return None
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+class BackupCatalog(object):
+    # Remembers which backups a container (a dump directory, chunk store or attic
+    # repository) holds, so finding them doesn't need to list the container every time.
+    
+    def __init__(self, path=DEFAULT_CATALOG):
+        path = expanduser(path)
+        if path != ':memory:':
+            os.makedirs(dirname(abspath(path)), exist_ok=True)
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self.connection:
+            self.connection.executescript(SCHEMA)
+    
+    def _location(self, location):
+        return abspath(location)
+    
+    def _row(self, location, name, size):
+        match = parse_backup_name(name)
+        interface, backup_name, timestamp = match.groups() if match else (None, None, None)
+        return (location, name, interface, backup_name, timestamp, size)
+    
+    def record(self, location, name, size=None):
+        with self._lock, self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO backups VALUES (?, ?, ?, ?, ?, ?)',
+                self._row(self._location(location), name, size))
+    
+    def forget(self, location, name):
+        with self._lock, self.connection:
+            self.connection.execute('DELETE FROM backups WHERE location = ? AND name = ?',
+                (self._location(location), name))
+    
+    def refresh(self, location, list_backups, watched=None, size_of=lambda name: None):
+        # Only lists the container if watched (by default the container itself) has a
+        # different mtime than at the last refresh. Returns whether it had to list it.
+        location = self._location(location)
+        mtime_ns = os.stat(watched or location).st_mtime_ns
+        with self._lock:
+            known_mtime = self.connection.execute(
+                'SELECT mtime_ns FROM containers WHERE location = ?', (location,)).fetchone()
+        if known_mtime is not None and known_mtime[0] == mtime_ns:
+            return False
+        
+        names = set(list_backups())
+        with self._lock, self.connection:
+            known = set(name for name, in self.connection.execute(
+                'SELECT name FROM backups WHERE location = ?', (location,)))
+            self.connection.executemany('DELETE FROM backups WHERE location = ? AND name = ?',
+                ((location, name) for name in known - names))
+            self.connection.executemany('INSERT INTO backups VALUES (?, ?, ?, ?, ?, ?)',
+                (self._row(location, name, size_of(name)) for name in sorted(names - known)))
+            # a change right after listing could keep the same mtime, so list again next time
+            if time.time() - mtime_ns / 1e9 < MTIME_RESOLUTION:
+                mtime_ns = None
+            self.connection.execute('INSERT OR REPLACE INTO containers VALUES (?, ?)', (location, mtime_ns))
+        return True
+    
+    def _query_with_prefix(self, select, location, prefix, suffix='', parameters=()):
+        conditions = 'location = ? AND name >= ?'
+        arguments = [self._location(location), prefix]
+        upper_bound = _prefix_upper_bound(prefix)
+        if upper_bound is not None:
+            conditions += ' AND name < ?'
+            arguments.append(upper_bound)
+        with self._lock:
+            return self.connection.execute(
+                '%s FROM backups WHERE %s %s' % (select, conditions, suffix),
+                arguments + list(parameters)).fetchall()
+    
+    def backup_names(self, location, prefix=''):
+        return [name for name, in self._query_with_prefix('SELECT name', location, prefix, 'ORDER BY name')]
+    
+    def latest_backup(self, location, prefix=''):
+        rows = self._query_with_prefix('SELECT name', location, prefix, 'ORDER BY name DESC LIMIT 1')
+        return rows[0][0] if rows else None
+    
+    def prefixes(self, location, prefix='', limit=2):
+        # distinct (interface, backup name) pairs, (None, None) stands for unparseable names
+        return self._query_with_prefix('SELECT DISTINCT interface, backup_name', location, prefix,
+            'LIMIT ?', [limit])
+    
+    def size(self, location, name):
+        with self._lock:
+            row = self.connection.execute('SELECT size FROM backups WHERE location = ? AND name = ?',
+                (self._location(location), name)).fetchone()
+        return row[0] if row else None
+    
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,188 @@
+from concurrent.futures import ProcessPoolExecutor
+from os.path import join, exists, dirname
+from .manifest import read_json_lines
+import hashlib
+import os
+import random
+import tempfile
+
+MASK_64 = (1 << 64) - 1
+# the gear hash shifts one bit per byte, so only the last 64 bytes influence it
+GEAR_WINDOW = 64
+# bytes hashed per numpy pass, small enough for its arrays (8 bytes per byte) to stay in cache
+NUMPY_BLOCK_SIZE = 64 << 10
+
+def _gear_table():
+    # fixed seed, chunk boundaries must never change between runs
+    generator = random.Random(0x7265647564)
+    return [generator.getrandbits(64) for _ in range(256)]
+
+GEAR = _gear_table()
+
+def _gear_candidates(data, start, offset, mask):
+    gear = GEAR
+    fingerprint = 0
+    candidates = []
+    for position, byte in enumerate(data, start + 1):
+        fingerprint = ((fingerprint << 1) + gear[byte]) & MASK_64
+        if not fingerprint & mask and position > offset:
+            candidates.append(position)
+    return candidates
+
+def _gear_candidates_with_numpy(numpy, data, start, offset, mask):
+    # The same fingerprints as _gear_candidates, computed for a whole block at once.
+    # After adding each fingerprint to the one `width` bytes before, shifted by width,
+    # it covers twice as many bytes. Six rounds cover GEAR_WINDOW, and uint64 wraps
+    # around like MASK_64.
+    gear = numpy.array(GEAR, dtype=numpy.uint64)
+    mask = numpy.uint64(mask)
+    shifted = numpy.empty(NUMPY_BLOCK_SIZE + GEAR_WINDOW, dtype=numpy.uint64)
+    candidates = []
+    for block_start in range(0, len(data), NUMPY_BLOCK_SIZE):
+        # the bytes before the block warm the fingerprints up
+        warm_start = max(0, block_start - GEAR_WINDOW + 1)
+        block = numpy.frombuffer(data, dtype=numpy.uint8,
+            count=min(len(data), block_start + NUMPY_BLOCK_SIZE) - warm_start, offset=warm_start)
+        fingerprints = gear.take(block)
+        width = 1
+        while width < GEAR_WINDOW:
+            rest = len(fingerprints) - width
+            numpy.left_shift(fingerprints[:rest], numpy.uint64(width), out=shifted[:rest])
+            fingerprints[width:] += shifted[:rest]
+            width *= 2
+        fingerprints &= mask
+        positions = numpy.flatnonzero(fingerprints == 0) + (start + warm_start + 1)
+        first = max(offset, start + block_start) + 1
+        candidates.extend(positions[positions >= first].tolist())
+    return candidates
+
+def _boundary_candidates(path, offset, length, mask):
+    # Because the hash only depends on the last GEAR_WINDOW bytes, each segment can be
+    # scanned on its own after warming up with the bytes preceding it.
+    start = max(0, offset - GEAR_WINDOW)
+    with open(path, 'rb') as source:
+        source.seek(start)
+        data = source.read(offset + length - start)
+    
+    # numpy is optional, it hashes about twenty times as fast as the loop in Python
+    try:
+        import numpy
+    except ImportError:
+        return _gear_candidates(data, start, offset, mask)
+    return _gear_candidates_with_numpy(numpy, data, start, offset, mask)
+
+def sha256_hexdigest(data):
+    # hashlib releases the GIL for large buffers, so this parallelizes in threads
+    return hashlib.sha256(data).hexdigest()
+
+
+class Chunker(object):
+    def __init__(self, average_size=1 << 20, min_size=None, max_size=None,
+            segment_size=64 << 20, jobs=None):
+        assert average_size & (average_size - 1) == 0, "average_size must be a power of two"
+        self.average_size = average_size
+        self.min_size = min_size or average_size // 4
+        self.max_size = max_size or average_size * 8
+        self.segment_size = segment_size
+        self.jobs = jobs
+        bits = average_size.bit_length() - 1
+        self.mask = ((1 << bits) - 1) << (64 - bits)
+        self._executor = None
+    
+    def _candidates(self, path, size):
+        segments = [(offset, min(self.segment_size, size - offset))
+            for offset in range(0, size, self.segment_size)]
+        if len(segments) == 1:
+            return [_boundary_candidates(path, 0, size, self.mask)]
+        
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.jobs)
+        return self._executor.map(_boundary_candidates,
+            *zip(*((path, offset, length, self.mask) for offset, length in segments)))
+    
+    def boundaries(self, path):
+        size = os.path.getsize(path)
+        if size <= self.min_size:
+            if size > 0:
+                yield 0, size
+            return
+        
+        start = 0
+        for candidates in self._candidates(path, size):
+            for candidate in candidates:
+                while candidate - start > self.max_size:
+                    yield start, self.max_size
+                    start += self.max_size
+                if candidate - start >= self.min_size:
+                    yield start, candidate - start
+                    start = candidate
+        while size - start > self.max_size:
+            yield start, self.max_size
+            start += self.max_size
+        if size > start:
+            yield start, size - start
+    
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+
+class ChunkStore(object):
+    def __init__(self, directory):
+        self.directory = join(directory, 'chunks')
+    
+    def _path(self, digest):
+        return join(self.directory, digest[:2], digest)
+    
+    def __contains__(self, digest):
+        return exists(self._path(digest))
+    
+    def add(self, digest, data):
+        if digest in self:
+            return False
+        
+        chunk_path = self._path(digest)
+        os.makedirs(dirname(chunk_path), exist_ok=True)
+        # write to a temporary name first, so a crash never leaves a truncated chunk behind
+        descriptor, temporary_path = tempfile.mkstemp(dir=dirname(chunk_path), prefix='.partial-')
+        with os.fdopen(descriptor, 'wb') as chunk:
+            chunk.write(data)
+        os.rename(temporary_path, chunk_path)
+        return True
+    
+    def read(self, digest):
+        with open(self._path(digest), 'rb') as chunk:
+            return chunk.read()
+
+
+def restore_manifest(manifest_path, store, destination):
+    directories = []
+    for entry in read_json_lines(manifest_path):
+        # absolute paths come from resolved symlinks, rsync --relative puts them below the destination
+        target = join(destination, entry['path'].lstrip('/'))
+        if entry['type'] == 'directory':
+            os.makedirs(target, exist_ok=True)
+            directories.append((target, entry))
+            continue
+        
+        os.makedirs(dirname(target), exist_ok=True)
+        if entry['type'] == 'symlink':
+            os.symlink(entry['target'], target)
+        else:
+            with open(target, 'wb') as restored:
+                for digest in entry['chunks']:
+                    restored.write(store.read(digest))
+        _restore_metadata(target, entry)
+    
+    # restore directory metadata last, writing files into them would change their mtime
+    for target, entry in reversed(directories):
+        _restore_metadata(target, entry)
+
+def _restore_metadata(target, entry):
+    if os.geteuid() == 0:
+        os.lchown(target, entry['uid'], entry['gid'])
+    if entry['type'] == 'symlink':
+        return
+    os.chmod(target, entry['mode'])
+    os.utime(target, ns=(entry['mtime_ns'], entry['mtime_ns']))
@@ -0,0 +1,36 @@
+class UnknownCompressionError(Exception):
+    pass
+
+class Codec(object):
+    def __init__(self, name, command, extension, threads_flag=None):
+        self.name = name
+        self.command = command
+        self.extension = extension
+        self.threads_flag = threads_flag
+    
+    def compress_arguments(self, level=None, threads=None):
+        arguments = ['--stdout']
+        if level not in (None, ''):
+            arguments.append('-%d' % int(level))
+        if threads not in (None, '') and self.threads_flag is not None:
+            arguments.append(self.threads_flag % int(threads))
+        return arguments
+    
+    def decompress_arguments(self, filename):
+        return ['--decompress', '--stdout', filename]
+
+
+known_codecs = dict(
+    # gzip is single threaded, use pigz if you want to use more cores
+    gzip=Codec('gzip', 'gzip', '.gz'),
+    pigz=Codec('pigz', 'pigz', '.gz', threads_flag='--processes=%d'),
+    zstd=Codec('zstd', 'zstd', '.zst', threads_flag='-T%d'),
+    xz=Codec('xz', 'xz', '.xz', threads_flag='--threads=%d'),
+)
+
+def codec_named(name):
+    if name in (None, '', 'none'):
+        return None
+    if name not in known_codecs:
+        raise UnknownCompressionError("Unknown compression {0}".format(name))
+    return known_codecs[name]
@@ -0,0 +1,137 @@
+"""
+The configuration, parsed once into immutable tuples.
+
+Parsing a generated config with thousands of sections with ConfigObj takes a noticeable
+part of every run, so the compiled form is cached as JSON, keyed by the config file's
+path, mtime and content hash. dump.conf is unaffected, data interfaces still write
+their options with ConfigObj.
+"""
+
+from collections import namedtuple
+from os.path import abspath, expanduser, join
+import hashlib
+import json
+import os
+import tempfile
+
+from configobj import ConfigObj
+from .tags import TagIndex, is_selectable_tag
+from .utils import as_list
+
+DEFAULT_CACHE_DIRECTORY = '~/.cache/redumpster/config'
+# bump when the compiled form changes, older cache entries are ignored then
+CACHE_FORMAT = 2
+
+class InvalidConfigError(Exception):
+    pass
+
+
+class InterfaceConfig(namedtuple('InterfaceConfig', 'backup_name interface_name tags options')):
+    # options are (key, value) pairs as written in the section, values are strings or
+    # tuples of strings for lists
+    __slots__ = ()
+    
+    def option_dict(self):
+        return dict((key, list(value) if isinstance(value, tuple) else value) for key, value in self.options)
+
+
+class CompiledConfig(object):
+    __slots__ = ('path', 'sections', '_tag_index')
+    
+    def __init__(self, path, sections):
+        self.path = path
+        self.sections = tuple(sections)
+        self._tag_index = None
+    
+    def tag_index(self):
+        if self._tag_index is None:
+            self._tag_index = TagIndex(section.tags for section in self.sections)
+        return self._tag_index
+    
+    def select(self, tag_expression=''):
+        # lazily yields the sections matching tag_expression
+        for position in self.tag_index().select(tag_expression):
+            yield self.sections[position]
+    
+    def to_json(self):
+        return dict(path=self.path, sections=[
+            [section.backup_name, section.interface_name, list(section.tags),
+                [[key, list(value) if isinstance(value, tuple) else value] for key, value in section.options]]
+            for section in self.sections])
+    
+    @classmethod
+    def from_json(cls, data):
+        return cls(data['path'], (
+            InterfaceConfig(backup_name, interface_name, tuple(tags),
+                tuple((key, tuple(value) if isinstance(value, list) else value) for key, value in options))
+            for backup_name, interface_name, tags, options in data['sections']))
+
+
+def _compile_section(backup_name, options):
+    if not hasattr(options, 'items'):
+        raise InvalidConfigError("%s is not a section" % backup_name)
+    if 'interface_name' not in options:
+        raise InvalidConfigError("Section %s has no interface_name" % backup_name)
+    tags = tuple(as_list(options.get('tags')))
+    for tag in tags:
+        if not is_selectable_tag(tag):
+            raise InvalidConfigError("Section %s has tag %r, tags can't be and, or, not "
+                "or contain parentheses or whitespace" % (backup_name, tag))
+    return InterfaceConfig(
+        backup_name=backup_name,
+        interface_name=options['interface_name'],
+        tags=tags,
+        options=tuple((key, tuple(value) if isinstance(value, list) else value)
+            for key, value in options.items()),
+    )
+
+def compile_config(config, path=None):
+    # config is a ConfigObj or a dict of sections
+    if isinstance(config, CompiledConfig):
+        return config
+    return CompiledConfig(path, (_compile_section(name, options) for name, options in config.items()))
+
+def _cache_path(cache_directory, path):
+    return join(expanduser(cache_directory), hashlib.sha256(path.encode()).hexdigest() + '.json')
+
+def _read_cache(cache_path, path, mtime_ns, digest):
+    try:
+        with open(cache_path) as cache:
+            cached = json.load(cache)
+    except (OSError, ValueError):
+        return None
+    if (cached.get('format'), cached.get('path'), cached.get('mtime_ns'), cached.get('sha256')) \
+            != (CACHE_FORMAT, path, mtime_ns, digest):
+        return None
+    return CompiledConfig.from_json(cached['config'])
+
+def _write_cache(cache_path, path, mtime_ns, digest, compiled):
+    # the cache is only an optimization, a read only home directory must not break runs
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        descriptor, temporary_path = tempfile.mkstemp(dir=os.path.dirname(cache_path), prefix='.partial-')
+        with os.fdopen(descriptor, 'w') as cache:
+            json.dump(dict(format=CACHE_FORMAT, path=path, mtime_ns=mtime_ns, sha256=digest,
+                config=compiled.to_json()), cache)
+        os.replace(temporary_path, cache_path)
+    except OSError:
+        pass
+
+def load_config(path, cache_directory=DEFAULT_CACHE_DIRECTORY):
+    path = abspath(path)
+    with open(path, 'rb') as config_file:
+        content = config_file.read()
+        mtime_ns = os.fstat(config_file.fileno()).st_mtime_ns
+    digest = hashlib.sha256(content).hexdigest()
+    
+    cache_path = None
+    if cache_directory is not None:
+        cache_path = _cache_path(cache_directory, path)
+        compiled = _read_cache(cache_path, path, mtime_ns, digest)
+        if compiled is not None:
+            return compiled
+    
+    compiled = compile_config(ConfigObj(content.decode().splitlines()), path)
+    if cache_path is not None:
+        _write_cache(cache_path, path, mtime_ns, digest, compiled)
+    return compiled
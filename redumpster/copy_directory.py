@@ -0,0 +1,159 @@
+from configobj import ConfigObj
+import os
+import tempfile
+from os.path import join, abspath, dirname, normpath, isfile, expanduser
+from glob import glob
+from .copying import NativeCopy
+from .data_interfaces import DataInterface
+from .manifest import METADATA_FILES, has_manifest, read_manifest
+from .sharding import partition_tree, write_file_list, parse_rsync_stats, merge_stats
+from .utils import run_in_parallel
+
+class CopyDirectory(DataInterface):
+    INTERFACE_NAME = 'copydir'
+    
+    def default_options(self):
+        return dict(
+            source=None,
+            # relative to this dump's directory, by default the same backup in sibling dump directories
+            previous_dumps='../../*/{backup_name}',
+            # more than one runs that many rsyncs at once, on parts of the tree split by size,
+            # or by top level entries only (shard_by=top, which skips measuring the tree)
+            shards=1, shard_by='size',
+            # native copies local trees without rsync, with copy_threads copying files at once
+            copy_engine='rsync', copy_threads=4,
+        )
+    
+    def _default_rsync_args(self):
+        return dict(archive=True, acls=True, xattrs=True, numeric_ids=True, delete_after=True)
+    
+    def _uses_native_copy(self):
+        engine = self.config['options'].get('copy_engine') or 'rsync'
+        assert engine in ('rsync', 'native'), "Unknown copy_engine %s" % engine
+        return engine == 'native'
+    
+    def _native_copy(self, source, destination, limiter=None, **kwargs):
+        def progress(relative_path, action, size):
+            self.log.debug("%s %s (%d bytes).", action.capitalize(), relative_path, size)
+        copy = NativeCopy(threads=self.config['options'].get('copy_threads') or 4, progress=progress,
+            limiter=limiter)
+        stats = copy.copy_tree(source, destination, **kwargs)
+        self.log.info("Copied %s: %s", source, stats)
+        return stats
+    
+    def _rsync(self, sh, source, destination, arguments=(), excludes=(), **rsync_args):
+        options = self.config['options']
+        shards = int(options.get('shards') or 1)
+        if shards <= 1:
+            return sh.rsync(*list(excludes) + list(arguments), source, destination, **rsync_args)
+        
+        delete_after = rsync_args.pop('delete_after', False)
+        partitions = partition_tree(source, shards, options.get('shard_by') or 'size',
+            exclude=[name.partition('/')[2] for name in excludes])
+        self.log.info("Copying %s in %d shards.", source, len(partitions))
+        with tempfile.TemporaryDirectory(prefix='redumpster-shards-') as lists:
+            def copy_shard(paths):
+                file_list = write_file_list(lists, paths)
+                return parse_rsync_stats(sh.rsync(*list(excludes) + list(arguments),
+                    '--files-from=' + file_list, '--from0', source, destination,
+                    recursive=True, stats=True, **rsync_args))
+            # raises the first failure, but only once every shard is done
+            stats = run_in_parallel(copy_shard, partitions, len(partitions))
+        
+        if delete_after:
+            # transfers nothing, it only deletes what is no longer in the source
+            stats.append(parse_rsync_stats(sh.rsync(*excludes, source, destination,
+                recursive=True, delete_after=True, existing=True, ignore_existing=True, stats=True)))
+        stats = merge_stats(stats)
+        self.log.info("Copied %s: %s", source, stats)
+        return stats
+    
+    def _is_previous_dump_of_same_source(self, candidate):
+        dump_config = join(candidate, 'dump.conf')
+        if normpath(abspath(candidate)) == normpath(abspath(self.directory)) or not isfile(dump_config):
+            # without dump.conf the dump never finished
+            return False
+        
+        config = ConfigObj(dump_config)
+        source = config.get('options', dict()).get('source')
+        return config.get('interface_name') == self.INTERFACE_NAME and source is not None \
+            and normpath(abspath(source)) == normpath(abspath(self.config['options']['source']))
+    
+    def previous_dump(self):
+        pattern = self.config['options'].get('previous_dumps')
+        if not pattern:
+            return None
+        
+        pattern = normpath(join(abspath(self.directory), pattern.format(backup_name=self.backup_name)))
+        # dumps written into an archive in place sit next to earlier dumps of the same backup
+        siblings = join(dirname(abspath(self.directory)), '%s-%s-*' % (self.INTERFACE_NAME, self.backup_name))
+        candidates = filter(self._is_previous_dump_of_same_source, set(glob(pattern)) | set(glob(siblings)))
+        candidates = sorted(candidates, key=lambda candidate: os.stat(join(candidate, 'dump.conf')).st_mtime)
+        if not candidates:
+            return None
+        return candidates[-1]
+    
+    def _native_dump(self, source, previous_dump):
+        # The copy runs in this process, so rate_limit and latency_probe apply through the
+        # limiter. ionice, nice and cgroup only prefix external tools.
+        policy = self.resource_policy()
+        if policy.command_prefix() or policy.cgroup is not None:
+            self.log.warning("copy_engine=native ignores ionice, nice and cgroup of %s, "
+                "use copy_engine=rsync for them.", self.backup_name)
+        delete = 'delete_after' in self._default_rsync_args()
+        if self.throttle is None:
+            return self._native_copy(source, self.directory, previous=previous_dump, delete=delete)
+        with self.throttle.active() as limiter:
+            return self._native_copy(source, self.directory, limiter=limiter, previous=previous_dump,
+                delete=delete)
+    
+    def dump(self):
+        super().dump()
+        source = normpath(abspath(self.config['options']['source'])) + '/'
+        # path NEEDS to end in a '/' else rsync wouldn't copy the sources content, 
+        # but instead work on the sourc directory.
+        # also normpath removes any existing trailing slashes
+        
+        # rsync checks --link-dest directories in order, so unchanged files are linked against
+        # the previous dump first. Keywords can't repeat, so it is passed as a plain argument.
+        previous_link_dests = []
+        previous_dump = self.previous_dump()
+        if previous_dump is not None:
+            self.log.info("Hard linking unchanged files of %s against %s.", self.backup_name, previous_dump)
+            previous_link_dests.append('--link-dest=' + previous_dump)
+        
+        if self._uses_native_copy():
+            self._native_dump(source, previous_dump)
+        else:
+            policy = self.resource_policy()
+            self._rsync(policy.wrap(self.sh), source, self.directory,
+                arguments=previous_link_dests + policy.rsync_arguments(),
+                link_dest=os.path.dirname(source),
+                **self._default_rsync_args()
+            )
+        
+        previous_entries = ()
+        if previous_dump is not None and has_manifest(previous_dump):
+            previous_entries = read_manifest(previous_dump)
+        self.manifest.add_tree(self.directory, previous_entries)
+    
+    def restore(self, home='~'):
+        super().restore()
+        
+        home = expanduser(home)
+        restore_to = normpath(self.config['options']['source'])
+        
+        # dump.conf and the manifest describe the dump, they don't belong into the restored directory
+        if self._uses_native_copy():
+            self._native_copy(self.directory, restore_to, exclude=METADATA_FILES,
+                delete='delete_after' in self._default_rsync_args(), record_state=False)
+            self.log.info("Restored backup to %s.", restore_to)
+            return restore_to
+        
+        metadata_excludes = ['--exclude=/' + name for name in METADATA_FILES]
+        self._rsync(self.sh, self.directory + '/', restore_to,
+            excludes=metadata_excludes,
+            **self._default_rsync_args()
+        )
+        self.log.info("Restored backup to %s.", restore_to)
+        return restore_to
@@ -0,0 +1,237 @@
+"""
+Copies directory trees without rsync, for local copies.
+
+rsync compares both sides of every file through its delta machinery, even when
+source and destination are on the same machine. NativeCopy instead decides from
+(size, mtime_ns, inode, ctime_ns) of the source whether a file changed since the
+previous dump, which it records in source_state.jsonl next to the dump. The ctime
+catches chmod, chown and setfattr, which leave the mtime alone. Unchanged files are
+hard linked against the previous dump, changed files are copied in the kernel from
+a pool of threads. Like rsync -a --acls --xattrs --numeric-ids it keeps modes,
+ownership (when running as root), mtimes, extended attributes and with them ACLs,
+which Linux stores as system.posix_acl_* attributes. With a limiter (a RateLimiter of
+redumpster.throttle) files are copied in small chunks at its rate.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from os.path import join, lexists
+from logging import getLogger
+import errno
+import json
+import os
+import stat
+import threading
+
+from .datapath import copy_stream
+from .manifest import SOURCE_STATE_FILE
+from .throttle import THROTTLED_BUFFER_SIZE
+
+DEFAULT_THREADS = 4
+# attributes the file system or the user can't set are skipped, like rsync does
+IGNORED_XATTR_ERRORS = (errno.ENOTSUP, errno.EOPNOTSUPP, errno.EPERM, errno.EACCES)
+
+def read_source_state(directory):
+    # {relative path: (size, mtime_ns, inode, ctime_ns)} of the source files a dump was
+    # copied from, states written before ctime_ns was recorded never match
+    state = dict()
+    path = join(directory, SOURCE_STATE_FILE)
+    if not os.path.isfile(path):
+        return state
+    with open(path) as stream:
+        for line in stream:
+            entry = json.loads(line)
+            state[entry['path']] = (entry['size'], entry['mtime_ns'], entry['inode'], entry.get('ctime_ns'))
+    return state
+
+def _source_key(status):
+    return (status.st_size, status.st_mtime_ns, status.st_ino, status.st_ctime_ns)
+
+def _copy_xattrs(source, destination, follow_symlinks=True):
+    try:
+        names = os.listxattr(source, follow_symlinks=follow_symlinks)
+    except OSError as error:
+        if error.errno in IGNORED_XATTR_ERRORS:
+            return
+        raise
+    for name in names:
+        try:
+            os.setxattr(destination, name, os.getxattr(source, name, follow_symlinks=follow_symlinks),
+                follow_symlinks=follow_symlinks)
+        except OSError as error:
+            if error.errno not in IGNORED_XATTR_ERRORS:
+                raise
+
+def copy_metadata(source, destination, status):
+    # ownership first, chown clears setuid bits
+    is_link = stat.S_ISLNK(status.st_mode)
+    if os.geteuid() == 0:
+        os.chown(destination, status.st_uid, status.st_gid, follow_symlinks=False)
+    if not is_link:
+        os.chmod(destination, stat.S_IMODE(status.st_mode))
+    _copy_xattrs(source, destination, follow_symlinks=not is_link)
+    os.utime(destination, ns=(status.st_atime_ns, status.st_mtime_ns), follow_symlinks=not is_link)
+
+def _is_unchanged_copy(path, status):
+    # the quick check of rsync: same size and mtime, and the same mode and owner
+    try:
+        existing = os.lstat(path)
+    except FileNotFoundError:
+        return False
+    owner = lambda status: (status.st_uid, status.st_gid) if os.geteuid() == 0 else None
+    return stat.S_ISREG(existing.st_mode) \
+        and (existing.st_size, existing.st_mtime_ns) == (status.st_size, status.st_mtime_ns) \
+        and existing.st_mode == status.st_mode and owner(existing) == owner(status)
+
+def _remove(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+        for entry in os.scandir(path):
+            _remove(entry.path)
+        os.rmdir(path)
+    else:
+        os.unlink(path)
+
+
+class NativeCopy(object):
+    # copy_tree() mirrors a source tree into a destination, progress(relative_path, action, size)
+    # is called for every file, action being one of copied, linked, unchanged, deleted.
+    
+    def __init__(self, threads=DEFAULT_THREADS, progress=None, limiter=None):
+        self.log = getLogger(__name__)
+        self.threads = max(1, int(threads))
+        self.progress = progress
+        self.limiter = limiter
+        self.stats = dict(copied=0, copied_bytes=0, linked=0, unchanged=0, deleted=0, directories=0)
+        self._lock = threading.Lock()
+    
+    def _count(self, relative_path, action, size=0):
+        with self._lock:
+            self.stats[action] += 1
+            if action == 'copied':
+                self.stats['copied_bytes'] += size
+        if self.progress is not None:
+            self.progress(relative_path, action, size)
+    
+    def _copy_data(self, source, destination):
+        if self.limiter is None:
+            copy_stream(source, destination)
+            return
+        while True:
+            copied = copy_stream(source, destination, THROTTLED_BUFFER_SIZE)
+            if copied == 0:
+                break
+            self.limiter.throttle(copied)
+    
+    def _copy_file(self, source, destination, relative_path, status):
+        # copied next to its final name first, so a restore never leaves half a file behind
+        partial = join(os.path.dirname(destination), '.%s.partial' % os.path.basename(destination))
+        with open(source, 'rb') as source_file, open(partial, 'wb') as destination_file:
+            self._copy_data(source_file.fileno(), destination_file.fileno())
+        copy_metadata(source, partial, status)
+        os.replace(partial, destination)
+        self._count(relative_path, 'copied', status.st_size)
+    
+    def _update_metadata(self, source, destination, relative_path, status):
+        # unchanged data, but attributes like xattrs may have changed, rsync -a sets them too
+        copy_metadata(source, destination, status)
+        self._count(relative_path, 'unchanged', status.st_size)
+    
+    def _link_or_copy(self, source, destination, relative_path, status, previous_path):
+        try:
+            if lexists(destination):
+                os.unlink(destination)
+            os.link(previous_path, destination)
+            self._count(relative_path, 'linked', status.st_size)
+        except OSError as error:
+            # e.g. too many links, or the previous dump is on another file system
+            self.log.debug("Copying %s instead of linking: %s", relative_path, error)
+            self._copy_file(source, destination, relative_path, status)
+    
+    def _copy_special(self, source, destination, status):
+        if lexists(destination):
+            _remove(destination)
+        if stat.S_ISLNK(status.st_mode):
+            os.symlink(os.readlink(source), destination)
+        elif stat.S_ISFIFO(status.st_mode):
+            os.mkfifo(destination, stat.S_IMODE(status.st_mode))
+        elif stat.S_ISCHR(status.st_mode) or stat.S_ISBLK(status.st_mode):
+            os.mknod(destination, status.st_mode, status.st_rdev)
+        else:
+            # sockets can't be copied
+            return
+        copy_metadata(source, destination, status)
+    
+    def _walk(self, source, destination, relative_directory, exclude, previous, previous_state, state,
+            directories, pool, futures):
+        directory = join(source, relative_directory)
+        with os.scandir(directory) as iterator:
+            entries = sorted(iterator, key=lambda entry: entry.name)
+        for entry in entries:
+            relative_path = join(relative_directory, entry.name) if relative_directory else entry.name
+            if not relative_directory and entry.name in exclude:
+                continue
+            status = entry.stat(follow_symlinks=False)
+            target = join(destination, relative_path)
+            if stat.S_ISDIR(status.st_mode):
+                # never write through a symlink in the destination
+                if os.path.islink(target) or lexists(target) and not os.path.isdir(target):
+                    os.unlink(target)
+                os.makedirs(target, exist_ok=True)
+                # attributes of directories are set once their content is complete
+                directories.append((entry.path, target, status))
+                self._walk(source, destination, relative_path, exclude, previous, previous_state, state,
+                    directories, pool, futures)
+            elif stat.S_ISREG(status.st_mode):
+                if os.path.isdir(target) and not os.path.islink(target):
+                    _remove(target)
+                state.append(dict(path=relative_path, size=status.st_size,
+                    mtime_ns=status.st_mtime_ns, inode=status.st_ino, ctime_ns=status.st_ctime_ns))
+                previous_path = join(previous, relative_path) if previous is not None else None
+                if previous_path is not None and previous_state.get(relative_path) == _source_key(status) \
+                        and _is_unchanged_copy(previous_path, status):
+                    futures.append(pool.submit(self._link_or_copy, entry.path, target, relative_path,
+                        status, previous_path))
+                elif _is_unchanged_copy(target, status):
+                    futures.append(pool.submit(self._update_metadata, entry.path, target, relative_path, status))
+                else:
+                    futures.append(pool.submit(self._copy_file, entry.path, target, relative_path, status))
+            else:
+                self._copy_special(entry.path, target, status)
+    
+    def _delete_extraneous(self, source, destination, relative_directory, exclude):
+        for entry in os.scandir(join(destination, relative_directory)):
+            relative_path = join(relative_directory, entry.name) if relative_directory else entry.name
+            if not relative_directory and entry.name in exclude:
+                continue
+            if not lexists(join(source, relative_path)):
+                _remove(entry.path)
+                self._count(relative_path, 'deleted')
+            elif entry.is_dir(follow_symlinks=False):
+                self._delete_extraneous(source, destination, relative_path, exclude)
+    
+    def copy_tree(self, source, destination, previous=None, exclude=(), delete=True, record_state=True):
+        # previous is an earlier copy of the same source, made by copy_tree with
+        # record_state. exclude are top level names, neither copied nor deleted.
+        previous_state = read_source_state(previous) if previous is not None else dict()
+        exclude = set(exclude) | {SOURCE_STATE_FILE}
+        os.makedirs(destination, exist_ok=True)
+        state, directories, futures = [], [], []
+        with ThreadPoolExecutor(max_workers=self.threads) as pool:
+            self._walk(source, destination, '', exclude, previous, previous_state, state,
+                directories, pool, futures)
+            # raises the first failure, after all copies are done
+            for future in futures:
+                future.result()
+        
+        if delete:
+            self._delete_extraneous(source, destination, '', exclude)
+        # deepest first, setting a directory's mtime must come after changing its content
+        for source_directory, target, status in reversed(directories):
+            copy_metadata(source_directory, target, status)
+            self.stats['directories'] += 1
+        copy_metadata(source, destination, os.lstat(source))
+        
+        if record_state:
+            with open(join(destination, SOURCE_STATE_FILE), 'w') as stream:
+                for entry in state:
+                    stream.write(json.dumps(entry, sort_keys=True) + '\n')
+        return self.stats
@@ -2,45 +2,48 @@ from configobj import ConfigObj
 import datetime
 from logging import getLogger
 import os
-from os.path import join, abspath, normpath, basename, isfile, expanduser
+from os.path import join
 from os import path
-import sh
-import tempfile
-from .utils import same_file_system
+from .catalog import TIMESTAMP_FORMAT
+from .config import compile_config
+from .manifest import ManifestWriter
+from .registry import DataInterfaceRegistry, load_object
+from .utils import default_sh
 
 class UnknownDataInterfaceError(Exception):
     pass
 
-def are_interface_options_tagged_with_tag(options, tag):
-    return 'tags' in options and tag in options['tags']
+def iter_interfaces_from_config(config, directory, tag='', sh=None):
+    # tag is a tag expression, see redumpster.tags. Only the selected interfaces are
+    # constructed, and only once they are asked for.
+    for section in compile_config(config).select(tag):
+        yield DataInterface.make_data_interface(
+            directory, section.interface_name, section.backup_name, section.option_dict(), sh=sh)
 
-def interfaces_from_config(config, directory, tag=''):
-    interfaces = []
-    for backup_name, options in config.items():
-        interface_name = options['interface_name']
-        if tag != '' and not are_interface_options_tagged_with_tag(options, tag):
-            continue
-        interfaces.append(DataInterface.make_data_interface(
-            directory, interface_name, backup_name, options))
-    return interfaces
+def interfaces_from_config(config, directory, tag='', sh=None):
+    return list(iter_interfaces_from_config(config, directory, tag=tag, sh=sh))
 
 class DataInterface(object):
     INTERFACE_NAME = 'data_interface'
+    # restore() only reads from the dump directory, so it can be used in place
+    RESTORE_READS_ONLY = True
     
     @classmethod
-    def make_data_interface(cls, container_directory, data_interface_name, backup_name, options):
+    def make_data_interface(cls, container_directory, data_interface_name, backup_name, options, sh=None):
         if data_interface_name not in known_data_interfaces:
             raise UnknownDataInterfaceError("Unknown data_interface {0}".format(data_interface_name))
         interface_directory = join(container_directory, backup_name)
-        return known_data_interfaces[data_interface_name](interface_directory, options)
+        return known_data_interfaces[data_interface_name](interface_directory, options, sh=sh)
 
     def __init__(self,
             # API options
             directory, options,
-            # for mocking
-            sh=sh):
+            # for mocking, or another executor
+            sh=None):
         self.log = getLogger(__name__)
         self.directory = directory
+        # dump_into() moves the dump, the backup keeps its name
+        self._backup_name = path.basename(directory) if directory is not None else None
         
         # REFACT rename to _options? shouldn't be accessed directly
         self.config = ConfigObj(
@@ -54,149 +57,120 @@ class DataInterface(object):
         
         self.config.merge(dict(options=options or dict()))
         
-        self.sh = sh
+        self.sh = sh if sh is not None else default_sh()
+        self.manifest = None
+        self.throttle = None
+        self._dump_name = None
+        self._tool_options = None
+    
+    def dump_into(self, directory):
+        # for dumping straight into an archive instead of the directory given at construction
+        self.directory = directory
+        self.config.filename = join(directory, 'dump.conf')
     
     @property
     def backup_name(self):
-        # REFACT consider to save this separately? --mh
-        return path.basename(self.directory)
+        return self._backup_name
+    
+    def dump_name(self):
+        # The name archivers store the dump under, e.g. mysql-main-2015-01-20_16-24-29, as
+        # parse_backup_name reads it. The timestamp is taken on the first call, so it
+        # stays the same while the dump is archived.
+        if self._dump_name is None:
+            self._dump_name = '%s-%s-%s' % (self.INTERFACE_NAME, self.backup_name,
+                datetime.datetime.now().strftime(TIMESTAMP_FORMAT))
+        return self._dump_name
     
     def default_options(self):
         return dict(name="")
     
     def options(self):
-        options = dict()
-        for key, value in self.config['options'].items():
-            if key.startswith(self.INTERFACE_NAME + '_'):
-                options[key[len(self.INTERFACE_NAME + '_'):]] = value
-        return options
+        # The options of the dump tools, without the interface name prefix. Built once,
+        # the options only change in load_dump_config. Callers must not change the dict.
+        if self._tool_options is None:
+            prefix = self.INTERFACE_NAME + '_'
+            self._tool_options = dict((key[len(prefix):], value)
+                for key, value in self.config['options'].items() if key.startswith(prefix))
+        return self._tool_options
+    
+    def concurrency_group(self):
+        # interfaces dumping through the same command prefix (usually ssh to the
+        # same host) share a group, so the scheduler can limit load on that host
+        options = self.config['options']
+        return options.get('concurrency_group') or options.get('dump_command_prefix') or None
+    
+    def resource_policy(self):
+        # ionice, nice, rate limits and cgroup of the dump tools, see redumpster.throttle
+        # (imported here, it pulls in subprocess, which commands that don't dump never need)
+        from .throttle import ResourcePolicy
+        return ResourcePolicy.from_options(self.config['options'])
+    
+    def concurrency_limit(self):
+        limit = self.config['options'].get('concurrency_limit', None)
+        if limit is None or limit == '':
+            return None
+        return int(limit)
+    
+    def write_dump_config(self):
+        # dump.conf and the manifest are written last, they mark the dump as finished
+        if self.manifest is not None:
+            self.manifest.close()
+            self.manifest = None
+        self.config.write()
+    
+    def load_dump_config(self, override_options=dict()):
+        self.config.merge(ConfigObj(self.config.filename))
+        self.config.merge(dict(options=override_options))
+        self._tool_options = None
     
     def dump(self):
         if not path.exists(self.directory):
             os.makedirs(self.directory)
+        self.manifest = ManifestWriter(self.directory)
+        self.throttle = self.resource_policy().throttle()
+    
+    def _open_dump_file(self, path):
+        # without a rate limit the tool writes into the file itself
+        if self.throttle is None:
+            return self.manifest.open_file(path), dict()
+        from .throttle import THROTTLED_BUFFER_SIZE
+        return self.throttle.open(self.manifest.open_stream(path)), dict(_out_bufsize=THROTTLED_BUFFER_SIZE)
+    
+    def restore_paths(self):
+        # paths relative to the dump directory that restore() reads, None if it needs everything
+        return None
     
     def restore(self):
         pass
+    
+    # dump() and restore() block until their tools are done. The async variants run them
+    # in a worker thread, the tools themselves can still share one event loop by
+    # passing sh=AsyncSh().
+    async def async_dump(self):
+        import asyncio
+        await asyncio.get_running_loop().run_in_executor(None, self.dump)
+    
+    async def async_restore(self):
+        import asyncio
+        await asyncio.get_running_loop().run_in_executor(None, self.restore)
 
 class NoOp(DataInterface):
     INTERFACE_NAME = 'noop'
-
-class MySQLDump(DataInterface):
-    INTERFACE_NAME = 'mysql'
-    
-    def default_options(self):
-        return dict(
-            super().default_options(),
-            dump_command_prefix='',
-            mysql_user='root', mysql_password='',
-        )
-    
-    def options(self):
-        options = super().options()
-        if not options.get('password', None): # is this intentionally a test for falsyness? --mh
-            options['password'] = False
-        return options
     
-    def dump(self):
-        super().dump()
-        dumpfile = join(self.directory, "dump.sql")
-        
-        sh = self.sh
-        if self.config['options']['dump_command_prefix']:
-            dump_command_prefix = self.config['options']['dump_command_prefix'].split()
-            sh = sh.Command(dump_command_prefix[0]).bake(*dump_command_prefix[1:])
-        
-        sh.mysqldump(
-            "--all-databases", "--complete-insert",
-            _out=dumpfile,
-            **self.options()
-        )
-    
-    def restore(self):
-        super().restore()
-        dumpfile = join(self.directory, "dump.sql")
-        
-        self.sh.mysql(
-            execute="source {0}".format(dumpfile),
-            **self.options()
-        )
+    def restore_paths(self):
+        return []
 
 
-class PostgreSQLDump(DataInterface):
-    INTERFACE_NAME = 'postgres'
-    
-    def default_options(self):
-        return dict(
-            super().default_options(),
-            username='root',
-            dump_command_prefix='',
-        )
-    
-    def dump(self):
-        super().dump()
-        dumpfile = join(self.directory, "dump.sql")
-        
-        sh = self.sh
-        if self.config['options']['dump_command_prefix']:
-            dump_command_prefix = self.config['options']['dump_command_prefix'].split()
-            sh = sh.Command(dump_command_prefix[0]).bake(*dump_command_prefix[1:])
-        
-        sh.pg_dumpall(
-            clean=True,
-            _out=dumpfile,
-            **self.options()
-        )
-    
-    def restore(self):
-        super().restore()
-        dumpfile = join(self.directory, "dump.sql")
-        
-        self.sh.psql(
-            'postgres',
-            file=dumpfile,
-            **self.options()
-        )
-    
+known_data_interfaces = DataInterfaceRegistry()
 
-class CopyDirectory(DataInterface):
-    INTERFACE_NAME = 'copydir'
-    
-    def default_options(self):
-        return dict(
-            source=None,
-        )
-    
-    def _default_rsync_args(self):
-        return dict(archive=True, acls=True, xattrs=True, numeric_ids=True, delete_after=True)
-    
-    def dump(self):
-        super().dump()
-        source = normpath(abspath(self.config['options']['source'])) + '/'
-        # path NEEDS to end in a '/' else rsync wouldn't copy the sources content, 
-        # but instead work on the sourc directory.
-        # also normpath removes any existing trailing slashes
-        self.sh.rsync(source, self.directory, 
-            link_dest=os.path.dirname(source),
-            **self._default_rsync_args()
-        )
-    
-    def restore(self, home='~'):
-        super().restore()
-        
-        home = expanduser(home)
-        restore_to = normpath(self.config['options']['source'])
-        
-        self.sh.rsync(
-            self.directory + '/', restore_to,
-            **self._default_rsync_args()
-        )
-        self.log.info("Restored backup to %s.", restore_to)
-        return restore_to
-    
-
-known_data_interfaces = dict(
-    noop=NoOp,
-    mysql=MySQLDump,
-    postgres=PostgreSQLDump,
-    copydir=CopyDirectory,
+# The built-in interfaces live in modules that are only imported once they are used.
+# Importing them from here keeps working.
+_MOVED_CLASSES = dict(
+    SQLDump='redumpster.sql_dumps', MySQLDump='redumpster.sql_dumps', PostgreSQLDump='redumpster.sql_dumps',
+    CopyDirectory='redumpster.copy_directory',
 )
+
+def __getattr__(name):
+    if name not in _MOVED_CLASSES:
+        raise AttributeError("module %r has no attribute %r" % (__name__, name))
+    return load_object('%s:%s' % (_MOVED_CLASSES[name], name))
@@ -0,0 +1,182 @@
+"""
+Moving dump data without passing it through Python.
+
+Tools write their output straight into the dump file: DirectFileWriter hands its file
+descriptor to sh, so the kernel copies from the tool into the page cache exactly once.
+The manifest still needs a hash of everything written, which FollowingHasher computes
+by reading the file back from the page cache while the tool is still writing.
+
+copy_stream moves data between file descriptors inside the kernel with splice,
+sendfile or copy_file_range, whichever the descriptors and the system support, and
+falls back to a loop with a large buffer.
+"""
+
+import errno
+import fcntl
+import hashlib
+import os
+import stat
+import threading
+
+COPY_BUFFER_SIZE = 4 << 20
+HASH_BUFFER_SIZE = 4 << 20
+PIPE_SIZE = 1 << 20
+# Linux only, fcntl knows it from Python 3.10 on
+F_SETPIPE_SZ = getattr(fcntl, 'F_SETPIPE_SZ', 1031)
+# errors meaning "not for these descriptors", as opposed to real I/O errors
+UNSUPPORTED = (errno.EINVAL, errno.ENOSYS, errno.EXDEV, errno.EOPNOTSUPP, errno.EBADF, errno.ESPIPE)
+
+def enlarge_pipe(fd, size=PIPE_SIZE):
+    # Bigger pipes mean fewer context switches between the tools on both ends. Anything
+    # above /proc/sys/fs/pipe-max-size needs CAP_SYS_RESOURCE, keep the default then.
+    try:
+        return fcntl.fcntl(fd, F_SETPIPE_SZ, size)
+    except OSError:
+        return None
+
+def _is_pipe(fd):
+    return stat.S_ISFIFO(os.fstat(fd).st_mode)
+
+def _is_regular_file(fd):
+    return stat.S_ISREG(os.fstat(fd).st_mode)
+
+def _splice(source, destination, count):
+    return os.splice(source, destination, count)
+
+def _sendfile(source, destination, count):
+    return os.sendfile(destination, source, None, count)
+
+def _copy_file_range(source, destination, count):
+    return os.copy_file_range(source, destination, count)
+
+def _kernel_copy_functions(source, destination):
+    functions = []
+    if hasattr(os, 'splice') and (_is_pipe(source) or _is_pipe(destination)):
+        functions.append(_splice)
+    if hasattr(os, 'copy_file_range') and _is_regular_file(source) and _is_regular_file(destination):
+        functions.append(_copy_file_range)
+    if hasattr(os, 'sendfile') and _is_regular_file(source):
+        functions.append(_sendfile)
+    return functions
+
+_buffers = threading.local()
+
+def _copy_buffer():
+    # one per thread, allocated on first use: copying many small files in the kernel
+    # shouldn't allocate (and zero) a large buffer per file
+    if not hasattr(_buffers, 'buffer'):
+        _buffers.buffer = memoryview(bytearray(COPY_BUFFER_SIZE))
+    return _buffers.buffer
+
+def _read_and_write(source, destination, count):
+    buffer = _copy_buffer()
+    count = os.readv(source, [buffer[:count]])
+    written = 0
+    while written < count:
+        written += os.write(destination, buffer[written:count])
+    return count
+
+def copy_stream(source, destination, size=None):
+    # Copies size bytes, or everything up to end of file, from the current position of
+    # the source descriptor to the destination descriptor. Returns the number of bytes.
+    functions = _kernel_copy_functions(source, destination) + [_read_and_write]
+    copied = 0
+    for function in functions:
+        try:
+            while size is None or copied < size:
+                count = COPY_BUFFER_SIZE if size is None else min(COPY_BUFFER_SIZE, size - copied)
+                moved = function(source, destination, count)
+                if moved == 0:
+                    break
+                copied += moved
+            return copied
+        except OSError as error:
+            # all of them advance the positions, the next one continues where this one failed
+            if function is functions[-1] or error.errno not in UNSUPPORTED:
+                raise
+    return copied
+
+
+class FollowingHasher(object):
+    # Hashes a file while another process appends to it. Call finish() once the
+    # writer is done, it reads the rest and returns the hex digest.
+    
+    POLL_INTERVAL = 0.02
+    
+    def __init__(self, path):
+        self.size = 0
+        self._digest = hashlib.sha256()
+        self._file = open(path, 'rb', buffering=0)
+        self._buffer = memoryview(bytearray(HASH_BUFFER_SIZE))
+        self._finished = threading.Event()
+        self._error = None
+        self._thread = threading.Thread(target=self._follow, name='hash %s' % path, daemon=True)
+        self._thread.start()
+    
+    def _read_available(self):
+        while True:
+            count = self._file.readinto(self._buffer)
+            if not count:
+                return
+            # hashlib releases the GIL for large buffers
+            self._digest.update(self._buffer[:count])
+            self.size += count
+    
+    def _follow(self):
+        try:
+            while not self._finished.is_set():
+                self._read_available()
+                self._finished.wait(self.POLL_INTERVAL)
+            self._read_available()
+        except Exception as error:
+            self._error = error
+    
+    def finish(self):
+        self._finished.set()
+        self._thread.join()
+        self._file.close()
+        if self._error is not None:
+            raise self._error
+        return self._digest.hexdigest()
+
+
+class DirectFileWriter(object):
+    # Handed to sh as _out. Unlike manifest.HashingWriter it has a fileno(), so sh gives
+    # the file itself to the tool as stdout. write() works as well, for Python writers.
+    
+    def __init__(self, path, on_close=None):
+        self.path = path
+        self._fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_CLOEXEC, 0o666)
+        self._hasher = FollowingHasher(path)
+        self._on_close = on_close
+        self._hexdigest = None
+    
+    @property
+    def size(self):
+        return self._hasher.size
+    
+    def fileno(self):
+        return self._fd
+    
+    def write(self, data):
+        view = memoryview(data)
+        while view:
+            view = view[os.write(self._fd, view):]
+    
+    def hexdigest(self):
+        return self._hexdigest
+    
+    def close(self):
+        if self._fd is None:
+            return
+        os.close(self._fd)
+        self._fd = None
+        self._hexdigest = self._hasher.finish()
+        if self._on_close is not None:
+            self._on_close(self)
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,352 @@
+"""
+An asyncio based stand-in for the parts of sh redumpster uses.
+
+sh starts helper threads for every stream of every command. AsyncSh instead runs all
+processes from one event loop in a background thread, so dozens of concurrent dumps
+don't need a thread per stream. It is passed wherever sh=sh is accepted:
+
+    interface = MySQLDump(directory, options, sh=AsyncSh())
+
+Blocking calls look like sh calls. Every command runs in its own process group, which
+is killed when the command times out or is cancelled, including anything it forked.
+Pipes between piped commands are plain OS pipes, enlarged where allowed. Output read
+by Python is read in chunks of at most _out_bufsize, and the command blocks while the
+consumer catches up.
+"""
+
+import asyncio
+import os
+import shutil
+import signal
+import threading
+from logging import getLogger
+
+import sh
+
+from .datapath import enlarge_pipe
+
+DEFAULT_BUFFER_SIZE = 1 << 16
+# only the end of stderr is kept for error messages, tools can be chatty
+STDERR_TAIL_SIZE = 1 << 16
+KILL_GRACE_PERIOD = 5
+
+def compile_arguments(args, kwargs):
+    # same conventions as sh: True is a flag, False and None are left out,
+    # one letter options are short options, underscores become dashes
+    arguments = []
+    for argument in args:
+        if isinstance(argument, (list, tuple)):
+            arguments.extend(str(each) for each in argument)
+        elif argument is not None and argument is not False:
+            arguments.append(str(argument))
+    for key, values in kwargs.items():
+        for value in values if isinstance(values, (list, tuple)) else [values]:
+            if value is None or value is False:
+                continue
+            if len(key) == 1:
+                arguments += ['-' + key] if value is True else ['-' + key, str(value)]
+            else:
+                option = '--' + key.replace('_', '-')
+                arguments.append(option if value is True else '%s=%s' % (option, value))
+    return arguments
+
+def _exception_for(exit_code):
+    if exit_code < 0:
+        return getattr(sh, 'SignalException_%d' % -exit_code)
+    return getattr(sh, 'ErrorReturnCode_%d' % exit_code)
+
+def _fileno(stream):
+    try:
+        return stream.fileno()
+    except (AttributeError, OSError, ValueError):
+        return None
+
+
+class CommandResult(object):
+    def __init__(self, argv, exit_code, stdout, stderr):
+        self.argv = argv
+        self.exit_code = exit_code
+        self.stdout = stdout
+        self.stderr = stderr
+    
+    def wait(self):
+        return self
+    
+    def __str__(self):
+        return self.stdout.decode(errors='replace')
+
+
+class BackgroundCommand(object):
+    # returned for _bg=True, like sh's RunningCommand
+    
+    def __init__(self, future):
+        self.future = future
+    
+    def wait(self, timeout=None):
+        return self.future.result(timeout)
+    
+    def kill(self):
+        self.future.cancel()
+
+
+class PipedCommand(object):
+    # returned for _piped=True, started together with the command it is passed to as _in
+    
+    def __init__(self, command, argv, special):
+        self.command = command
+        self.argv = argv
+        self.special = special
+
+
+class AsyncExecutor(object):
+    # Owns the event loop all commands run on, started on first use.
+    
+    def __init__(self, timeout=None, kill_grace_period=KILL_GRACE_PERIOD):
+        self.log = getLogger(__name__)
+        self.timeout = timeout
+        self.kill_grace_period = kill_grace_period
+        self.loop = None
+        self._thread = None
+        self._lock = threading.Lock()
+    
+    def _running_loop(self):
+        with self._lock:
+            if self.loop is None:
+                self.loop = asyncio.new_event_loop()
+                self._thread = threading.Thread(target=self.loop.run_forever, name='redumpster-executor', daemon=True)
+                self._thread.start()
+            return self.loop
+    
+    def submit(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self._running_loop())
+    
+    def run_sync(self, coroutine):
+        if threading.current_thread() is self._thread:
+            coroutine.close()
+            raise RuntimeError("Blocking command called on the executor's event loop, await command.run() instead")
+        future = self.submit(coroutine)
+        try:
+            return future.result()
+        except BaseException:
+            # e.g. KeyboardInterrupt, don't leave the processes running
+            future.cancel()
+            raise
+    
+    def close(self):
+        with self._lock:
+            if self.loop is None:
+                return
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self._thread.join()
+            self.loop.close()
+            self.loop = None
+    
+    async def kill(self, process):
+        if process.returncode is not None:
+            return
+        for signal_number in (signal.SIGTERM, signal.SIGKILL):
+            try:
+                os.killpg(process.pid, signal_number)
+            except ProcessLookupError:
+                return
+            try:
+                await asyncio.wait_for(process.wait(), self.kill_grace_period)
+                return
+            except asyncio.TimeoutError:
+                pass
+
+
+class AsyncCommand(object):
+    def __init__(self, executor, name, baked_args=(), baked_kwargs=None):
+        self.executor = executor
+        self.name = name
+        self.baked_args = tuple(baked_args)
+        self.baked_kwargs = dict(baked_kwargs or ())
+    
+    def bake(self, *args, **kwargs):
+        return AsyncCommand(self.executor, self.name,
+            self.baked_args + args, dict(self.baked_kwargs, **kwargs))
+    
+    def __getattr__(self, name):
+        # sh.Command('ssh').bake('host').mysqldump runs mysqldump through ssh
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self.bake(name)
+    
+    def _prepare(self, args, kwargs):
+        kwargs = dict(self.baked_kwargs, **kwargs)
+        special = dict((key, value) for key, value in kwargs.items() if key.startswith('_'))
+        options = dict((key, value) for key, value in kwargs.items() if not key.startswith('_'))
+        path = shutil.which(self.name)
+        if path is None:
+            raise sh.CommandNotFound(self.name)
+        return [path] + compile_arguments(self.baked_args + args, options), special
+    
+    def __call__(self, *args, **kwargs):
+        argv, special = self._prepare(args, kwargs)
+        if special.get('_piped'):
+            return PipedCommand(self, argv, special)
+        if special.get('_bg'):
+            return BackgroundCommand(self.executor.submit(self._run(argv, special)))
+        return self.executor.run_sync(self._run(argv, special))
+    
+    async def run(self, *args, **kwargs):
+        argv, special = self._prepare(args, kwargs)
+        return await self._run(argv, special)
+    
+    async def _run(self, argv, special):
+        processes = []
+        try:
+            return await asyncio.wait_for(self._pipeline(argv, special, processes),
+                special.get('_timeout', self.executor.timeout))
+        except asyncio.TimeoutError:
+            raise sh.TimeoutException(-signal.SIGKILL, ' '.join(argv))
+        finally:
+            # only still running after a failure, timeout or cancellation
+            for process in processes:
+                await self.executor.kill(process)
+    
+    async def _spawn(self, argv, special, processes, stdin, stdout):
+        buffer_size = special.get('_out_bufsize', DEFAULT_BUFFER_SIZE)
+        process = await asyncio.create_subprocess_exec(*argv,
+            stdin=stdin, stdout=stdout, stderr=asyncio.subprocess.PIPE,
+            cwd=special.get('_cwd'), env=special.get('_env'),
+            preexec_fn=special.get('_preexec_fn'),
+            # bounds what is buffered from the pipe, the reader pauses beyond it
+            limit=buffer_size,
+            start_new_session=True)
+        processes.append(process)
+        return process
+    
+    async def _pipeline(self, argv, special, processes):
+        stdin, upstream, data = asyncio.subprocess.DEVNULL, None, None
+        source = special.get('_in')
+        if isinstance(source, PipedCommand):
+            read_end, write_end = os.pipe()
+            enlarge_pipe(write_end)
+            try:
+                upstream = await source.command._pipeline_upstream(source, processes, write_end)
+            finally:
+                os.close(write_end)
+            stdin = read_end
+        elif _fileno(source) is not None:
+            stdin = _fileno(source)
+        elif source is not None:
+            stdin, data = asyncio.subprocess.PIPE, source.encode() if isinstance(source, str) else source
+        
+        out = special.get('_out')
+        out_file = open(out, 'wb') if isinstance(out, str) else None
+        if out_file is not None:
+            stdout = out_file.fileno()
+        elif _fileno(out) is not None:
+            stdout = _fileno(out)
+        else:
+            stdout = asyncio.subprocess.PIPE
+        
+        try:
+            process = await self._spawn(argv, special, processes, stdin, stdout)
+            buffer_size = special.get('_out_bufsize', DEFAULT_BUFFER_SIZE)
+            stdout_data, stderr_data, _ = await asyncio.gather(
+                self._read_stdout(process, out, buffer_size),
+                _read_tail(process.stderr),
+                _feed(process, data),
+            )
+            await process.wait()
+            if upstream is not None:
+                # a failing upstream is the more interesting error, report it first
+                await upstream
+        except BaseException:
+            if upstream is not None and not upstream.done():
+                upstream.cancel()
+            raise
+        finally:
+            if isinstance(source, PipedCommand):
+                os.close(stdin)
+            if out_file is not None:
+                out_file.close()
+        return _result(argv, process.returncode, stdout_data, stderr_data, special)
+    
+    async def _pipeline_upstream(self, piped, processes, write_end):
+        # starts a _piped command writing into write_end, returns a task for its result
+        source = piped.special.get('_in')
+        stdin = _fileno(source) if _fileno(source) is not None else asyncio.subprocess.DEVNULL
+        process = await self._spawn(piped.argv, piped.special, processes, stdin, write_end)
+        
+        async def finish():
+            stderr_data = await _read_tail(process.stderr)
+            await process.wait()
+            return _result(piped.argv, process.returncode, b'', stderr_data, piped.special)
+        return asyncio.ensure_future(finish())
+    
+    async def _read_stdout(self, process, out, buffer_size):
+        if process.stdout is None:
+            return b''
+        chunks = []
+        loop = asyncio.get_running_loop()
+        while True:
+            data = await process.stdout.read(buffer_size)
+            if not data:
+                break
+            if out is None:
+                chunks.append(data)
+            elif callable(out):
+                await loop.run_in_executor(None, out, data)
+            else:
+                # writing to disk (and hashing) happens off the loop, reading waits for it
+                await loop.run_in_executor(None, out.write, data)
+        return b''.join(chunks)
+
+
+async def _read_tail(stream):
+    tail = b''
+    while True:
+        data = await stream.read(STDERR_TAIL_SIZE)
+        if not data:
+            return tail
+        tail = (tail + data)[-STDERR_TAIL_SIZE:]
+
+async def _feed(process, data):
+    # data is bytes, or like with sh an iterable of str or bytes chunks
+    if data is None:
+        return
+    try:
+        for chunk in [data] if isinstance(data, bytes) else data:
+            chunk = chunk.encode() if isinstance(chunk, str) else chunk
+            for offset in range(0, len(chunk), DEFAULT_BUFFER_SIZE):
+                process.stdin.write(chunk[offset:offset + DEFAULT_BUFFER_SIZE])
+                await process.stdin.drain()
+    except (BrokenPipeError, ConnectionResetError):
+        pass
+    finally:
+        process.stdin.close()
+
+def _result(argv, exit_code, stdout, stderr, special):
+    ok_codes = special.get('_ok_code', [0])
+    if not isinstance(ok_codes, (list, tuple)):
+        ok_codes = [ok_codes]
+    if exit_code not in ok_codes:
+        raise _exception_for(exit_code)(' '.join(argv), stdout, stderr)
+    return CommandResult(argv, exit_code, stdout, stderr)
+
+
+class AsyncSh(object):
+    # Module-like object handed to classes instead of sh. Piped commands fail the
+    # pipeline when they fail, a broken dump must not be stored as a good one.
+    
+    ErrorReturnCode = sh.ErrorReturnCode
+    TimeoutException = sh.TimeoutException
+    CommandNotFound = sh.CommandNotFound
+    
+    def __init__(self, executor=None, timeout=None):
+        self.executor = executor or AsyncExecutor(timeout=timeout)
+    
+    def Command(self, name):
+        return AsyncCommand(self.executor, name)
+    
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self.Command(name)
+    
+    def close(self):
+        self.executor.close()
@@ -0,0 +1,114 @@
+from os.path import join, isdir, isfile
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+from logging import getLogger
+
+from .manifest import MANIFEST_FILE, has_manifest, read_manifest, write_json_line
+
+JOURNAL_FILE = 'journal.jsonl'
+PENDING, RUNNING, DONE, FAILED = 'pending', 'running', 'done', 'failed'
+
+def _manifest_summary(directory):
+    # size of the dump and a checksum over the hashes of all its files
+    with open(join(directory, MANIFEST_FILE), 'rb') as manifest:
+        sha256 = hashlib.sha256(manifest.read()).hexdigest()
+    return sum(entry['size'] for entry in read_manifest(directory)), sha256
+
+
+class Journal(object):
+    # Records the state of every data interface of a dump run in the dump directory,
+    # one appended line per change: pending, running, done (with size and checksum of
+    # its manifest) or failed. The last line of an interface wins, so a run killed at
+    # any point leaves a journal that tells which dumps can be kept.
+    
+    def __init__(self, directory):
+        self.log = getLogger(__name__)
+        self.directory = directory
+        self.path = join(directory, JOURNAL_FILE)
+        self._lock = threading.Lock()
+    
+    def states(self):
+        states = dict()
+        if not isfile(self.path):
+            return states
+        with open(self.path) as stream:
+            for line in stream:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # a line being written when a run was killed, later runs append after it
+                    continue
+                states[entry['backup_name']] = entry
+        return states
+    
+    def _ends_in_torn_line(self):
+        if not isfile(self.path) or os.path.getsize(self.path) == 0:
+            return False
+        with open(self.path, 'rb') as stream:
+            stream.seek(-1, os.SEEK_END)
+            return stream.read(1) != b'\n'
+    
+    def _append(self, entries):
+        with self._lock:
+            os.makedirs(self.directory, exist_ok=True)
+            torn = self._ends_in_torn_line()
+            with open(self.path, 'a') as stream:
+                # end a line torn by a killed run, so it doesn't swallow the next entry
+                if torn:
+                    stream.write('\n')
+                for entry in entries:
+                    write_json_line(stream, entry)
+                stream.flush()
+                os.fsync(stream.fileno())
+    
+    def record(self, backup_name, state, **details):
+        entry = dict(details, backup_name=backup_name, state=state, time=time.time())
+        self._append([entry])
+        return entry
+    
+    def pending(self, interfaces):
+        now = time.time()
+        self._append([dict(backup_name=interface.backup_name, state=PENDING, time=now) for interface in interfaces])
+    
+    def running(self, interface):
+        self.record(interface.backup_name, RUNNING)
+    
+    def done(self, interface):
+        size = sha256 = None
+        if has_manifest(interface.directory):
+            size, sha256 = _manifest_summary(interface.directory)
+        self.record(interface.backup_name, DONE, size=size, sha256=sha256)
+    
+    def failed(self, interface, exception):
+        self.record(interface.backup_name, FAILED, error=str(exception))
+    
+    def _is_complete(self, interface, entry):
+        # dump.conf and the manifest are written last, and the manifest still has to be
+        # what the journal recorded, otherwise the dump is redone
+        if entry is None or entry['state'] != DONE:
+            return False
+        if not isfile(join(interface.directory, 'dump.conf')):
+            return False
+        if entry.get('sha256') is None:
+            return not has_manifest(interface.directory)
+        return has_manifest(interface.directory) \
+            and _manifest_summary(interface.directory) == (entry['size'], entry['sha256'])
+    
+    def resume(self, interfaces):
+        # Returns the interfaces that still have to be dumped. Their partial dumps are
+        # removed, so they start from scratch.
+        states = self.states()
+        remaining = []
+        for interface in interfaces:
+            if self._is_complete(interface, states.get(interface.backup_name)):
+                self.log.info("Skipping %s, it was dumped completely before.", interface.backup_name)
+                continue
+            if isdir(interface.directory):
+                self.log.info("Removing partial dump of %s.", interface.backup_name)
+                shutil.rmtree(interface.directory)
+            remaining.append(interface)
+        return remaining
@@ -5,34 +5,107 @@
 Import, export, backup and update data.
 
 Usage:
-  redumpster [options] dump --config=<CONFIG> --to=<DUMP_DIR>
+  redumpster [options] dump --config=<CONFIG> --to=<DUMP_DIR> [--resume]
   redumpster [options] restore --config=<CONFIG> --from=<DUMP_DIR>
+  redumpster [options] prune --from=<DUMP_DIR> [--keep-daily=<N>] [--keep-weekly=<N>] [--keep-monthly=<N>]
+                             [--dry-run] [--unlink-jobs=<N>]
+  redumpster [options] verify --from=<DUMP_DIR> [--verify-jobs=<N>] [--rate-limit=<RATE>] [--full]
   redumpster -h | --help
 
 Global Options:
-     --tagged=<TAG>        Which tagged data interfaces to select for restoration or dumping. [default: ]
+     --tagged=<TAGS>       Which tagged data interfaces to select for restoration or dumping. Tags
+                           may be globs and combined with and, or, not and parentheses, for
+                           example 'db and not staging' or 'tenant-*'. [default: ]
      --config=<CONFIG>     Configuration file that specifies what should be backed up.
-                           
+     --jobs=<N>            How many data interfaces to dump or restore concurrently. [default: 1]
+     --jobs-per-group=<N>  How many data interfaces of the same concurrency group (by default
+                           interfaces sharing a dump_command_prefix, i.e. the same host) may run
+                           concurrently. 0 means no limit besides --jobs. [default: 0]
+     --metrics=<FILE>      Write wall time, size, tool CPU time and memory of every data interface
+                           as JSON to this file.
+     --prometheus-textfile=<FILE>  Write the same metrics for the node-exporter textfile collector.
+     --executor=<EXECUTOR>  How to run external tools: sh, or asyncio to supervise all of them from
+                           one event loop. [default: sh]
+     --command-timeout=<SECONDS>  Kill external tools (and everything they started) after this
+                           long. Needs --executor=asyncio.
+  
   -h --help                Show this screen.
   -v --verbose             Increase amount of output.
      --debug               Increase amount of output even more.
 
 Dump Options:
      --to=<DUMP_DIR>       Directory to create backup in. Must be empty or non-existant.
+     --resume              Continue an earlier dump into the same directory. Data interfaces its
+                           journal lists as done are skipped, partial dumps are redone.
 
 Restore Options:
      --from=<RESTORE_DIR>  Backup directory to restore from.
      <restore_options>     Override options that were stored at backup time when restoring,
                            for example to change restore location or mysql credentials.
+
+Prune Options:
+     --keep-daily=<N>      Keep the latest backup of each of the last N days that have one.
+     --keep-weekly=<N>     Keep the latest backup of each of the last N weeks that have one.
+     --keep-monthly=<N>    Keep the latest backup of each of the last N months that have one.
+     --dry-run             Only report which backups would be pruned and how many bytes that frees.
+     --unlink-jobs=<N>     How many threads remove the files of pruned backups. [default: 16]
+
+Verify Options:
+     --verify-jobs=<N>     How many processes hash files. 0 means one per core. [default: 0]
+     --rate-limit=<RATE>   Read at most this many bytes per second, for example 50M. k, M and G are
+                           powers of 1024.
+     --full                Hash all files, also those that didn't change since they were last verified.
 """
 
 
 import logging
 import shutil
+import sys
+from functools import partial
 from os import path
 from docopt import docopt
-from configobj import ConfigObj
+from .config import load_config
 from .data_interfaces import interfaces_from_config
+from .journal import Journal
+from .metrics import Metrics
+from .scheduler import Scheduler
+
+def _dump(metrics, journal, interface):
+    journal.running(interface)
+    try:
+        with metrics.measure(interface.backup_name, 'dump', interface.directory, interface.INTERFACE_NAME):
+            interface.dump()
+            interface.write_dump_config()
+    except BaseException as exception:
+        journal.failed(interface, exception)
+        raise
+    journal.done(interface)
+
+def _restore(metrics, interface):
+    with metrics.measure(interface.backup_name, 'restore', interface.directory, interface.INTERFACE_NAME):
+        interface.restore()
+
+def _prune(arguments):
+    from .pruning import RetentionPolicy, pruner_for, format_report
+    policy = RetentionPolicy(daily=arguments['--keep-daily'], weekly=arguments['--keep-weekly'],
+        monthly=arguments['--keep-monthly'])
+    pruner = pruner_for(arguments['--from'], policy, jobs=arguments['--unlink-jobs'])
+    result = pruner.prune(dry_run=arguments['--dry-run'])
+    for line in format_report(result, dry_run=arguments['--dry-run']):
+        print(line)
+
+def _verify(arguments):
+    from .throttle import parse_rate
+    from .verification import Verifier, dump_directories
+    verifier = Verifier(jobs=arguments['--verify-jobs'], rate_limit=parse_rate(arguments['--rate-limit']),
+        full=arguments['--full'])
+    results = verifier.verify(dump_directories(arguments['--from']))
+    for result in results:
+        for line in result.report():
+            print(line)
+    failed = [result.directory for result in results if not result.ok]
+    if failed:
+        sys.exit("Failed verification: %s" % ', '.join(failed))
 
 def main():
     arguments = docopt(__doc__, argv=None)
@@ -48,13 +121,41 @@ def main():
     logging.basicConfig(level=level)
     
     
+    if arguments['prune']:
+        return _prune(arguments)
+    if arguments['verify']:
+        return _verify(arguments)
+    
     assert path.exists(arguments['--config']), "No config file found"
-    config = ConfigObj(arguments['--config'])
+    config = load_config(arguments['--config'])
+    assert arguments['--executor'] in ('sh', 'asyncio'), "Unknown executor %s" % arguments['--executor']
+    assert arguments['--executor'] == 'asyncio' or not arguments['--command-timeout'], \
+        "--command-timeout needs --executor=asyncio"
+    executor = None
+    if arguments['--executor'] == 'asyncio':
+        from .executor import AsyncSh
+        timeout = arguments['--command-timeout']
+        executor = AsyncSh(timeout=float(timeout) if timeout else None)
+    scheduler = Scheduler(jobs=arguments['--jobs'], group_limit=arguments['--jobs-per-group'])
+    metrics = Metrics()
+    failures = dict()
     if arguments['dump']:
-        for interface in interfaces_from_config(config, arguments['--to'], tag=arguments['--tagged']):
-            interface.dump()
+        interfaces = interfaces_from_config(config, arguments['--to'], tag=arguments['--tagged'], sh=executor)
+        journal = Journal(arguments['--to'])
+        if arguments['--resume']:
+            interfaces = journal.resume(interfaces)
+        journal.pending(interfaces)
+        failures = scheduler.run(interfaces, partial(_dump, metrics, journal), action_name='dump')
         shutil.copy2(arguments['--config'], path.join(arguments['--to']))
     
     if arguments['restore']:
-        for interface in interfaces_from_config(config, arguments['--from'], tag=arguments['--tagged']):
-            interface.restore()
+        interfaces = interfaces_from_config(config, arguments['--from'], tag=arguments['--tagged'], sh=executor)
+        failures = scheduler.run(interfaces, partial(_restore, metrics), action_name='restore')
+    
+    if arguments['--metrics']:
+        metrics.write_json(arguments['--metrics'])
+    if arguments['--prometheus-textfile']:
+        metrics.write_prometheus_textfile(arguments['--prometheus-textfile'])
+    
+    if failures:
+        sys.exit("Failed data interfaces: %s" % ', '.join(failures.keys()))
@@ -0,0 +1,154 @@
+from os.path import join, relpath, isfile
+import hashlib
+import json
+import os
+import stat
+import threading
+from .datapath import DirectFileWriter
+
+MANIFEST_FILE = 'manifest.jsonl'
+# the state of the copied files, see redumpster.copying
+SOURCE_STATE_FILE = 'source_state.jsonl'
+# written next to the dumped data, but not part of it
+METADATA_FILES = ('dump.conf', MANIFEST_FILE, MANIFEST_FILE + '.partial', SOURCE_STATE_FILE)
+HASH_BLOCK_SIZE = 1 << 20
+
+def write_json_line(stream, entry):
+    stream.write(json.dumps(entry, sort_keys=True) + '\n')
+
+def read_json_lines(path):
+    with open(path) as stream:
+        for line in stream:
+            yield json.loads(line)
+
+def read_manifest(directory):
+    return read_json_lines(join(directory, MANIFEST_FILE))
+
+def has_manifest(directory):
+    return isfile(join(directory, MANIFEST_FILE))
+
+def hash_file(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as source:
+        for block in iter(lambda: source.read(HASH_BLOCK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class HashingWriter(object):
+    # Handed to sh as _out. It deliberately has no fileno(), so sh passes the
+    # output through write() and it can be hashed on its way to disk.
+    
+    def __init__(self, path, on_close=None):
+        self.path = path
+        self.size = 0
+        self._digest = hashlib.sha256()
+        self._file = open(path, 'wb')
+        self._on_close = on_close
+    
+    def write(self, data):
+        self._digest.update(data)
+        self.size += len(data)
+        self._file.write(data)
+    
+    def hexdigest(self):
+        return self._digest.hexdigest()
+    
+    def close(self):
+        if self._file.closed:
+            return
+        self._file.close()
+        if self._on_close is not None:
+            self._on_close(self)
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class ManifestWriter(object):
+    # Collects (path, size, mtime, mode, content hash) of everything a dump writes.
+    # Entries are appended as files are finished, so nothing is kept in memory.
+    
+    def __init__(self, directory):
+        self.directory = directory
+        self.path = join(directory, MANIFEST_FILE)
+        self._lock = threading.Lock()
+        self._stream = None
+    
+    def _add(self, path, sha256):
+        status = os.lstat(path)
+        entry = dict(
+            path=relpath(path, self.directory),
+            size=status.st_size, mtime_ns=status.st_mtime_ns,
+            mode=stat.S_IMODE(status.st_mode), sha256=sha256,
+        )
+        with self._lock:
+            if self._stream is None:
+                self._stream = open(self.path + '.partial', 'w')
+            write_json_line(self._stream, entry)
+        return entry
+    
+    def open_stream(self, path):
+        return HashingWriter(path, on_close=lambda writer: self._add(writer.path, writer.hexdigest()))
+    
+    def open_file(self, path):
+        # for tool output: the tool writes into the file directly, it is hashed as it grows
+        return DirectFileWriter(path, on_close=lambda writer: self._add(writer.path, writer.hexdigest()))
+    
+    def add_file(self, path, sha256=None):
+        if sha256 is None:
+            sha256 = hash_file(path)
+        return self._add(path, sha256)
+    
+    def add_tree(self, directory, previous_entries=()):
+        # previous_entries is the manifest of an earlier dump of the same tree. Files
+        # with unchanged size and mtime (e.g. hard links to that dump) reuse its hash
+        # instead of being read again.
+        previous = _EntriesInWalkOrder(previous_entries)
+        for root, directories, files in os.walk(directory):
+            directories.sort()
+            for name in sorted(files):
+                path = join(root, name)
+                if root == self.directory and name in METADATA_FILES:
+                    continue
+                # only regular files have content to hash, opening a FIFO would block
+                status = os.lstat(path)
+                if not stat.S_ISREG(status.st_mode):
+                    continue
+                known = previous.find(relpath(path, self.directory))
+                if known is not None and (known['size'], known['mtime_ns']) == (status.st_size, status.st_mtime_ns):
+                    self._add(path, known['sha256'])
+                else:
+                    self.add_file(path)
+    
+    def close(self):
+        with self._lock:
+            if self._stream is None:
+                self._stream = open(self.path + '.partial', 'w')
+            self._stream.close()
+            os.rename(self.path + '.partial', self.path)
+
+
+def _walk_order_key(relative_path):
+    # os.walk with sorted names lists the files of a directory before descending into it
+    components = relative_path.split(os.sep)
+    return tuple((1, component) for component in components[:-1]) + ((0, components[-1]),)
+
+class _EntriesInWalkOrder(object):
+    # Looks up entries of a manifest written in walk order without loading it into memory.
+    # Lookups must happen in walk order as well.
+    
+    def __init__(self, entries):
+        self._entries = iter(entries)
+        self._current = next(self._entries, None)
+    
+    def find(self, relative_path):
+        key = _walk_order_key(relative_path)
+        while self._current is not None and _walk_order_key(self._current['path']) < key:
+            self._current = next(self._entries, None)
+        if self._current is not None and self._current['path'] == relative_path:
+            return self._current
+        return None
@@ -0,0 +1,111 @@
+from contextlib import contextmanager
+from os.path import join, isdir
+import json
+import os
+import resource
+import threading
+import time
+
+from .manifest import has_manifest, read_manifest
+
+def _tree_size(directory):
+    # dumps list what they wrote in their manifest, anything else has to be walked
+    if directory is None or not isdir(directory):
+        return None, None
+    if has_manifest(directory):
+        sizes = [entry['size'] for entry in read_manifest(directory)]
+        return sum(sizes), len(sizes)
+    size = files = 0
+    for root, directories, names in os.walk(directory):
+        for name in names:
+            path = join(root, name)
+            if not os.path.islink(path):
+                size += os.path.getsize(path)
+                files += 1
+    return size, files
+
+def _escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Metrics(object):
+    # Records one entry per stage (dump, restore, commit) of every data interface.
+    #
+    # Child CPU time and max RSS come from RUSAGE_CHILDREN, which covers all children
+    # of this process that have been waited for. When stages run concurrently, their
+    # numbers include each other's tools. Max RSS is the largest child so far, so it
+    # is only reported when it grew during the stage.
+    
+    PROMETHEUS_METRICS = (
+        ('seconds', 'redumpster_stage_duration_seconds', 'Wall time of the stage.'),
+        ('bytes', 'redumpster_stage_bytes', 'Bytes written by a dump, restored or committed.'),
+        ('files', 'redumpster_stage_files', 'Files written by a dump, restored or committed.'),
+        ('child_cpu_seconds', 'redumpster_stage_child_cpu_seconds', 'CPU time of tools run by the stage.'),
+        ('child_max_rss_bytes', 'redumpster_stage_child_max_rss_bytes', 'Largest resident set of a tool run by the stage.'),
+        ('exit_status', 'redumpster_stage_exit_status', 'Exit status of the tool that failed the stage, 0 on success, -1 for other errors.'),
+        ('success', 'redumpster_stage_success', '1 if the stage succeeded.'),
+    )
+    
+    def __init__(self):
+        self.stages = []
+        self.started = time.time()
+        self._lock = threading.Lock()
+    
+    @contextmanager
+    def measure(self, backup_name, stage, directory=None, interface=None):
+        entry = dict(backup_name=backup_name, stage=stage, interface=interface, started=time.time())
+        usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        start = time.perf_counter()
+        try:
+            yield entry
+            entry.update(success=1, exit_status=0)
+        except BaseException as error:
+            # sh reports failed tools with their exit code
+            entry.update(success=0, exit_status=getattr(error, 'exit_code', -1), error=repr(error))
+            raise
+        finally:
+            entry['seconds'] = time.perf_counter() - start
+            usage_after = resource.getrusage(resource.RUSAGE_CHILDREN)
+            entry['child_cpu_seconds'] = (usage_after.ru_utime - usage.ru_utime) + (usage_after.ru_stime - usage.ru_stime)
+            entry['child_max_rss_bytes'] = usage_after.ru_maxrss * 1024 if usage_after.ru_maxrss > usage.ru_maxrss else None
+            entry['bytes'], entry['files'] = _tree_size(directory)
+            with self._lock:
+                self.stages.append(entry)
+    
+    def summary(self):
+        with self._lock:
+            stages = sorted(self.stages, key=lambda entry: entry['started'])
+        return dict(
+            started=self.started, seconds=time.time() - self.started,
+            failed=sum(1 for entry in stages if not entry['success']),
+            stages=stages,
+        )
+    
+    def write_json(self, path):
+        with open(path, 'w') as output:
+            json.dump(self.summary(), output, indent=2, sort_keys=True)
+            output.write('\n')
+    
+    def prometheus_text(self):
+        summary = self.summary()
+        lines = []
+        for key, name, description in self.PROMETHEUS_METRICS:
+            lines += ['# HELP %s %s' % (name, description), '# TYPE %s gauge' % name]
+            for entry in summary['stages']:
+                if entry[key] is None:
+                    continue
+                labels = ','.join('%s="%s"' % (label, _escape_label(entry[label]))
+                    for label in ('backup_name', 'interface', 'stage') if entry[label] is not None)
+                lines.append('%s{%s} %s' % (name, labels, entry[key]))
+        lines += [
+            '# HELP redumpster_run_timestamp_seconds When the run finished.',
+            '# TYPE redumpster_run_timestamp_seconds gauge',
+            'redumpster_run_timestamp_seconds %s' % (summary['started'] + summary['seconds']),
+        ]
+        return '\n'.join(lines) + '\n'
+    
+    def write_prometheus_textfile(self, path):
+        # node-exporter may read the file at any time, so it must never see half of it
+        with open(path + '.partial', 'w') as output:
+            output.write(self.prometheus_text())
+        os.rename(path + '.partial', path)
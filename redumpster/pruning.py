@@ -0,0 +1,252 @@
+"""
+Removes old dumps from a container, keeping the latest of some days, weeks and months.
+
+Backups are grouped into series by interface and backup name, and ordered by the
+timestamp in their name. As with attic prune, each rule keeps the latest backup of each
+of the last N days, weeks or months that have a backup. The rules apply one after the
+other, and a backup kept by one rule doesn't count for the next. Names that don't parse
+are never pruned.
+
+Dumps that are hard linked against each other (CopyDirectory) only free the files no
+kept dump links to, and the reclaimable bytes count exactly these. Removing a tree with
+millions of links is bound by the latency of each unlink, not by the disk, so files are
+unlinked from a pool of threads. A pruned dump is renamed first, so it never looks like
+a complete backup while it is removed, and the next prune finishes an interrupted one.
+
+Attic repositories are pruned with one attic prune per series. attic decides by the
+time an archive was created rather than the name, which only differs for dumps
+committed across midnight.
+"""
+
+from collections import defaultdict, namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from datetime import datetime
+from logging import getLogger
+from os.path import join, isdir
+import os
+import sh
+
+from .archivers import SESSION_ARCHIVE_PREFIX
+from .catalog import parse_backup_name, TIMESTAMP_FORMAT
+from .restorers import RestoreFromAttic
+from .utils import looks_like_attic_directory, run_in_parallel
+
+PRUNING_PREFIX = '.prune-'
+DEFAULT_JOBS = 16
+# files per task of the unlink pool
+UNLINK_BATCH_SIZE = 1000
+# (rule, strftime format of its period), in the order the rules apply
+PERIODS = (('daily', '%Y-%m-%d'), ('weekly', '%G-%V'), ('monthly', '%Y-%m'))
+
+class UnsupportedContainerError(Exception):
+    pass
+
+
+class RetentionPolicy(namedtuple('RetentionPolicy', 'daily weekly monthly')):
+    __slots__ = ()
+    
+    def __new__(cls, daily=0, weekly=0, monthly=0):
+        policy = super().__new__(cls, int(daily or 0), int(weekly or 0), int(monthly or 0))
+        assert min(policy) >= 0, "Retention counts can't be negative"
+        assert any(policy), "A retention policy has to keep something, set keep daily, weekly or monthly"
+        return policy
+    
+    def keep(self, backups):
+        # the names to keep of one series of (timestamp, name) pairs
+        newest_first = sorted(backups, reverse=True)
+        kept = set()
+        for count, (_, period_format) in zip(self, PERIODS):
+            last_period, kept_by_rule = None, 0
+            for timestamp, name in newest_first:
+                if kept_by_rule >= count:
+                    break
+                period = timestamp.strftime(period_format)
+                if period == last_period:
+                    continue
+                last_period = period
+                if name not in kept:
+                    kept.add(name)
+                    kept_by_rule += 1
+        return kept
+
+
+PruneResult = namedtuple('PruneResult', 'kept pruned reclaimable_bytes')
+
+def parse_series(name):
+    # (series, timestamp), or None for names that are never pruned
+    if name.startswith(SESSION_ARCHIVE_PREFIX):
+        series, timestamp = SESSION_ARCHIVE_PREFIX, name[len(SESSION_ARCHIVE_PREFIX):]
+    else:
+        match = parse_backup_name(name)
+        if match is None or match.end() != len(name):
+            return None
+        series, timestamp = '%s-%s-' % match.group(1, 2), match.group(3)
+    try:
+        return series, datetime.strptime(timestamp, TIMESTAMP_FORMAT)
+    except ValueError:
+        return None
+
+def plan(names, policy):
+    # {series: (kept, pruned)}, and the names that aren't backups
+    series = defaultdict(list)
+    others = []
+    for name in names:
+        parsed = parse_series(name)
+        if parsed is None:
+            others.append(name)
+        else:
+            series[parsed[0]].append((parsed[1], name))
+    
+    plans = dict()
+    for prefix, backups in series.items():
+        kept = policy.keep(backups)
+        names = sorted(name for _, name in backups)
+        plans[prefix] = ([name for name in names if name in kept], [name for name in names if name not in kept])
+    return plans, sorted(others)
+
+def format_report(result, dry_run=False):
+    lines = ['%s %s' % ('would prune' if dry_run else 'pruned', name) for name in result.pruned]
+    if result.reclaimable_bytes is None:
+        size = 'an unknown number of bytes (attic shares chunks between archives)'
+    else:
+        size = '%d bytes (%.1f GiB)' % (result.reclaimable_bytes, result.reclaimable_bytes / (1 << 30))
+    lines.append('%s %d of %d backups, %s %s' % ('Would prune' if dry_run else 'Pruned', len(result.pruned),
+        len(result.pruned) + len(result.kept), 'reclaimable:' if dry_run else 'reclaimed:', size))
+    return lines
+
+def _scan_directory(path):
+    files, directories = [], []
+    with os.scandir(path) as iterator:
+        for entry in iterator:
+            if entry.is_dir(follow_symlinks=False):
+                directories.append(entry.path)
+            else:
+                files.append((entry.path, entry.stat(follow_symlinks=False)))
+    return files, directories
+
+def _unlink_all(paths):
+    for path in paths:
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+def _batches(items, size):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+class DirectoryPruner(object):
+    # Prunes a container holding one directory per backup, as made by dump --to and
+    # the directory archiver.
+    
+    def __init__(self, directory, policy, jobs=DEFAULT_JOBS, catalog=None):
+        self.log = getLogger(__name__)
+        self.directory = directory
+        self.policy = policy
+        self.jobs = max(1, int(jobs))
+        self.catalog = catalog
+    
+    def _scan(self, roots):
+        # All files and directories below roots, listed by a pool of threads. Returns the
+        # files, the directories as (depth, path) and the bytes unlinking the files frees.
+        files, directories = [], []
+        links = dict()
+        with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+            pending = dict((pool.submit(_scan_directory, root), (0, root)) for root in roots)
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    depth, path = pending.pop(future)
+                    found_files, found_directories = future.result()
+                    directories.append((depth, path))
+                    for file_path, status in found_files:
+                        files.append(file_path)
+                        inode = (status.st_dev, status.st_ino)
+                        seen, nlink, blocks = links.get(inode, (0, status.st_nlink, status.st_blocks))
+                        links[inode] = (seen + 1, nlink, blocks)
+                    for directory in found_directories:
+                        pending[pool.submit(_scan_directory, directory)] = (depth + 1, directory)
+        # an inode is only freed once all its links are gone
+        reclaimable = sum(blocks * 512 for seen, nlink, blocks in links.values() if seen >= nlink)
+        reclaimable += sum(os.lstat(path).st_blocks * 512 for _, path in directories)
+        return files, directories, reclaimable
+    
+    def _remove(self, files, directories):
+        run_in_parallel(_unlink_all, list(_batches(files, UNLINK_BATCH_SIZE)), self.jobs)
+        # deepest first, the directories of one depth at once
+        by_depth = defaultdict(list)
+        for depth, path in directories:
+            by_depth[depth].append(path)
+        for depth in sorted(by_depth, reverse=True):
+            run_in_parallel(os.rmdir, by_depth[depth], self.jobs)
+    
+    def prune(self, dry_run=False):
+        names = [name for name in os.listdir(self.directory) if isdir(join(self.directory, name))]
+        interrupted = [name for name in names if name.startswith(PRUNING_PREFIX)]
+        plans, others = plan([name for name in names if name not in interrupted], self.policy)
+        kept = sorted(others + [name for kept, _ in plans.values() for name in kept])
+        pruned = sorted(name for _, pruned in plans.values() for name in pruned)
+        
+        roots = [join(self.directory, name) for name in interrupted]
+        for name in pruned:
+            path = join(self.directory, name)
+            if not dry_run:
+                hidden = join(self.directory, PRUNING_PREFIX + name)
+                os.rename(path, hidden)
+                path = hidden
+            roots.append(path)
+        
+        files, directories, reclaimable = self._scan(roots)
+        if not dry_run:
+            self.log.info("Removing %d files of %s.", len(files), ', '.join(pruned + interrupted))
+            self._remove(files, directories)
+            if self.catalog is not None:
+                for name in pruned:
+                    self.catalog.forget(self.directory, name)
+        return PruneResult(kept, pruned, reclaimable)
+
+
+class AtticPruner(object):
+    # Prunes an attic repository. Each series whose prefix no other archive shares is
+    # pruned by attic prune, with one lock and one cache sync for all its archives.
+    # Series such as db-main- next to db-main-replica- fall back to attic delete.
+    
+    def __init__(self, directory, policy, sh=sh):
+        self.log = getLogger(__name__)
+        self.directory = os.path.abspath(directory)
+        self.policy = policy
+        self.sh = sh
+    
+    def _rule_arguments(self):
+        return ['--keep-%s=%d' % (rule, count) for (rule, _), count in zip(PERIODS, self.policy) if count]
+    
+    def prune(self, dry_run=False):
+        archives = RestoreFromAttic._archives(self.directory, sh=self.sh)
+        plans, others = plan(archives, self.policy)
+        kept = sorted(others + [name for kept, _ in plans.values() for name in kept])
+        pruned = sorted(name for _, pruned in plans.values() for name in pruned)
+        if dry_run:
+            return PruneResult(kept, pruned, None)
+        
+        for prefix, (_, series_pruned) in sorted(plans.items()):
+            if not series_pruned:
+                continue
+            shared = [name for name in archives if name.startswith(prefix)
+                and (parse_series(name) or (None,))[0] != prefix]
+            if not shared:
+                self.sh.attic('prune', self.directory, '--prefix=%s' % prefix, *self._rule_arguments())
+            else:
+                self.log.info("Another series shares the prefix %s, deleting its archives one by one.", prefix)
+                for name in series_pruned:
+                    self.sh.attic('delete', "{0}::{1}".format(self.directory, name))
+        return PruneResult(kept, pruned, None)
+
+
+def pruner_for(directory, policy, jobs=DEFAULT_JOBS, sh=sh, catalog=None):
+    if looks_like_attic_directory(directory):
+        return AtticPruner(directory, policy, sh=sh)
+    if isdir(join(directory, 'manifests')) and isdir(join(directory, 'chunks')):
+        # chunks are shared between manifests and would need a garbage collection
+        raise UnsupportedContainerError("Can't prune chunk store %s yet" % directory)
+    return DirectoryPruner(directory, policy, jobs=jobs, catalog=catalog)
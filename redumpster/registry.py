@@ -0,0 +1,71 @@
+from collections.abc import Mapping
+from importlib import import_module
+import threading
+
+ENTRY_POINT_GROUP = 'redumpster.data_interfaces'
+
+# Also registered as entry points in setup.py. Listed here as well so looking them up
+# doesn't have to scan the installed packages, and works from a source checkout.
+BUILTIN_DATA_INTERFACES = dict(
+    noop='redumpster.data_interfaces:NoOp',
+    mysql='redumpster.sql_dumps:MySQLDump',
+    postgres='redumpster.sql_dumps:PostgreSQLDump',
+    copydir='redumpster.copy_directory:CopyDirectory',
+)
+
+def load_object(specification):
+    module_name, _, attribute = specification.partition(':')
+    target = import_module(module_name)
+    for name in attribute.split('.'):
+        target = getattr(target, name)
+    return target
+
+
+class DataInterfaceRegistry(Mapping):
+    # Maps interface names to their classes, importing each class the first time it is
+    # looked up. Other packages add interfaces with an entry point in the group
+    # redumpster.data_interfaces, for example:
+    #
+    #     entry_points={'redumpster.data_interfaces': ['redis = redumpster_redis:RedisDump']}
+    
+    def __init__(self, builtins=BUILTIN_DATA_INTERFACES, group=ENTRY_POINT_GROUP):
+        self.builtins = dict(builtins)
+        self.group = group
+        self._loaded = dict()
+        self._entry_points = None
+        self._lock = threading.Lock()
+    
+    def _plugins(self):
+        # importlib.metadata takes as long to import as everything else together
+        if self._entry_points is None:
+            from importlib.metadata import entry_points
+            self._entry_points = dict((entry_point.name, entry_point.value)
+                for entry_point in entry_points(group=self.group))
+        return self._entry_points
+    
+    def _specification(self, name):
+        if name in self.builtins:
+            return self.builtins[name]
+        return self._plugins().get(name)
+    
+    def __getitem__(self, name):
+        with self._lock:
+            if name not in self._loaded:
+                specification = self._specification(name)
+                if specification is None:
+                    raise KeyError(name)
+                self._loaded[name] = load_object(specification)
+            return self._loaded[name]
+    
+    def __contains__(self, name):
+        return name in self._loaded or self._specification(name) is not None
+    
+    def __iter__(self):
+        return iter(sorted(set(self.builtins) | set(self._plugins())))
+    
+    def __len__(self):
+        return len(set(self.builtins) | set(self._plugins()))
+    
+    def register(self, name, data_interface):
+        with self._lock:
+            self._loaded[name] = data_interface
@@ -1,3 +1,4 @@
+import json
 import os
 from os.path import join, exists
 import re
@@ -6,23 +7,34 @@ import shutil
 import tempfile
 from logging import getLogger
 
+from .archivers import SESSION_ARCHIVE_PREFIX, SESSION_INDEX_FILE
+from .catalog import parse_backup_name
+from .chunking import ChunkStore, restore_manifest
 from .data_interfaces import DataInterface
-from .utils import change_working_directory_to, looks_like_attic_directory
+from .manifest import has_manifest, read_manifest, read_json_lines
+from .utils import change_working_directory_to, looks_like_attic_directory, same_file_system, clone_file, \
+    wait_for_mount
 
 class UnknownBackupError(Exception):
     pass
 
+class AtticMountError(Exception):
+    pass
+
 class RestoreFromDirectory(object):
     log = getLogger(__name__)
+    STAGING_STRATEGIES = ('auto', 'inplace', 'hardlink', 'reflink', 'copy')
     
-    def __init__(self, backup_directory, backup_name, sh=sh):
+    def __init__(self, backup_directory, backup_name, sh=sh, staging='auto'):
+        assert staging in self.STAGING_STRATEGIES, "Unknown staging strategy %r" % staging
         self.backup_directory = backup_directory
         self.backup_name = backup_name
+        self.staging = staging
         self.temporary_directory = tempfile.TemporaryDirectory()
         interface_directory = join(self.temporary_directory.name, 'restore_from')
         self.data_interface = self._make_data_interface(interface_directory)
         self.sh = sh
-        
+    
     @classmethod
     def _backups_in_directory(cls, backup_directory):
         if looks_like_attic_directory(backup_directory):
@@ -30,7 +42,30 @@ class RestoreFromDirectory(object):
         return os.listdir(backup_directory)
     
     @classmethod
-    def available_backups(cls, backup_directory, filter_prefix, dirlist=None):
+    def _backup_size(cls, backup_directory, backup_name):
+        directory = join(backup_directory, backup_name)
+        if not has_manifest(directory):
+            return None
+        return sum(entry['size'] for entry in read_manifest(directory))
+    
+    @classmethod
+    def _catalog_watched_path(cls, backup_directory):
+        return backup_directory
+    
+    @classmethod
+    def refresh_catalog(cls, catalog, backup_directory):
+        catalog.refresh(backup_directory, lambda: cls._backups_in_directory(backup_directory),
+            watched=cls._catalog_watched_path(backup_directory),
+            size_of=lambda name: cls._backup_size(backup_directory, name))
+    
+    @classmethod
+    def available_backups(cls, backup_directory, filter_prefix, dirlist=None, catalog=None):
+        if catalog is not None and dirlist is None:
+            cls.refresh_catalog(catalog, backup_directory)
+            available_backups = catalog.backup_names(backup_directory, filter_prefix)
+            cls.log.debug("Found available backups in catalog: %s", available_backups)
+            return available_backups
+        
         if dirlist is None or backup_directory is not None:
             dirlist = cls._backups_in_directory(backup_directory)
         
@@ -43,8 +78,7 @@ class RestoreFromDirectory(object):
     
     @classmethod
     def _parse_backup_name(cls, backup_name):
-        parser = re.compile('([a-zA-Z0-9]+)-([a-zA-Z0-9-]*)-(\d{4}-\d{2}-\d{2}_\d{2}-\d{2}-\d{2})')
-        return parser.match(backup_name)
+        return parse_backup_name(backup_name)
     
     @classmethod
     def _is_valid_backup_name(cls, backup_name):
@@ -69,6 +103,22 @@ class RestoreFromDirectory(object):
         backup_names = sorted(backup_names, reverse=True)
         return backup_names[0]
     
+    @classmethod
+    def best_backup(cls, backup_directory, filter_prefix, catalog=None):
+        if catalog is None:
+            return cls.best_backup_from_set(cls.available_backups(backup_directory, filter_prefix))
+        
+        # same rules as best_backup_from_set, but answered from the catalog's index
+        cls.refresh_catalog(catalog, backup_directory)
+        prefixes = catalog.prefixes(backup_directory, filter_prefix)
+        if len(prefixes) == 0:
+            raise UnknownBackupError("Did not find backup to determine best from.")
+        if (None, None) in prefixes:
+            raise UnknownBackupError("Invalid backup name with prefix %s" % filter_prefix)
+        if len(prefixes) > 1:
+            raise UnknownBackupError("Ambigous backup names, not all match prefix %s-%s" % prefixes[0])
+        return catalog.latest_backup(backup_directory, filter_prefix)
+    
     @classmethod
     def parse_restore_options(cls, options):
         parsed = dict()
@@ -79,15 +129,35 @@ class RestoreFromDirectory(object):
             parsed[split[0]] = split[1]
         return parsed
     
-    def _make_data_interface(self, temporary_directory):
+    def _make_data_interface(self, directory):
         assert self._is_valid_backup_name(self.backup_name)
         interface, name, timestamp = self._parse_backup_name(self.backup_name).groups()
-        return DataInterface.make_data_interface(interface, dict(), timestamp, temporary_directory)
+        container_directory, interface_directory = os.path.split(directory)
+        return DataInterface.make_data_interface(container_directory, interface, interface_directory, dict())
+    
+    def _staging_strategy(self):
+        # cheapest first: no copy at all, shared inodes, shared blocks, a real copy
+        if self.staging != 'auto':
+            return self.staging
+        if self.data_interface.RESTORE_READS_ONLY:
+            return 'inplace'
+        # a restore that writes to its files must not write through to the backup, so
+        # never share inodes with it. Blocks can only be shared on the same file system.
+        if same_file_system(self.backup_directory, self.temporary_directory.name):
+            return 'reflink'
+        return 'copy'
     
     def _restore_backup_to_tempdir(self):
         source = join(self.backup_directory, self.backup_name)
-        destination = self.data_interface.directory
-        shutil.copytree(source, destination)
+        strategy = self._staging_strategy()
+        self.log.info("Staging backup %s for restore using strategy %s.", source, strategy)
+        
+        if strategy == 'inplace':
+            self.data_interface = self._make_data_interface(os.path.abspath(source))
+            return
+        
+        copy_function = dict(hardlink=os.link, reflink=clone_file, copy=shutil.copy2)[strategy]
+        shutil.copytree(source, self.data_interface.directory, symlinks=True, copy_function=copy_function)
     
     def restore(self, override_options=dict()):
         self.log.info("Restoring backup at %s tagged %s.", self.backup_directory, self.backup_name)
@@ -99,15 +169,51 @@ class RestoreFromDirectory(object):
         pass
 
 class RestoreFromAttic(RestoreFromDirectory):
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, mount_timeout=60, **kwargs):
         super().__init__(*args, **kwargs)
+        self.mount_timeout = mount_timeout
         self.mounts = []
     
     @classmethod
-    def _backups_in_directory(cls, backup_directory, sh=sh):
+    def _archives(cls, backup_directory, sh=sh):
         archives = str(sh.attic('list', backup_directory))
-        archives = sorted(re.findall('^([^\s]+)', archives, re.MULTILINE))
-        return archives
+        return sorted(re.findall('^([^\s]+)', archives, re.MULTILINE))
+    
+    @classmethod
+    def _session_members(cls, backup_directory, session, sh=sh):
+        # only the index is extracted, not the dumps
+        with tempfile.TemporaryDirectory() as directory, change_working_directory_to(directory):
+            sh.attic('extract', "{0}::{1}".format(os.path.abspath(backup_directory), session), SESSION_INDEX_FILE)
+            with open(SESSION_INDEX_FILE) as index:
+                return json.load(index)
+    
+    @classmethod
+    def _backups_in_directory(cls, backup_directory, sh=sh):
+        backups = []
+        for archive in cls._archives(backup_directory, sh=sh):
+            if archive.startswith(SESSION_ARCHIVE_PREFIX):
+                backups.extend(cls._session_members(backup_directory, archive, sh=sh))
+            else:
+                backups.append(archive)
+        return sorted(backups)
+    
+    def _locate(self):
+        # (archive, None) for a backup in its own archive, (session, backup name) for one
+        # committed in a session
+        archives = self._archives(self.backup_directory, sh=self.sh)
+        sessions = [archive for archive in archives if archive.startswith(SESSION_ARCHIVE_PREFIX)]
+        if self.backup_name in archives or not sessions:
+            return self.backup_name, None
+        for session in sorted(sessions, reverse=True):
+            if self.backup_name in self._session_members(self.backup_directory, session, sh=self.sh):
+                return session, self.backup_name
+        raise UnknownBackupError("Backup %s is neither an archive nor in a session" % self.backup_name)
+    
+    @classmethod
+    def _backup_size(cls, backup_directory, backup_name):
+        # Asking attic would cost as much as listing. The repository directory itself
+        # is a fine thing to watch though, attic replaces its index file on every change.
+        return None
     
     def _should_mount(self):
         try:
@@ -118,34 +224,73 @@ class RestoreFromAttic(RestoreFromDirectory):
     
     def _wait_until_mounted(self, directory):
         dump_exists = lambda: exists(join(directory, 'dump.conf'))
-        import time
-        wait_iterations = 20
-        while not dump_exists() and wait_iterations >= 0:
-            time.sleep(0.3)
-            wait_iterations -= 1
-        assert dump_exists()
+        if not wait_for_mount(dump_exists, self.mount_timeout):
+            raise AtticMountError("Backup %s was not mounted at %s within %ss" % (
+                self.backup_name, directory, self.mount_timeout))
+    
+    def _extract(self, source, destination, *paths):
+        with change_working_directory_to(destination):
+            self.sh.attic('extract', source, *paths)
+    
+    def _extract_for_restore(self, source, destination, member=None):
+        # dump.conf tells the data interface what it needs, e.g. which databases were dumped
+        in_member = lambda path: join(member, path) if member is not None else path
+        self._extract(source, destination, in_member('dump.conf'))
+        paths = self.data_interface.restore_paths()
+        if paths is None:
+            self.log.info("Extracting full backup to restore. Consider installing llfuse to improve performance.")
+            self._extract(source, destination, *[member] if member is not None else [])
+        elif paths:
+            self.log.info("Extracting %s from backup to restore.", ', '.join(paths))
+            self._extract(source, destination, *map(in_member, paths))
     
     def _restore_backup_to_tempdir(self, should_mount=None):
         if should_mount is None:
             should_mount = self._should_mount()
         
         backup_directory = os.path.abspath(self.backup_directory)
-        source = "{0}::{1}".format(backup_directory, self.backup_name)
+        archive, member = self._locate()
+        source = "{0}::{1}".format(backup_directory, archive)
         destination = self.data_interface.directory
         
         os.mkdir(destination)
+        if member is not None:
+            # the session holds the backup below its name
+            self.data_interface = self._make_data_interface(join(destination, member))
         if should_mount:
             # Unless we background this command, it will be killed in a weird way by sh
             # and then it's not mounted. Go figure...
             command = self.sh.attic('mount', source, destination, _bg=True)
             self.mounts.append(destination)
-            self._wait_until_mounted(destination)
+            self._wait_until_mounted(self.data_interface.directory)
             command.wait()
         else:
-            self.log.info("Extracting full backup to restore. Consider installing llfuse to improve performance.")
-            with change_working_directory_to(destination):
-                self.sh.attic('extract', source)
+            self._extract_for_restore(source, destination, member)
     
     def cleanup(self):
         for mount in self.mounts:
             self.sh.fusermount('-u', mount)
+
+
+class RestoreFromChunkStore(RestoreFromDirectory):
+    MANIFEST_DIRECTORY = 'manifests'
+    
+    @classmethod
+    def _backups_in_directory(cls, backup_directory):
+        return [name for name in os.listdir(join(backup_directory, cls.MANIFEST_DIRECTORY))
+            if not name.endswith('.partial')]
+    
+    @classmethod
+    def _catalog_watched_path(cls, backup_directory):
+        return join(backup_directory, cls.MANIFEST_DIRECTORY)
+    
+    @classmethod
+    def _backup_size(cls, backup_directory, backup_name):
+        manifest = join(backup_directory, cls.MANIFEST_DIRECTORY, backup_name)
+        return sum(entry.get('size', 0) for entry in read_json_lines(manifest))
+    
+    def _restore_backup_to_tempdir(self):
+        manifest = join(self.backup_directory, self.MANIFEST_DIRECTORY, self.backup_name)
+        destination = self.data_interface.directory
+        os.mkdir(destination)
+        restore_manifest(manifest, ChunkStore(self.backup_directory), destination)
@@ -0,0 +1,59 @@
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from logging import getLogger
+
+
+class Scheduler(object):
+    """Runs an action on many data interfaces using a pool of worker threads.
+    
+    Interfaces that report the same concurrency group (e.g. the same database host)
+    are limited to `group_limit` concurrent runs. Failures are collected per
+    interface, all other interfaces still run."""
+    
+    def __init__(self, jobs=1, group_limit=0):
+        self.log = getLogger(__name__)
+        assert int(jobs) > 0, "Need at least one job, got %r" % jobs
+        self.jobs = int(jobs)
+        self.group_limit = int(group_limit)
+    
+    def _limit_for(self, interface):
+        limit = interface.concurrency_limit()
+        if limit is None:
+            limit = self.group_limit
+        return int(limit)
+    
+    def _startable(self, pending, running):
+        running_groups = Counter(interface.concurrency_group() for interface in running.values())
+        startable = []
+        for interface in pending:
+            if len(running) + len(startable) >= self.jobs:
+                break
+            group = interface.concurrency_group()
+            limit = self._limit_for(interface)
+            if group is not None and limit > 0 and running_groups[group] >= limit:
+                continue
+            running_groups[group] += 1
+            startable.append(interface)
+        return startable
+    
+    def run(self, interfaces, action, action_name='process'):
+        pending = list(interfaces)
+        running = dict()
+        failures = OrderedDict()
+        
+        with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            while pending or running:
+                for interface in self._startable(pending, running):
+                    pending.remove(interface)
+                    self.log.info("Starting to %s %s.", action_name, interface.backup_name)
+                    running[executor.submit(action, interface)] = interface
+                
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    interface = running.pop(future)
+                    exception = future.exception()
+                    if exception is not None:
+                        self.log.error("Failed to %s %s: %s", action_name, interface.backup_name, exception,
+                            exc_info=exception)
+                        failures[interface.backup_name] = exception
+        return failures
@@ -0,0 +1,93 @@
+"""
+Splits a tree into shards of about equal size, so several rsyncs can copy it at once.
+
+The shards list top level entries, or deeper subtrees where a single entry would
+outweigh a whole shard. Each rsync gets its shard with --files-from. Deletions can't
+be sharded (a deleted entry is in no shard), so a last rsync only deletes.
+"""
+
+from os.path import join
+import heapq
+import os
+import re
+import tempfile
+
+SHARD_BY = ('size', 'top')
+# how deep a large directory is split into its children, deeper trees stay one unit
+MAX_SPLIT_DEPTH = 3
+STATISTIC = re.compile(r'^([A-Z][^:]*):\s+([\d,.]+)', re.MULTILINE)
+
+def _scan(root, relative_path, depth, children):
+    # size of the subtree, records the entries of directories up to MAX_SPLIT_DEPTH
+    size = 0
+    entries = []
+    with os.scandir(join(root, relative_path)) as iterator:
+        for entry in iterator:
+            path = join(relative_path, entry.name) if relative_path else entry.name
+            if entry.is_dir(follow_symlinks=False):
+                entry_size = _scan(root, path, depth + 1, children)
+                entries.append((path, entry_size, True))
+            else:
+                entry_size = entry.stat(follow_symlinks=False).st_size
+                entries.append((path, entry_size, False))
+            size += entry_size
+    if depth < MAX_SPLIT_DEPTH:
+        children[relative_path] = entries
+    return size
+
+def _top_level(root, exclude):
+    return sorted(name for name in os.listdir(root) if name not in exclude)
+
+def partition_tree(root, shards, by='size', exclude=()):
+    # Lists of paths relative to root, at most shards of them. exclude are top level
+    # names to leave out.
+    assert by in SHARD_BY, "Unknown shard_by %r, expected one of %s" % (by, ', '.join(SHARD_BY))
+    shards = max(1, int(shards))
+    if by == 'top':
+        names = _top_level(root, exclude)
+        return [names[index::shards] for index in range(min(shards, len(names)))]
+    
+    children = dict()
+    _scan(root, '', 0, children)
+    units = [unit for unit in children[''] if unit[0] not in exclude]
+    target = sum(size for _, size, _ in units) / shards
+    while True:
+        # split the largest directory while it is larger than a shard should be
+        splittable = [unit for unit in units if unit[2] and unit[0] in children and children[unit[0]]]
+        largest = max(splittable, key=lambda unit: unit[1], default=None)
+        if largest is None or largest[1] <= target:
+            break
+        units.remove(largest)
+        units.extend(children[largest[0]])
+    
+    # largest units first, each into the emptiest shard
+    bins = [(0, index, []) for index in range(min(shards, len(units)))]
+    for path, size, _ in sorted(units, key=lambda unit: (-unit[1], unit[0])):
+        total, index, paths = heapq.heappop(bins)
+        paths.append(path)
+        heapq.heappush(bins, (total + size, index, paths))
+    return [sorted(paths) for _, _, paths in sorted(bins, key=lambda each: each[1])]
+
+def write_file_list(directory, paths):
+    # NUL separated, for --files-from with --from0
+    descriptor, path = tempfile.mkstemp(dir=directory, prefix='shard-', suffix='.list')
+    with os.fdopen(descriptor, 'wb') as file_list:
+        for each in paths:
+            file_list.write(os.fsencode(each) + b'\0')
+    return path
+
+def parse_rsync_stats(output):
+    # the numbers of rsync --stats, e.g. {'number_of_regular_files_transferred': 23}
+    stats = dict()
+    for name, value in STATISTIC.findall(str(output)):
+        key = re.sub(r'\W+', '_', name.strip().lower()).strip('_')
+        number = float(value.replace(',', ''))
+        stats[key] = int(number) if number.is_integer() else number
+    return stats
+
+def merge_stats(all_stats):
+    merged = dict()
+    for stats in all_stats:
+        for key, value in stats.items():
+            merged[key] = merged.get(key, 0) + value
+    return merged
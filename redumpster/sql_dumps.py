@@ -0,0 +1,269 @@
+from configobj import ConfigObj
+import os
+from os.path import join, basename, isfile
+from fnmatch import fnmatch
+from .compression import codec_named
+from .data_interfaces import DataInterface
+from .utils import as_list, run_in_parallel
+
+class SQLDump(DataInterface):
+    DUMP_FILE = 'dump.sql'
+    DATABASES_DIRECTORY = 'databases'
+    SYSTEM_DATABASES = ()
+    
+    def default_options(self):
+        return dict(
+            super().default_options(),
+            dump_command_prefix='',
+            compression='none', compression_level='', compression_threads='',
+            include_databases='', exclude_databases='', parallel_databases=1,
+        )
+    
+    def _selected_databases(self, databases):
+        options = self.config['options']
+        include = as_list(options['include_databases']) or ['*']
+        exclude = list(self.SYSTEM_DATABASES) + as_list(options['exclude_databases'])
+        matches = lambda database, patterns: any(fnmatch(database, pattern) for pattern in patterns)
+        return [database for database in databases
+            if matches(database, include) and not matches(database, exclude)]
+    
+    def _parallel_databases(self):
+        return self.config['options'].as_int('parallel_databases')
+    
+    def _dump_sh(self):
+        policy = self.resource_policy()
+        if self.config['options']['dump_command_prefix']:
+            # ionice and nice go after the prefix, they are meant for the tools on the database host
+            dump_command_prefix = self.config['options']['dump_command_prefix'].split() + policy.command_prefix()
+            return self.sh.Command(dump_command_prefix[0]).bake(*dump_command_prefix[1:])
+        return policy.wrap(self.sh)
+    
+    def _dump_codec(self):
+        return codec_named(self.config['options']['compression'])
+    
+    def _recorded_config(self):
+        # restore with whatever the dump was written with, even if the config changed since
+        dump_config = join(self.directory, 'dump.conf')
+        if isfile(dump_config):
+            return ConfigObj(dump_config)
+        return self.config
+    
+    def _recorded_codec(self):
+        return codec_named(self._recorded_config().get('options', dict()).get('compression'))
+    
+    def _recorded_databases(self):
+        # None for dumps of all databases into a single file
+        recorded = self._recorded_config()
+        if 'databases' not in recorded:
+            return None
+        return as_list(recorded['databases'])
+    
+    def _dumpfile(self, codec, name=None):
+        name = name or self.DUMP_FILE
+        if codec is not None:
+            name += codec.extension
+        return join(self.directory, name)
+    
+    def _database_dumpfile(self, codec, database):
+        return self._dumpfile(codec, join(self.DATABASES_DIRECTORY, database + '.sql'))
+    
+    def restore_paths(self):
+        if self._recorded_databases() is None:
+            return [basename(self._dumpfile(self._recorded_codec()))]
+        return [self.DATABASES_DIRECTORY]
+    
+    def _dump_to(self, dumpfile, command, *args, **kwargs):
+        codec = self._dump_codec()
+        out, out_options = self._open_dump_file(dumpfile)
+        with out:
+            if codec is None:
+                return command(*args, _out=out, **dict(kwargs, **out_options))
+            
+            options = self.config['options']
+            compress = getattr(self.resource_policy().wrap(self.sh), codec.command)
+            return compress(
+                *codec.compress_arguments(options['compression_level'], options['compression_threads']),
+                _in=command(*args, _piped=True, **kwargs),
+                _out=out, **out_options
+            )
+    
+    def _decompressed(self, codec, dumpfile):
+        decompress = getattr(self.sh, codec.command)
+        return decompress(*codec.decompress_arguments(dumpfile), _piped=True)
+
+class MySQLDump(SQLDump):
+    INTERFACE_NAME = 'mysql'
+    SYSTEM_DATABASES = ('information_schema', 'performance_schema', 'sys')
+    
+    def default_options(self):
+        return dict(
+            super().default_options(),
+            per_database=False,
+            mysql_user='root', mysql_password='',
+        )
+    
+    def options(self):
+        options = super().options()
+        if not options.get('password', None): # is this intentionally a test for falsyness? --mh
+            options = dict(options, password=False)
+        return options
+    
+    def _list_databases(self):
+        output = self._dump_sh().mysql(
+            batch=True, skip_column_names=True, execute="SHOW DATABASES",
+            **self.options()
+        )
+        return str(output).split()
+    
+    def dump(self):
+        super().dump()
+        if self.config['options'].as_bool('per_database'):
+            return self._dump_per_database()
+        
+        self._dump_to(
+            self._dumpfile(self._dump_codec()),
+            self._dump_sh().mysqldump,
+            "--all-databases", "--complete-insert",
+            **self.options()
+        )
+    
+    def _dump_per_database(self):
+        databases = self._selected_databases(self._list_databases())
+        codec = self._dump_codec()
+        os.makedirs(join(self.directory, self.DATABASES_DIRECTORY), exist_ok=True)
+        
+        def dump_database(database):
+            self.log.info("Dumping database %s of %s.", database, self.backup_name)
+            self._dump_to(
+                self._database_dumpfile(codec, database),
+                self._dump_sh().mysqldump,
+                "--complete-insert", "--databases", database,
+                **self.options()
+            )
+        run_in_parallel(dump_database, databases, self._parallel_databases())
+        self.config['databases'] = databases
+    
+    def _restore_dumpfile(self, codec, dumpfile):
+        if codec is None:
+            self.sh.mysql(
+                execute="source {0}".format(dumpfile),
+                **self.options()
+            )
+        else:
+            self.sh.mysql(_in=self._decompressed(codec, dumpfile), **self.options())
+    
+    def restore(self):
+        super().restore()
+        codec = self._recorded_codec()
+        databases = self._recorded_databases()
+        if databases is None:
+            return self._restore_dumpfile(codec, self._dumpfile(codec))
+        
+        def restore_database(database):
+            self.log.info("Restoring database %s of %s.", database, self.backup_name)
+            self._restore_dumpfile(codec, self._database_dumpfile(codec, database))
+        run_in_parallel(restore_database, databases, self._parallel_databases())
+
+
+class PostgreSQLDump(SQLDump):
+    INTERFACE_NAME = 'postgres'
+    GLOBALS_FILE = 'globals.sql'
+    
+    def default_options(self):
+        return dict(
+            super().default_options(),
+            username='root',
+            format='plain', jobs=1,
+        )
+    
+    def _is_directory_format(self, config):
+        return config.get('options', dict()).get('format', 'plain') == 'directory'
+    
+    def _list_databases(self):
+        output = self._dump_sh().psql(
+            'postgres',
+            tuples_only=True, no_align=True,
+            command="SELECT datname FROM pg_database WHERE datallowconn AND NOT datistemplate",
+            **self.options()
+        )
+        return str(output).split()
+    
+    def _database_directory(self, database):
+        return join(self.directory, self.DATABASES_DIRECTORY, database)
+    
+    def restore_paths(self):
+        if not self._is_directory_format(self._recorded_config()):
+            return super().restore_paths()
+        return [basename(self._dumpfile(self._recorded_codec(), self.GLOBALS_FILE)), self.DATABASES_DIRECTORY]
+    
+    def dump(self):
+        super().dump()
+        if self._is_directory_format(self.config):
+            return self._dump_directory_format()
+        
+        self._dump_to(
+            self._dumpfile(self._dump_codec()),
+            self._dump_sh().pg_dumpall,
+            clean=True,
+            **self.options()
+        )
+    
+    def _dump_directory_format(self):
+        assert not self.config['options']['dump_command_prefix'], \
+            "dump_command_prefix is not supported with format=directory, pg_dump writes the dump itself"
+        
+        throttled_sh = self.resource_policy().wrap(self.sh)
+        self._dump_to(
+            self._dumpfile(self._dump_codec(), self.GLOBALS_FILE),
+            throttled_sh.pg_dumpall,
+            globals_only=True, clean=True,
+            **self.options()
+        )
+        
+        databases = self._selected_databases(self._list_databases())
+        os.makedirs(join(self.directory, self.DATABASES_DIRECTORY), exist_ok=True)
+        jobs = self.config['options'].as_int('jobs')
+        
+        def dump_database(database):
+            self.log.info("Dumping database %s of %s.", database, self.backup_name)
+            throttled_sh.pg_dump(
+                database,
+                format='directory', jobs=jobs,
+                file=self._database_directory(database),
+                **self.options()
+            )
+            # pg_dump writes these files itself, so they have to be read back for hashing
+            self.manifest.add_tree(self._database_directory(database))
+        run_in_parallel(dump_database, databases, self._parallel_databases())
+        self.config['databases'] = databases
+    
+    def _restore_dumpfile(self, codec, dumpfile):
+        if codec is None:
+            self.sh.psql(
+                'postgres',
+                file=dumpfile,
+                **self.options()
+            )
+        else:
+            self.sh.psql('postgres', _in=self._decompressed(codec, dumpfile), **self.options())
+    
+    def restore(self):
+        super().restore()
+        codec = self._recorded_codec()
+        if not self._is_directory_format(self._recorded_config()):
+            return self._restore_dumpfile(codec, self._dumpfile(codec))
+        
+        self._restore_dumpfile(codec, self._dumpfile(codec, self.GLOBALS_FILE))
+        jobs = self.config['options'].as_int('jobs')
+        
+        def restore_database(database):
+            self.log.info("Restoring database %s of %s.", database, self.backup_name)
+            # --clean --create drops the restored database, which can't be the one pg_restore
+            # is connected to. template1 is never dumped, _list_databases skips templates.
+            self.sh.pg_restore(
+                self._database_directory(database),
+                create=True, clean=True, if_exists=True,
+                dbname='template1', jobs=jobs,
+                **self.options()
+            )
+        run_in_parallel(restore_database, self._recorded_databases(), self._parallel_databases())
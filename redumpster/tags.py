@@ -0,0 +1,138 @@
+"""
+Tag expressions select data interfaces by their tags, for example:
+
+    db
+    tenant-*
+    db and not staging
+    (mysql or postgres) and tenant-4*
+
+Tags are fnmatch patterns, `and` binds stronger than `or`, `not` stronger than both.
+An expression can't name a tag that is an operator or contains parentheses or
+whitespace, so the config rejects such tags.
+"""
+
+from fnmatch import fnmatchcase
+import re
+
+OPERATORS = ('and', 'or', 'not')
+TOKEN = re.compile(r'\s*(?:(\()|(\))|([^\s()]+))')
+GLOB_CHARACTERS = re.compile(r'[*?\[]')
+TAG = re.compile(r'[^\s()]+')
+
+class TagExpressionError(ValueError):
+    pass
+
+def is_selectable_tag(tag):
+    return TAG.fullmatch(tag) is not None and tag not in OPERATORS
+
+def _tokenize(expression):
+    tokens, position = [], 0
+    expression = expression.strip()
+    while position < len(expression):
+        match = TOKEN.match(expression, position)
+        if match is None:
+            raise TagExpressionError("Can't parse tag expression %r at %d" % (expression, position))
+        tokens.append(match.group(match.lastindex))
+        position = match.end()
+    return tokens
+
+def parse_tag_expression(expression):
+    # Returns a tree of tuples: ('tag', pattern), ('not', node), ('and', left, right), ('or', left, right)
+    tokens = _tokenize(expression)
+    if not tokens:
+        raise TagExpressionError("Empty tag expression")
+    position = 0
+    
+    def peek():
+        return tokens[position] if position < len(tokens) else None
+    
+    def take(expected=None):
+        nonlocal position
+        token = peek()
+        if token is None or (expected is not None and token != expected):
+            raise TagExpressionError("Expected %s in tag expression %r" % (expected or 'a tag', expression))
+        position += 1
+        return token
+    
+    def binary(operator, operand):
+        node = operand()
+        while peek() == operator:
+            take(operator)
+            node = (operator, node, operand())
+        return node
+    
+    def disjunction():
+        return binary('or', conjunction)
+    
+    def conjunction():
+        return binary('and', negation)
+    
+    def negation():
+        if peek() == 'not':
+            take('not')
+            return ('not', negation())
+        if peek() == '(':
+            take('(')
+            node = disjunction()
+            take(')')
+            return node
+        tag = take()
+        if tag in OPERATORS or tag == ')':
+            raise TagExpressionError("Expected a tag instead of %r in tag expression %r" % (tag, expression))
+        return ('tag', tag)
+    
+    node = disjunction()
+    if peek() is not None:
+        raise TagExpressionError("Unexpected %r in tag expression %r" % (peek(), expression))
+    return node
+
+def matches(node, tags):
+    # evaluates a parsed expression against the tags of a single interface
+    operator = node[0]
+    if operator == 'tag':
+        return any(fnmatchcase(tag, node[1]) for tag in tags)
+    if operator == 'not':
+        return not matches(node[1], tags)
+    if operator == 'and':
+        return matches(node[1], tags) and matches(node[2], tags)
+    return matches(node[1], tags) or matches(node[2], tags)
+
+
+class TagIndex(object):
+    # Maps each tag to the positions of the sections carrying it, so selecting sections
+    # costs a lookup per tag (or a scan of the distinct tags for patterns), not a scan of
+    # every section.
+    
+    def __init__(self, tags_per_section):
+        self.size = 0
+        self._positions = dict()
+        for position, tags in enumerate(tags_per_section):
+            for tag in tags:
+                self._positions.setdefault(tag, set()).add(position)
+            self.size = position + 1
+    
+    def tags(self):
+        return self._positions.keys()
+    
+    def _evaluate(self, node):
+        operator = node[0]
+        if operator == 'tag':
+            pattern = node[1]
+            if not GLOB_CHARACTERS.search(pattern):
+                return self._positions.get(pattern, set())
+            selected = set()
+            for tag in self._positions:
+                if fnmatchcase(tag, pattern):
+                    selected |= self._positions[tag]
+            return selected
+        if operator == 'not':
+            return set(range(self.size)) - self._evaluate(node[1])
+        if operator == 'and':
+            return self._evaluate(node[1]) & self._evaluate(node[2])
+        return self._evaluate(node[1]) | self._evaluate(node[2])
+    
+    def select(self, expression):
+        # positions of the sections matching expression, in config order
+        if not expression:
+            return range(self.size)
+        return sorted(self._evaluate(parse_tag_expression(expression)))
@@ -1,6 +1,7 @@
 from ..archivers import *
 from ..data_interfaces import NoOp
 from os.path import join, exists
+import json
 import os
 
 import glob
@@ -8,7 +9,14 @@ import glob
 from pyexpect import expect
 import unittest
 from testfixtures import tempdir
-from unittest.mock import Mock, MagicMock
+from unittest.mock import Mock, MagicMock, patch
+import datetime
+
+def frozen_time():
+    # dump names are taken from the clock
+    clock = MagicMock()
+    clock.datetime.now.return_value = datetime.datetime(2015, 1, 20, 16, 24, 29)
+    return patch('redumpster.data_interfaces.datetime', clock)
 
 """
 class ArchiverTest(unittest.TestCase):
@@ -55,7 +63,7 @@ class AtticArchiverTest(unittest.TestCase):
     @tempdir()
     def test_should_move_files_to_attic(self, tempdir):
         sh = MagicMock()
-
+        
         actual_data = join(tempdir.path, 'actual.dir')
         backup = join(tempdir.path, 'backup')
         os.mkdir(actual_data), os.mkdir(backup)
@@ -79,6 +87,123 @@ class AtticArchiverTest(unittest.TestCase):
         os.symlink('/fnord3', join(tempdir.path, 'fnord4'))
         
         archiver = AtticArchiver(tempdir.path, ())
-        expect(archiver._files_to_archive_in_directory(tempdir.path)) == ['/fnord3', 'fnord1', 'fnord2']
-    
+        expect(sorted(archiver._files_to_archive_in_directory(tempdir.path))) == ['/fnord3', 'fnord1', 'fnord2']
+
 """
+
+class InPlaceArchiveTest(unittest.TestCase):
+
+    def _noop(self, tempdir, name):
+        return NoOp(join(tempdir.path, 'staging', name), dict())
+    
+    @tempdir()
+    def test_should_dump_straight_into_archive(self, tempdir):
+        archive = join(tempdir.path, 'archive')
+        noops = [self._noop(tempdir, 'first'), self._noop(tempdir, 'second')]
+        archiver = Archiver(archive, noops, sh=MagicMock(), staging=False)
+        with frozen_time():
+            archiver.archive()
+        
+        for name in ('first', 'second'):
+            expect(exists(join(archive, 'noop-%s-2015-01-20_16-24-29' % name, 'dump.conf'))) == True
+        expect(exists(join(tempdir.path, 'staging'))) == False
+        expect(archiver.sh.rsync.called) == False
+    
+    @tempdir()
+    def test_should_not_leave_failed_dumps_in_the_archive(self, tempdir):
+        archive = join(tempdir.path, 'archive')
+        noop = self._noop(tempdir, 'first')
+        def dump():
+            os.makedirs(noop.directory)
+            open(join(noop.directory, 'half_written'), 'w').close()
+            raise OSError("disk full")
+        noop.dump = dump
+        archiver = Archiver(archive, [noop], sh=MagicMock(), staging=False)
+        with frozen_time():
+            expect(archiver.archive).raises(OSError)
+        expect(os.listdir(archive)) == []
+    
+    @tempdir()
+    def test_should_stage_one_dump_at_a_time_for_attic(self, tempdir):
+        sh = MagicMock()
+        staged = []
+        def attic(command, *args):
+            if command == 'create':
+                staged.append(sorted(os.listdir(join(tempdir.path, 'staging'))))
+        sh.attic.side_effect = attic
+        noops = [self._noop(tempdir, 'first'), self._noop(tempdir, 'second')]
+        archiver = AtticArchiver(join(tempdir.path, 'archive'), noops, sh=sh, staging=False)
+        archiver.archive()
+        
+        expect(staged) == [['first'], ['second']]
+        expect(os.listdir(join(tempdir.path, 'staging'))) == []
+        sh.attic.assert_any_call('init', join(tempdir.path, 'archive'))
+
+class FileListTest(unittest.TestCase):
+
+    @tempdir()
+    def test_should_stream_file_list_to_rsync(self, tempdir):
+        tempdir.write('dump/dump.conf', b'')
+        tempdir.write('dump/data/file', b'')
+        tempdir.write('elsewhere/file', b'')
+        tempdir.makedir('archive')
+        os.symlink(join(tempdir.path, 'elsewhere'), join(tempdir.path, 'dump', 'link'))
+        sh = MagicMock()
+        file_lists = []
+        sh.rsync.side_effect = lambda *args, _in, **kwargs: file_lists.append(b''.join(_in))
+        archiver = Archiver(join(tempdir.path, 'archive'), [], sh=sh)
+        archiver.commit_data_interface('noop-test-2015-01-20_16-24-29', join(tempdir.path, 'dump') + '/')
+        
+        destination = join(tempdir.path, 'archive', 'noop-test-2015-01-20_16-24-29')
+        (relative, _), (absolute, _) = [call[0] for call in sh.rsync.call_args_list]
+        expect((relative, absolute)) == ('.', '/')
+        expect(sh.rsync.call_args[1]).has_subdict(files_from='-', from0=True, recursive=True, archive=True)
+        expect(sorted(file_lists[0].split(b'\0'))) == [b'', b'data', b'dump.conf']
+        expect(file_lists[1]) == os.fsencode(join(tempdir.path, 'elsewhere')).lstrip(b'/') + b'\0'
+    
+    @tempdir()
+    def test_should_know_how_many_entries_attic_can_take(self, tempdir):
+        archiver = AtticArchiver(join(tempdir.path, 'archive'), [], sh=MagicMock())
+        expect(archiver._arguments_fit(['dump.conf', 'dump.sql'])) == True
+        expect(archiver._arguments_fit(['x' * 1000] * 10 ** 5)) == False
+    
+    @tempdir()
+    def test_should_archive_the_directory_with_attic_unless_symlinks_need_resolving(self, tempdir):
+        tempdir.write('dump/dump.conf', b'')
+        tempdir.write('dump/data/file', b'')
+        tempdir.makedir('elsewhere')
+        archiver = AtticArchiver(join(tempdir.path, 'archive'), [], sh=MagicMock())
+        created = lambda: archiver.sh.attic.call_args[0][2:]
+        archiver.commit_data_interface('noop-test-2015-01-20_16-24-29', tempdir.getpath('dump'))
+        expect(created()) == ('.',)
+        
+        os.symlink(tempdir.getpath('elsewhere'), tempdir.getpath('dump/link'))
+        archiver.commit_data_interface('noop-test-2015-01-20_16-24-29', tempdir.getpath('dump'))
+        expect(created()) == (tempdir.getpath('elsewhere'), 'data', 'dump.conf')
+        
+        with patch.object(archiver, '_arguments_fit', return_value=False):
+            archiver.commit_data_interface('noop-test-2015-01-20_16-24-29', tempdir.getpath('dump'))
+        expect(created()) == ('.', tempdir.getpath('elsewhere'))
+
+class AtticSessionTest(unittest.TestCase):
+
+    @tempdir()
+    def test_should_commit_all_interfaces_in_one_attic_create(self, tempdir):
+        sh = MagicMock()
+        archived = []
+        def attic(command, *args):
+            if command == 'create':
+                archived.append((args, sorted(os.listdir('.')), open('session.json').read()))
+        sh.attic.side_effect = attic
+        noops = [NoOp(join(tempdir.path, 'staging', name), dict()) for name in ('first', 'second')]
+        archiver = AtticArchiver(join(tempdir.path, 'archive'), noops, sh=sh, session=True)
+        with frozen_time():
+            archiver.archive()
+        
+        names = ['noop-first-2015-01-20_16-24-29', 'noop-second-2015-01-20_16-24-29']
+        (args, listed, index), = archived
+        expect(args[0].startswith(join(tempdir.path, 'archive') + '::session.20')) == True
+        expect(args[1:]) == ('session.json',) + tuple(names)
+        expect(listed) == names + ['session.json']
+        expect(json.loads(index)) == names
+        expect(sorted(os.listdir(join(tempdir.path, 'staging')))) == ['first', 'second']
@@ -0,0 +1,54 @@
+from ..catalog import *
+from ..restorers import RestoreFromDirectory, UnknownBackupError
+
+from os.path import join
+import os
+
+from pyexpect import expect
+import unittest
+from testfixtures import tempdir
+from unittest.mock import MagicMock, patch
+
+
+class BackupCatalogTest(unittest.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.catalog = BackupCatalog(':memory:')
+    
+    def tearDown(self):
+        self.catalog.close()
+    
+    @tempdir()
+    def test_should_only_list_container_again_after_it_changed(self, tempdir):
+        list_backups = MagicMock(return_value=['fnord-lala-2015-01-20_14-24-29'])
+        os.utime(tempdir.path, ns=(23, 23))
+        
+        expect(self.catalog.refresh(tempdir.path, list_backups)) == True
+        expect(self.catalog.refresh(tempdir.path, list_backups)) == False
+        expect(list_backups.call_count) == 1
+        
+        list_backups.return_value = ['fnord-lala-2015-01-20_16-24-29']
+        os.utime(tempdir.path, ns=(42, 42))
+        expect(self.catalog.refresh(tempdir.path, list_backups)) == True
+        expect(self.catalog.backup_names(tempdir.path)) == ['fnord-lala-2015-01-20_16-24-29']
+    
+    @tempdir()
+    def test_should_look_up_backups_by_prefix(self, tempdir):
+        for name in ['a', 'fnord-23', 'foobar-blub', 'fnord-42']:
+            self.catalog.record(tempdir.path, name)
+        
+        expect(self.catalog.backup_names(tempdir.path, 'fnord')) == ['fnord-23', 'fnord-42']
+        expect(self.catalog.backup_names(tempdir.path, 'nothing')) == []
+        expect(self.catalog.backup_names(join(tempdir.path, 'elsewhere'), 'fnord')) == []
+        expect(self.catalog.latest_backup(tempdir.path, 'fnord')) == 'fnord-42'
+    
+    @tempdir()
+    def test_should_find_best_backup_like_best_backup_from_set(self, tempdir):
+        os.utime(tempdir.path, ns=(23, 23))
+        backups = ['fnord-lala-2015-01-20_14-24-29', 'fnord-lala-2015-01-20_16-24-29', 'fnord-moo-2015-01-20_16-24-29']
+        with patch.object(RestoreFromDirectory, '_backups_in_directory', return_value=backups):
+            best = lambda prefix: RestoreFromDirectory.best_backup(tempdir.path, prefix, catalog=self.catalog)
+            expect(best('fnord-lala')) == 'fnord-lala-2015-01-20_16-24-29'
+            expect(lambda: best('fnord')).raises(UnknownBackupError)
+            expect(lambda: best('blubb')).raises(UnknownBackupError)
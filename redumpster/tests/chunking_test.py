@@ -0,0 +1,142 @@
+from ..chunking import *
+from ..chunking import _boundary_candidates, _gear_candidates
+from ..archivers import ChunkingArchiver
+from ..restorers import RestoreFromChunkStore
+
+from os.path import join, exists
+import os
+import random
+
+from pyexpect import expect
+import unittest
+from testfixtures import tempdir
+from unittest.mock import patch
+
+
+def sql_dump(rows, seed=23):
+    generator = random.Random(seed)
+    return b''.join(b"INSERT INTO `orders` VALUES (%d,'customer-%d',%d.%02d,'2015-01-%02d');\n" % (
+        row, generator.randrange(10000), generator.randrange(1000), generator.randrange(100),
+        generator.randrange(1, 29)) for row in range(rows))
+
+def write_random_file(path, size, seed=23):
+    data = random.Random(seed).getrandbits(size * 8).to_bytes(size, 'little')
+    with open(path, 'wb') as f:
+        f.write(data)
+    return data
+
+class ChunkerTest(unittest.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.chunker = Chunker(average_size=1024, min_size=256, max_size=4096, segment_size=8192, jobs=2)
+    
+    def tearDown(self):
+        self.chunker.close()
+    
+    @tempdir()
+    def test_should_cover_whole_file_within_size_limits(self, tempdir):
+        path = join(tempdir.path, 'data')
+        write_random_file(path, 50000)
+        
+        boundaries = list(self.chunker.boundaries(path))
+        expect(boundaries[0][0]) == 0
+        for (offset, length), (next_offset, _) in zip(boundaries, boundaries[1:]):
+            expect(offset + length) == next_offset
+        expect(sum(length for offset, length in boundaries)) == 50000
+        for offset, length in boundaries[:-1]:
+            expect(256 <= length <= 4096) == True
+    
+    @tempdir()
+    def test_should_scan_segments_like_the_whole_file(self, tempdir):
+        path = join(tempdir.path, 'data')
+        write_random_file(path, 50000)
+        
+        whole_file = Chunker(average_size=1024, min_size=256, max_size=4096, segment_size=1 << 20)
+        expect(list(self.chunker.boundaries(path))) == list(whole_file.boundaries(path))
+    
+    @tempdir()
+    def test_should_find_same_boundaries_after_insertion(self, tempdir):
+        path = join(tempdir.path, 'data')
+        data = write_random_file(path, 50000)
+        chunks = lambda: set(data[offset:offset + length] for offset, length in self.chunker.boundaries(path))
+        before = chunks()
+        
+        data = b'inserted at the front' + data
+        with open(path, 'wb') as f:
+            f.write(data)
+        after = chunks()
+        expect(len(before - after) <= 2) == True
+    
+    @tempdir()
+    def test_should_reuse_chunks_of_text_dumps_after_insertion(self, tempdir):
+        path = join(tempdir.path, 'dump.sql')
+        data = sql_dump(5000)
+        digests = lambda: [sha256_hexdigest(data[offset:offset + length])
+            for offset, length in self.chunker.boundaries(path)]
+        with open(path, 'wb') as f:
+            f.write(data)
+        before = digests()
+        expect(len(before) > len(data) // 4096 * 2) == True
+        
+        data = data[:1000] + b"INSERT INTO `orders` VALUES (0);\n" + data[1000:]
+        with open(path, 'wb') as f:
+            f.write(data)
+        after = digests()
+        expect(len(set(before) & set(after)) >= len(before) * 9 // 10) == True
+    
+    @tempdir()
+    def test_should_find_the_same_candidates_in_blocks(self, tempdir):
+        # with numpy installed the candidates are computed per block, without it this
+        # compares the loop with itself
+        path = join(tempdir.path, 'dump.sql')
+        data = sql_dump(500) + bytes(3000)
+        with open(path, 'wb') as f:
+            f.write(data)
+        mask = self.chunker.mask
+        with patch('redumpster.chunking.NUMPY_BLOCK_SIZE', 1000):
+            expect(_boundary_candidates(path, 5000, len(data) - 5000, mask)) == \
+                _gear_candidates(data[5000 - GEAR_WINDOW:], 5000 - GEAR_WINDOW, 5000, mask)
+            expect(_boundary_candidates(path, 0, len(data), mask)) == _gear_candidates(data, 0, 0, mask)
+
+class ChunkingArchiverTest(unittest.TestCase):
+
+    def _archiver(self, directory):
+        chunker = Chunker(average_size=1024, min_size=256, max_size=4096)
+        return ChunkingArchiver(directory, [], chunker=chunker, jobs=2)
+    
+    @tempdir()
+    def test_should_store_unchanged_chunks_only_once(self, tempdir):
+        dump = join(tempdir.path, 'dump')
+        archive = join(tempdir.path, 'archive')
+        os.makedirs(dump), os.makedirs(archive)
+        data = write_random_file(join(dump, 'dump.sql'), 50000)
+        
+        archiver = self._archiver(archive)
+        archiver.commit_data_interface('noop--2015-01-20_14-24-29', dump + '/')
+        expect(archiver.stored_bytes) == 50000
+        
+        with open(join(dump, 'dump.sql'), 'wb') as f:
+            f.write(data[:20000] + b'changed' + data[20000:])
+        archiver.commit_data_interface('noop--2015-01-20_15-24-29', dump + '/')
+        expect(archiver.stored_bytes < 10000) == True
+        expect(exists(join(archive, 'manifests', 'noop--2015-01-20_15-24-29'))) == True
+    
+    @tempdir()
+    def test_should_restore_files_from_manifest(self, tempdir):
+        dump = join(tempdir.path, 'dump')
+        archive = join(tempdir.path, 'archive')
+        os.makedirs(join(dump, 'subdirectory')), os.makedirs(archive)
+        data = write_random_file(join(dump, 'subdirectory', 'dump.sql'), 20000)
+        os.symlink('dump.sql', join(dump, 'subdirectory', 'link'))
+        os.chmod(join(dump, 'subdirectory', 'dump.sql'), 0o640)
+        
+        self._archiver(archive).commit_data_interface('noop--2015-01-20_14-24-29', dump + '/')
+        expect(RestoreFromChunkStore.available_backups(archive, 'noop')) == ['noop--2015-01-20_14-24-29']
+        
+        restorer = RestoreFromChunkStore(archive, 'noop--2015-01-20_14-24-29')
+        restorer._restore_backup_to_tempdir()
+        restored = join(restorer.data_interface.directory, 'subdirectory', 'dump.sql')
+        expect(open(restored, 'rb').read()) == data
+        expect(os.stat(restored).st_mode & 0o777) == 0o640
+        expect(os.readlink(join(restorer.data_interface.directory, 'subdirectory', 'link'))) == 'dump.sql'
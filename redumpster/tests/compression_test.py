@@ -0,0 +1,17 @@
+from ..compression import *
+
+from pyexpect import expect
+import unittest
+
+class CodecTest(unittest.TestCase):
+    
+    def test_should_find_codecs_by_name(self):
+        expect(codec_named('none')).is_none()
+        expect(codec_named('')).is_none()
+        expect(codec_named('zstd').extension) == '.zst'
+        expect(lambda: codec_named('fnord')).raises(UnknownCompressionError)
+    
+    def test_should_only_pass_thread_count_to_codecs_supporting_it(self):
+        expect(codec_named('gzip').compress_arguments(level='9', threads='8')) == ['--stdout', '-9']
+        expect(codec_named('xz').compress_arguments(threads='8')) == ['--stdout', '--threads=8']
+        expect(codec_named('pigz').compress_arguments(level='1', threads='8')) == ['--stdout', '-1', '--processes=8']
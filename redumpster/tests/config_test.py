@@ -0,0 +1,64 @@
+from ..config import *
+
+from os.path import join
+import os
+
+from pyexpect import expect
+import unittest
+from testfixtures import tempdir
+from unittest.mock import patch
+
+CONFIG = b"""
+[first]
+interface_name = mysql
+tags = db, tenant-1
+mysql_user = backup
+
+[second]
+interface_name = copydir
+source = /srv
+"""
+
+class LoadConfigTest(unittest.TestCase):
+
+    @tempdir()
+    def test_should_compile_sections(self, tempdir):
+        tempdir.write('redumpster.conf', CONFIG)
+        config = load_config(join(tempdir.path, 'redumpster.conf'), cache_directory=None)
+        first, second = config.sections
+        expect(first.backup_name) == 'first'
+        expect(first.interface_name) == 'mysql'
+        expect(first.tags) == ('db', 'tenant-1')
+        expect(first.option_dict()) == dict(interface_name='mysql', tags=['db', 'tenant-1'], mysql_user='backup')
+        expect(second.tags) == ()
+        expect([section.backup_name for section in config.select('tenant-* or not db')]) == ['first', 'second']
+        expect([section.backup_name for section in config.select('not db')]) == ['second']
+    
+    @tempdir()
+    def test_should_reject_sections_without_interface(self, tempdir):
+        tempdir.write('redumpster.conf', b'[fnord]\nsource = /srv\n')
+        expect(lambda: load_config(join(tempdir.path, 'redumpster.conf'), cache_directory=None)) \
+            .raises(InvalidConfigError)
+    
+    @tempdir()
+    def test_should_reject_tags_no_expression_can_select(self, tempdir):
+        for tag in ('and', 'not', 'or', 'db(main)', ')', 'db main'):
+            tempdir.write('redumpster.conf', b'[first]\ninterface_name = noop\ntags = db, ' + tag.encode() + b'\n')
+            expect(lambda: load_config(join(tempdir.path, 'redumpster.conf'), cache_directory=None)) \
+                .raises(InvalidConfigError)
+    
+    @tempdir()
+    def test_should_use_cache_until_config_changes(self, tempdir):
+        tempdir.write('redumpster.conf', CONFIG)
+        path = join(tempdir.path, 'redumpster.conf')
+        cache_directory = join(tempdir.path, 'cache')
+        expect(load_config(path, cache_directory).to_json()) == load_config(path, None).to_json()
+        
+        with patch('redumpster.config.ConfigObj') as config_obj:
+            cached = load_config(path, cache_directory)
+        expect(config_obj.called) == False
+        expect(cached.to_json()) == load_config(path, None).to_json()
+        
+        tempdir.write('redumpster.conf', CONFIG.replace(b'backup', b'fnord'))
+        os.utime(path, ns=(0, 0))
+        expect(load_config(path, cache_directory).sections[0].option_dict()['mysql_user']) == 'fnord'
@@ -0,0 +1,115 @@
+from ..copying import *
+from ..copy_directory import CopyDirectory
+from ..throttle import THROTTLED_BUFFER_SIZE
+
+from os.path import join, exists
+import os
+
+from pyexpect import expect
+import unittest
+from testfixtures import tempdir
+from unittest.mock import patch
+
+class NativeCopyTest(unittest.TestCase):
+
+    def _source(self, tempdir):
+        tempdir.write('source/unchanged', b'fnord')
+        tempdir.write('source/changed', b'fnord')
+        tempdir.write('source/nested/file', b'nested')
+        os.symlink('unchanged', join(tempdir.path, 'source', 'link'))
+        os.chmod(join(tempdir.path, 'source', 'nested', 'file'), 0o640)
+        os.utime(join(tempdir.path, 'source', 'nested'), ns=(0, 23 * 10 ** 9))
+        return join(tempdir.path, 'source')
+    
+    @tempdir()
+    def test_should_copy_tree_with_metadata(self, tempdir):
+        source = self._source(tempdir)
+        os.setxattr(join(source, 'changed'), 'user.fnord', b'23')
+        destination = join(tempdir.path, 'first')
+        actions = []
+        stats = NativeCopy(progress=lambda *args: actions.append(args)).copy_tree(source, destination)
+        
+        expect(stats).has_subdict(copied=3, copied_bytes=16, linked=0)
+        expect(sorted(actions)) == [('changed', 'copied', 5), ('nested/file', 'copied', 6), ('unchanged', 'copied', 5)]
+        expect(tempdir.read('first/nested/file')) == b'nested'
+        expect(os.readlink(join(destination, 'link'))) == 'unchanged'
+        expect(os.stat(join(destination, 'nested', 'file')).st_mode & 0o777) == 0o640
+        expect(os.stat(join(destination, 'nested')).st_mtime_ns) == 23 * 10 ** 9
+        expect(os.getxattr(join(destination, 'changed'), 'user.fnord')) == b'23'
+        expect(read_source_state(destination)['changed'][0]) == 5
+    
+    @tempdir()
+    def test_should_link_unchanged_files_against_previous_copy(self, tempdir):
+        source = self._source(tempdir)
+        first, second = join(tempdir.path, 'first'), join(tempdir.path, 'second')
+        NativeCopy().copy_tree(source, first)
+        tempdir.write('source/changed', b'FNORD')
+        os.utime(join(source, 'changed'), ns=(0, 42))
+        os.unlink(join(source, 'nested', 'file'))
+        tempdir.write('first/nested/gone', b'')
+        
+        stats = NativeCopy().copy_tree(source, second, previous=first)
+        expect(stats).has_subdict(copied=1, linked=1)
+        expect(os.stat(join(second, 'unchanged')).st_ino) == os.stat(join(first, 'unchanged')).st_ino
+        expect(tempdir.read('second/changed')) == b'FNORD'
+        expect(exists(join(second, 'nested', 'file'))) == False
+        
+        # copying over an existing copy only touches what changed, and deletes the rest
+        stats = NativeCopy().copy_tree(source, first)
+        expect(stats).has_subdict(copied=1, unchanged=1, deleted=2)
+        expect(exists(join(first, 'nested', 'gone'))) == False
+    
+    @tempdir()
+    def test_should_not_link_or_skip_files_whose_metadata_changed(self, tempdir):
+        source = self._source(tempdir)
+        first, second = join(tempdir.path, 'first'), join(tempdir.path, 'second')
+        NativeCopy().copy_tree(source, first)
+        # neither changes the mtime
+        os.chmod(join(source, 'unchanged'), 0o600)
+        os.setxattr(join(source, 'changed'), 'user.fnord', b'23')
+        
+        stats = NativeCopy().copy_tree(source, second, previous=first)
+        expect(stats).has_subdict(copied=2, linked=1)
+        expect(os.stat(join(second, 'unchanged')).st_mode & 0o777) == 0o600
+        expect(os.stat(join(first, 'unchanged')).st_mode & 0o777) != 0o600
+        expect(os.getxattr(join(second, 'changed'), 'user.fnord')) == b'23'
+        
+        # copying over an existing copy applies metadata to unchanged data as well
+        stats = NativeCopy().copy_tree(source, first)
+        expect(stats).has_subdict(copied=1, unchanged=2)
+        expect(os.getxattr(join(first, 'changed'), 'user.fnord')) == b'23'
+
+class NativeCopyDirectoryTest(unittest.TestCase):
+
+    @tempdir()
+    def test_should_dump_and_restore_without_rsync(self, tempdir):
+        tempdir.write('production/important_file', b'fnord')
+        options = dict(source=join(tempdir.path, 'production'), copy_engine='native')
+        dump = CopyDirectory(directory=join(tempdir.path, 'first', 'production'), options=options)
+        dump.dump()
+        dump.write_dump_config()
+        expect(tempdir.read('first/production/important_file')) == b'fnord'
+        
+        second = CopyDirectory(directory=join(tempdir.path, 'second', 'production'), options=options)
+        second.dump()
+        second.write_dump_config()
+        expect(os.stat(join(tempdir.path, 'second', 'production', 'important_file')).st_nlink) == 2
+        
+        tempdir.write('production/important_file', b'oops')
+        tempdir.write('production/new_file', b'')
+        second.restore()
+        expect(tempdir.read('production/important_file')) == b'fnord'
+        expect(sorted(os.listdir(join(tempdir.path, 'production')))) == ['important_file']
+    
+    @tempdir()
+    def test_should_apply_rate_limit_and_warn_about_other_policies(self, tempdir):
+        tempdir.write('production/important_file', b'x' * (THROTTLED_BUFFER_SIZE + 1))
+        options = dict(source=join(tempdir.path, 'production'), copy_engine='native',
+            rate_limit='1G', ionice_class='idle')
+        dump = CopyDirectory(directory=join(tempdir.path, 'first', 'production'), options=options)
+        with patch('redumpster.throttle.RateLimiter.throttle') as throttle, \
+                self.assertLogs('redumpster.data_interfaces', 'WARNING') as logs:
+            dump.dump()
+        expect([each[0][0] for each in throttle.call_args_list]) == [THROTTLED_BUFFER_SIZE, 1]
+        expect(logs.output[0]).to_contain('ignores ionice, nice and cgroup')
+        expect(tempdir.read('first/production/important_file')) == b'x' * (THROTTLED_BUFFER_SIZE + 1)
@@ -1,17 +1,31 @@
 from ..data_interfaces import *
+from ..sql_dumps import *
+from ..copy_directory import *
 from os.path import join, exists
 import os
 
-from testfixtures import tempdir, log_capture
+from testfixtures import tempdir, log_capture, TempDirectory
 from pyexpect import expect
 import unittest
-from unittest.mock import MagicMock
+from unittest.mock import MagicMock, patch
 
+from redumpster.throttle import THROTTLED_BUFFER_SIZE
 from redumpster.utils import change_working_directory_to
 
 def touch(a_path):
      open(a_path, 'a').close()
 
+class WritesTo(object):
+    # matches the writer that is handed to sh as _out
+    def __init__(self, path):
+        self.path = path
+    
+    def __eq__(self, other):
+        return getattr(other, 'path', None) == self.path
+    
+    def __repr__(self):
+        return 'WritesTo(%r)' % self.path
+
 class DataInterfaceFactoryTest(unittest.TestCase):
     
     def test_should_instantiate_multiple_interfaces(self):
@@ -62,6 +76,28 @@ class DataInterfaceFactoryTest(unittest.TestCase):
         expect(interfaces).has_length(2)
         expect(interfaces[0].backup_name) == 'first'
         expect(interfaces[1].backup_name) == 'second'
+        
+        # tags are not substrings of the tags option
+        interfaces = interfaces_from_config(config, 'unused_directory', tag='ba')
+        expect(interfaces).has_length(0)
+    
+    def test_should_filter_interfaces_by_tag_expressions(self):
+        from collections import OrderedDict
+        config = OrderedDict()
+        config['first'] = dict(interface_name='noop', tags='db, tenant-1')
+        config['second'] = dict(interface_name='noop', tags='db, staging')
+        config['third'] = dict(interface_name='noop', tags='tenant-2')
+        
+        selected = lambda tag: [interface.backup_name for interface in interfaces_from_config(config, 'dir', tag=tag)]
+        expect(selected('db and not staging')) == ['first']
+        expect(selected('tenant-*')) == ['first', 'third']
+        
+        with patch.object(DataInterface, 'make_data_interface') as make_data_interface:
+            interfaces = iter_interfaces_from_config(config, 'dir', tag='staging')
+            expect(make_data_interface.called) == False
+            expect(list(interfaces)) == [make_data_interface.return_value]
+        make_data_interface.assert_called_once_with(
+            'dir', 'noop', 'second', dict(interface_name='noop', tags='db, staging'), sh=None)
 
 class DataInterfaceTest(unittest.TestCase):
     
@@ -83,15 +119,39 @@ class DataInterfaceTest(unittest.TestCase):
         expect(exists(destination)) == False
         data_interface.dump()
         expect(exists(destination)) == True
+    
+    def test_should_name_dumps_like_restorers_parse_them(self):
+        from redumpster.catalog import parse_backup_name
+        data_interface = DataInterface.make_data_interface('dir', 'mysql', 'main', dict())
+        name = data_interface.dump_name()
+        expect(parse_backup_name(name).groups()[:2]) == ('mysql', 'main')
+        # stays the same after the dump moved into the archive
+        data_interface.dump_into(join('archive', name))
+        expect(data_interface.dump_name()) == name
+    
+    @tempdir()
+    def test_should_build_tool_options_until_dump_config_is_loaded(self, tempdir):
+        data_interface = DataInterface.make_data_interface(tempdir.path, 'mysql', 'main',
+            dict(mysql_user='backup', mysql_password='secret', compression='gzip'))
+        options = data_interface.options()
+        expect(options) == dict(user='backup', password='secret')
+        expect(data_interface.options()).is_(options)
+        
+        data_interface.config.filename = tempdir.write('dump.conf', b'[options]\nmysql_user = restore\n')
+        data_interface.load_dump_config(dict(mysql_password=''))
+        expect(data_interface.options()) == dict(user='restore', password=False)
 
 class MySQLDumpTest(unittest.TestCase):
     
     def setUp(self):
         super().setUp()
         self.sh = MagicMock()
+        self.tempdir = TempDirectory()
+        self.addCleanup(self.tempdir.cleanup)
+        self.directory = self.tempdir.path
     
     def test_should_call_dump(self):
-        dump = MySQLDump(directory='.', options=dict(mysql_user='foo', mysql_password='bar'), sh=self.sh)
+        dump = MySQLDump(directory=self.directory, options=dict(mysql_user='foo', mysql_password='bar'), sh=self.sh)
         
         expect(self.sh.mysqldump.called) == False
         dump.dump()
@@ -104,7 +164,7 @@ class MySQLDumpTest(unittest.TestCase):
         )
     
     def test_should_not_provide_password(self):
-        dump = MySQLDump(directory='.', options=dict(mysql_user='foo', mysql_password=''), sh=self.sh)
+        dump = MySQLDump(directory=self.directory, options=dict(mysql_user='foo', mysql_password=''), sh=self.sh)
         
         dump.dump()
         args, kwargs = self.sh.mysqldump.call_args
@@ -129,7 +189,7 @@ class MySQLDumpTest(unittest.TestCase):
         )
 
     def test_should_provide_command_before_mysqldump(self):
-        dump = MySQLDump(directory='/',
+        dump = MySQLDump(directory=self.directory,
             options=dict(
                 mysql_user='foo', mysql_password='bar',
                 dump_command_prefix='ssh fnord',
@@ -140,18 +200,119 @@ class MySQLDumpTest(unittest.TestCase):
         self.sh.Command('ssh').bake('fnord').mysqldump.assert_called_once_with(
             '--all-databases', '--complete-insert',
             user='foo', password='bar',
-            _out='/dump.sql',
+            _out=WritesTo(join(self.directory, 'dump.sql')),
+        )
+    
+    def test_should_throttle_tools_on_the_database_host(self):
+        dump = MySQLDump(directory=self.directory,
+            options=dict(
+                mysql_user='foo', dump_command_prefix='ssh fnord',
+                ionice_class='idle', nice='19',
+            ), sh=self.sh)
+        
+        dump.dump()
+        self.sh.Command('ssh').bake('fnord', 'ionice', '-c', '3', 'nice', '-n', '19').mysqldump \
+            .assert_called_once_with(
+                '--all-databases', '--complete-insert',
+                user='foo', password=False,
+                _out=WritesTo(join(self.directory, 'dump.sql')),
+            )
+    
+    def test_should_limit_rate_of_dump_stream(self):
+        def mysqldump(*args, _out, _out_bufsize, **kwargs):
+            for _ in range(3):
+                _out.write(b'x' * _out_bufsize)
+        self.sh.mysqldump.side_effect = mysqldump
+        dump = MySQLDump(directory=self.directory, options=dict(mysql_user='foo', rate_limit='1M'), sh=self.sh)
+        
+        with patch('time.sleep') as sleep:
+            dump.dump()
+            dump.write_dump_config()
+        expect(sleep.called) == True
+        expect(self.tempdir.read('dump.sql')) == b'x' * 3 * THROTTLED_BUFFER_SIZE
+        expect(self.tempdir.read('manifest.jsonl')).contains(b'dump.sql')
+    
+    def test_should_compress_dump_stream(self):
+        dump = MySQLDump(directory=self.directory,
+            options=dict(
+                mysql_user='foo', mysql_password='bar',
+                compression='zstd', compression_level='3', compression_threads='4',
+            ), sh=self.sh)
+        
+        dump.dump()
+        self.sh.mysqldump.assert_called_once_with(
+            '--all-databases', '--complete-insert',
+            user='foo', password='bar',
+            _piped=True,
+        )
+        self.sh.zstd.assert_called_once_with(
+            '--stdout', '-3', '-T4',
+            _in=self.sh.mysqldump.return_value,
+            _out=WritesTo(join(self.directory, 'dump.sql.zst')),
         )
     
+    @tempdir()
+    def test_should_restore_with_recorded_compression(self, tempdir):
+        dump = MySQLDump(directory=tempdir.path,
+            options=dict(mysql_user='foo', compression='xz'), sh=self.sh)
+        dump.dump()
+        dump.write_dump_config()
+        
+        restore = MySQLDump(directory=tempdir.path,
+            options=dict(mysql_user='foo', compression='none'), sh=self.sh)
+        restore.restore()
+        self.sh.xz.assert_called_with('--decompress', '--stdout', join(tempdir.path, 'dump.sql.xz'), _piped=True)
+        args, kwargs = self.sh.mysql.call_args
+        expect(kwargs).has_subdict(user='foo', _in=self.sh.xz.return_value)
+        expect(kwargs).does_not.contain('execute')
+    
+    @tempdir()
+    def test_should_dump_each_selected_database_separately(self, tempdir):
+        self.sh.mysql.return_value = 'information_schema\nmysql\nshop\nshop_staging\nwiki\n'
+        dump = MySQLDump(directory=tempdir.path,
+            options=dict(
+                mysql_user='foo', per_database=True, parallel_databases=2,
+                include_databases='shop*, wiki, mysql', exclude_databases='*_staging',
+            ), sh=self.sh)
+        
+        dump.dump()
+        dumped = sorted(call[0][-1] for call in self.sh.mysqldump.call_args_list)
+        expect(dumped) == ['mysql', 'shop', 'wiki']
+        self.sh.mysqldump.assert_any_call(
+            '--complete-insert', '--databases', 'shop',
+            user='foo', password=False,
+            _out=WritesTo(join(tempdir.path, 'databases', 'shop.sql')),
+        )
+        expect(dump.config['databases']) == ['mysql', 'shop', 'wiki']
+    
+    @tempdir()
+    def test_should_restore_recorded_databases(self, tempdir):
+        self.sh.mysql.return_value = 'shop\nwiki\n'
+        dump = MySQLDump(directory=tempdir.path,
+            options=dict(mysql_user='foo', per_database='true'), sh=self.sh)
+        dump.dump()
+        dump.write_dump_config()
+        self.sh.reset_mock()
+        
+        restore = MySQLDump(directory=tempdir.path, options=dict(mysql_user='foo'), sh=self.sh)
+        restore.restore()
+        restored = sorted(call[1]['execute'] for call in self.sh.mysql.call_args_list)
+        expect(restored) == [
+            'source %s' % join(tempdir.path, 'databases', 'shop.sql'),
+            'source %s' % join(tempdir.path, 'databases', 'wiki.sql'),
+        ]    
 
 class PostgreSQLDumpTest(unittest.TestCase):
     
     def setUp(self):
         super().setUp()
         self.sh = MagicMock()
+        self.tempdir = TempDirectory()
+        self.addCleanup(self.tempdir.cleanup)
+        self.directory = self.tempdir.path
     
     def test_should_dump(self):
-        dump = PostgreSQLDump(directory='.', options=dict(postgres_username='foo'), sh=self.sh)
+        dump = PostgreSQLDump(directory=self.directory, options=dict(postgres_username='foo'), sh=self.sh)
         
         expect(self.sh.pg_dumpall.called) == False
         dump.dump()
@@ -179,16 +340,88 @@ class PostgreSQLDumpTest(unittest.TestCase):
     
     def test_should_provide_command_before_postgres_dump(self):
         options = dict(postgres_username='foo', dump_command_prefix='ssh fnord')
-        dump = PostgreSQLDump(directory='/', options=options, sh=self.sh)
+        dump = PostgreSQLDump(directory=self.directory, options=options, sh=self.sh)
         
         expect(self.sh.Command.called) == False
         dump.dump()
         self.sh.Command('ssh').bake('fnord').pg_dumpall.assert_called_once_with(
             clean=True,
             username='foo',
-            _out='/dump.sql',
+            _out=WritesTo(join(self.directory, 'dump.sql')),
+        )
+    
+    @tempdir()
+    def test_should_restore_compressed_dump(self, tempdir):
+        dump = PostgreSQLDump(directory=tempdir.path,
+            options=dict(postgres_username='foo', compression='gzip'), sh=self.sh)
+        dump.dump()
+        self.sh.gzip.assert_called_once_with(
+            '--stdout',
+            _in=self.sh.pg_dumpall.return_value,
+            _out=WritesTo(join(tempdir.path, 'dump.sql.gz')),
+        )
+        dump.write_dump_config()
+        
+        dump.restore()
+        args, kwargs = self.sh.psql.call_args
+        expect(args) == ('postgres',)
+        expect(kwargs).has_subdict(_in=self.sh.gzip.return_value)
+        expect(kwargs).does_not.contain('file')
+    
+    @tempdir()
+    def test_should_dump_globals_and_each_database_in_directory_format(self, tempdir):
+        self.sh.psql.return_value = 'postgres\nshop\n'
+        dump = PostgreSQLDump(directory=tempdir.path,
+            options=dict(postgres_username='foo', format='directory', jobs='4'), sh=self.sh)
+        
+        dump.dump()
+        self.sh.pg_dumpall.assert_called_once_with(
+            globals_only=True, clean=True, username='foo',
+            _out=WritesTo(join(tempdir.path, 'globals.sql')),
+        )
+        self.sh.pg_dump.assert_any_call(
+            'shop', format='directory', jobs=4, username='foo',
+            file=join(tempdir.path, 'databases', 'shop'),
         )
+        expect(self.sh.pg_dump.call_count) == 2
+        expect(dump.config['databases']) == ['postgres', 'shop']
     
+    @tempdir()
+    def test_should_restore_directory_format_with_pg_restore(self, tempdir):
+        self.sh.psql.return_value = 'shop\n'
+        dump = PostgreSQLDump(directory=tempdir.path,
+            options=dict(postgres_username='foo', format='directory', jobs=2), sh=self.sh)
+        dump.dump()
+        dump.write_dump_config()
+        self.sh.reset_mock()
+        
+        restore = PostgreSQLDump(directory=tempdir.path, options=dict(postgres_username='foo', jobs=8), sh=self.sh)
+        restore.restore()
+        self.sh.psql.assert_called_once_with('postgres', file=join(tempdir.path, 'globals.sql'), username='foo')
+        self.sh.pg_restore.assert_called_once_with(
+            join(tempdir.path, 'databases', 'shop'),
+            create=True, clean=True, if_exists=True, dbname='template1', jobs=8,
+            username='foo',
+        )
+    
+    @tempdir()
+    def test_should_restore_the_postgres_database_without_dropping_the_connected_one(self, tempdir):
+        self.sh.psql.return_value = 'postgres\nshop\n'
+        dump = PostgreSQLDump(directory=tempdir.path,
+            options=dict(postgres_username='foo', format='directory'), sh=self.sh)
+        dump.dump()
+        dump.write_dump_config()
+        self.sh.reset_mock()
+        
+        PostgreSQLDump(directory=tempdir.path, options=dict(), sh=self.sh).restore()
+        restored = sorted((args[0], kwargs['dbname']) for args, kwargs in self.sh.pg_restore.call_args_list)
+        expect(restored) == [(join(tempdir.path, 'databases', 'postgres'), 'template1'),
+            (join(tempdir.path, 'databases', 'shop'), 'template1')]
+    
+    def test_should_not_allow_dump_command_prefix_in_directory_format(self):
+        options = dict(postgres_username='foo', dump_command_prefix='ssh fnord', format='directory')
+        dump = PostgreSQLDump(directory='/', options=options, sh=self.sh)
+        expect(dump.dump).raises(AssertionError)    
 
 class DirectoryTest(unittest.TestCase):
     
@@ -316,3 +549,45 @@ class DirectoryTest(unittest.TestCase):
             touch(source_file)
             dump.restore()
             expect(os.path.exists(source_file)).is_false()
+    
+    @tempdir()
+    def test_should_link_against_previous_dump_of_same_backup(self, tempdir):
+        sh = MagicMock()
+        source = join(tempdir.path, 'production')
+        options = dict(source=source)
+        for run in ('2015-01-19', '2015-01-20'):
+            previous = CopyDirectory(join(tempdir.path, run, 'uploads'), options, sh=sh)
+            previous.dump()
+            previous.write_dump_config()
+        # unfinished dumps and dumps of other sources are ignored
+        os.makedirs(join(tempdir.path, '2015-01-21', 'uploads'))
+        other = CopyDirectory(join(tempdir.path, '2015-01-22', 'uploads'), dict(source='/elsewhere'), sh=sh)
+        other.dump()
+        other.write_dump_config()
+        os.utime(join(tempdir.path, '2015-01-19', 'uploads', 'dump.conf'), (0, 0))
+        
+        dump = CopyDirectory(join(tempdir.path, '2015-01-23', 'uploads'), options, sh=sh)
+        expect(dump.previous_dump()) == join(tempdir.path, '2015-01-20', 'uploads')
+        dump.dump()
+        args, kwargs = sh.rsync.call_args
+        expect(args[0]) == '--link-dest=' + join(tempdir.path, '2015-01-20', 'uploads')
+        expect(args[1:]) == (source + '/', join(tempdir.path, '2015-01-23', 'uploads'))
+    
+    @tempdir()
+    def test_should_link_against_previous_dump_in_the_archive_when_dumping_in_place(self, tempdir):
+        sh = MagicMock()
+        options = dict(source=join(tempdir.path, 'production'))
+        archive = join(tempdir.path, 'archive')
+        previous = CopyDirectory(join(tempdir.path, 'staging', 'uploads'), options, sh=sh)
+        previous.dump_into(join(archive, 'copydir-uploads-2015-01-19_00-00-00'))
+        previous.dump()
+        previous.write_dump_config()
+        
+        dump = CopyDirectory(join(tempdir.path, 'staging', 'uploads'), options, sh=sh)
+        dump.dump_into(join(archive, '.partial-copydir-uploads-2015-01-20_00-00-00'))
+        expect(dump.backup_name) == 'uploads'
+        expect(dump.previous_dump()) == join(archive, 'copydir-uploads-2015-01-19_00-00-00')
+    
+    def test_should_not_link_against_anything_on_first_dump(self):
+        dump = CopyDirectory(directory='/nonexistant/run/uploads', options=dict(source='/bar'))
+        expect(dump.previous_dump()).is_none()
@@ -0,0 +1,64 @@
+from ..datapath import *
+
+from os.path import join
+import hashlib
+import os
+import random
+import sh
+
+from pyexpect import expect
+import unittest
+from testfixtures import tempdir
+from unittest.mock import patch
+
+
+class CopyStreamTest(unittest.TestCase):
+
+    def _copy(self, tempdir, data, **kwargs):
+        tempdir.write('source', data)
+        with open(join(tempdir.path, 'source'), 'rb') as source, \
+                open(join(tempdir.path, 'destination'), 'wb') as destination:
+            copied = copy_stream(source.fileno(), destination.fileno(), **kwargs)
+        return copied, tempdir.read('destination')
+    
+    @tempdir()
+    def test_should_copy_file_in_kernel(self, tempdir):
+        data = random.Random(23).randbytes(COPY_BUFFER_SIZE + 23)
+        expect(self._copy(tempdir, data)) == (len(data), data)
+    
+    @tempdir()
+    def test_should_copy_given_size_only(self, tempdir):
+        expect(self._copy(tempdir, b'fnord and more', size=5)) == (5, b'fnord')
+    
+    @tempdir()
+    def test_should_fall_back_to_buffer_if_kernel_refuses(self, tempdir):
+        def unsupported(*args):
+            raise OSError(errno.EXDEV, 'cross device')
+        with patch('os.copy_file_range', unsupported), patch('os.sendfile', unsupported):
+            expect(self._copy(tempdir, b'fnord')) == (5, b'fnord')
+    
+    @tempdir()
+    def test_should_splice_from_pipe(self, tempdir):
+        read_end, write_end = os.pipe()
+        enlarge_pipe(write_end)
+        os.write(write_end, b'fnord')
+        os.close(write_end)
+        with open(join(tempdir.path, 'destination'), 'wb') as destination:
+            expect(copy_stream(read_end, destination.fileno())) == 5
+        os.close(read_end)
+        expect(tempdir.read('destination')) == b'fnord'
+
+class DirectFileWriterTest(unittest.TestCase):
+
+    @tempdir()
+    def test_should_hash_what_a_tool_writes_into_the_file(self, tempdir):
+        written = []
+        with DirectFileWriter(join(tempdir.path, 'dump.sql'), on_close=written.append) as out:
+            sh.head('-c', str(3 << 20), '/dev/zero', _out=out)
+            out.write(b'fnord')
+        
+        expected = b'\0' * (3 << 20) + b'fnord'
+        expect(tempdir.read('dump.sql')) == expected
+        expect(written) == [out]
+        expect(out.size) == len(expected)
+        expect(out.hexdigest()) == hashlib.sha256(expected).hexdigest()
@@ -0,0 +1,70 @@
+from ..executor import *
+from ..sql_dumps import MySQLDump
+from ..manifest import HashingWriter
+
+from os.path import join
+import asyncio
+import time
+import sh
+
+from pyexpect import expect
+import unittest
+from testfixtures import tempdir
+from unittest.mock import MagicMock
+
+
+def is_running(pid):
+    try:
+        with open('/proc/%d/status' % pid) as status:
+            return 'zombie' not in status.read()
+    except FileNotFoundError:
+        return False
+
+class AsyncShTest(unittest.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.sh = AsyncSh()
+    
+    def tearDown(self):
+        self.sh.close()
+    
+    def test_should_compile_arguments_like_sh(self):
+        expect(compile_arguments(('a', ['b', 'c'], None), dict(n=True, skip_column_names=True,
+            password=False, user='root'))) == ['a', 'b', 'c', '-n', '--skip-column-names', '--user=root']
+    
+    def test_should_capture_output(self):
+        expect(str(self.sh.echo('fnord'))) == 'fnord\n'
+        expect(str(self.sh.Command('sh').bake('-c')('echo $0 $1', 'a', 'b'))) == 'a b\n'
+    
+    @tempdir()
+    def test_should_pipe_commands_into_writer(self, tempdir):
+        out = HashingWriter(join(tempdir.path, 'dump.sql'))
+        self.sh.cat(_in=self.sh.echo('CREATE TABLE fnord;', _piped=True), _out=out, _out_bufsize=4)
+        out.close()
+        expect(tempdir.read('dump.sql')) == b'CREATE TABLE fnord;\n'
+    
+    def test_should_fail_pipeline_if_piped_command_fails(self):
+        expect(lambda: self.sh.cat(_in=self.sh.false(_piped=True))).raises(sh.ErrorReturnCode_1)
+    
+    @tempdir()
+    def test_should_kill_process_group_on_timeout(self, tempdir):
+        pidfile = join(tempdir.path, 'pid')
+        start = time.time()
+        expect(lambda: self.sh.sh('-c', 'sleep 30 & echo $! > %s; wait' % pidfile, _timeout=0.5)) \
+            .raises(sh.TimeoutException)
+        expect(time.time() - start < 10) == True
+        expect(is_running(int(tempdir.read('pid')))) == False
+    
+    def test_should_run_awaited_commands_concurrently(self):
+        async def run():
+            return [str(result) for result in await asyncio.gather(
+                self.sh.echo.run('a'), self.sh.echo.run('b'))]
+        expect(self.sh.executor.submit(run()).result()) == ['a\n', 'b\n']
+    
+    def test_should_run_dump_in_worker_thread_for_async_dump(self):
+        mock_sh = MagicMock()
+        dump = MySQLDump(None, dict(), sh=mock_sh)
+        dump.dump = MagicMock()
+        asyncio.run(dump.async_dump())
+        expect(dump.dump.call_count) == 1
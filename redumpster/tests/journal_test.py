@@ -0,0 +1,78 @@
+from ..journal import *
+from ..data_interfaces import NoOp
+
+from os.path import join, exists
+
+from pyexpect import expect
+import unittest
+from testfixtures import tempdir
+
+class JournalTest(unittest.TestCase):
+
+    def _dump(self, journal, interface):
+        journal.running(interface)
+        interface.dump()
+        interface.write_dump_config()
+        journal.done(interface)
+    
+    @tempdir()
+    def test_should_record_last_state_per_interface(self, tempdir):
+        journal = Journal(tempdir.path)
+        first, second = NoOp(join(tempdir.path, 'first'), dict()), NoOp(join(tempdir.path, 'second'), dict())
+        journal.pending([first, second])
+        self._dump(journal, first)
+        journal.running(second)
+        journal.failed(second, RuntimeError('fnord'))
+        
+        states = journal.states()
+        expect(states['first']['state']) == DONE
+        expect(states['first']['size']) == 0
+        expect(states['first']['sha256']).has_length(64)
+        expect(states['second']['state']) == FAILED
+        expect(states['second']['error']) == 'fnord'
+    
+    @tempdir()
+    def test_should_resume_with_incomplete_interfaces_only(self, tempdir):
+        journal = Journal(tempdir.path)
+        interfaces = [NoOp(join(tempdir.path, name), dict()) for name in ('done', 'failed', 'running', 'tampered')]
+        done, failed, running, tampered = interfaces
+        journal.pending(interfaces)
+        self._dump(journal, done)
+        self._dump(journal, tampered)
+        tempdir.write('tampered/manifest.jsonl', b'{"path": "fnord", "size": 5}\n')
+        journal.running(failed)
+        tempdir.write('failed/dump.sql', b'partial')
+        journal.failed(failed, RuntimeError('fnord'))
+        journal.running(running)
+        # killed while writing the next line
+        with open(journal.path, 'a') as stream:
+            stream.write('{"backup_name": "run')
+        
+        remaining = journal.resume(interfaces)
+        expect([interface.backup_name for interface in remaining]) == ['failed', 'running', 'tampered']
+        expect(exists(join(tempdir.path, 'done', 'dump.conf'))) == True
+        expect(exists(join(tempdir.path, 'failed'))) == False
+        expect(exists(join(tempdir.path, 'tampered'))) == False
+    
+    @tempdir()
+    def test_should_resume_after_repeated_crashes(self, tempdir):
+        def crash(journal):
+            with open(journal.path, 'a') as stream:
+                stream.write('{"backup_name": "sec')
+        
+        interfaces = [NoOp(join(tempdir.path, name), dict()) for name in ('first', 'second', 'third')]
+        first, second, third = interfaces
+        journal = Journal(tempdir.path)
+        journal.pending(interfaces)
+        self._dump(journal, first)
+        crash(journal)
+        
+        journal = Journal(tempdir.path)
+        remaining = journal.resume(interfaces)
+        expect([interface.backup_name for interface in remaining]) == ['second', 'third']
+        journal.pending(remaining)
+        self._dump(journal, second)
+        crash(journal)
+        
+        remaining = Journal(tempdir.path).resume(interfaces)
+        expect([interface.backup_name for interface in remaining]) == ['third']
@@ -0,0 +1,87 @@
+from ..manifest import *
+from ..sql_dumps import MySQLDump
+
+from os.path import join
+import hashlib
+import os
+
+from pyexpect import expect
+import unittest
+from testfixtures import tempdir
+from unittest.mock import MagicMock
+
+
+def write(path, content):
+    with open(path, 'wb') as f:
+        f.write(content)
+
+class ManifestWriterTest(unittest.TestCase):
+
+    @tempdir()
+    def test_should_hash_streams_while_writing(self, tempdir):
+        manifest = ManifestWriter(tempdir.path)
+        with manifest.open_stream(join(tempdir.path, 'dump.sql')) as out:
+            out.write(b'hello ')
+            out.write(b'world')
+        manifest.close()
+        
+        entries = list(read_manifest(tempdir.path))
+        expect(entries).has_length(1)
+        expect(entries[0]).has_subdict(
+            path='dump.sql', size=11,
+            sha256=hashlib.sha256(b'hello world').hexdigest(),
+        )
+    
+    @tempdir()
+    def test_should_reuse_hashes_of_unchanged_files(self, tempdir):
+        previous = join(tempdir.path, 'previous')
+        current = join(tempdir.path, 'current')
+        for directory in (previous, current):
+            os.makedirs(join(directory, 'a'))
+            write(join(directory, 'a', 'unchanged'), b'same')
+            write(join(directory, 'changed'), b'old')
+            os.utime(join(directory, 'a', 'unchanged'), ns=(23, 23))
+        write(join(current, 'changed'), b'new')
+        write(join(current, 'dump.conf'), b'not part of the dump')
+        
+        manifest = ManifestWriter(previous)
+        manifest.add_tree(previous)
+        manifest.close()
+        # pretend the content changed without changing size or mtime, the hash must be reused
+        write(join(current, 'a', 'unchanged'), b'SAME')
+        os.utime(join(current, 'a', 'unchanged'), ns=(23, 23))
+        
+        manifest = ManifestWriter(current)
+        manifest.add_tree(current, read_manifest(previous))
+        manifest.close()
+        
+        entries = list(read_manifest(current))
+        expect([entry['path'] for entry in entries]) == ['changed', 'a/unchanged']
+        expect(entries[0]['sha256']) == hashlib.sha256(b'new').hexdigest()
+        expect(entries[1]['sha256']) == hashlib.sha256(b'same').hexdigest()
+    
+    @tempdir()
+    def test_should_only_hash_regular_files(self, tempdir):
+        write(join(tempdir.path, 'data'), b'data')
+        os.symlink('data', join(tempdir.path, 'link'))
+        os.mkfifo(join(tempdir.path, 'pipe'))
+        
+        manifest = ManifestWriter(tempdir.path)
+        manifest.add_tree(tempdir.path)
+        manifest.close()
+        expect([entry['path'] for entry in read_manifest(tempdir.path)]) == ['data']
+    
+    @tempdir()
+    def test_should_write_manifest_while_dumping(self, tempdir):
+        sh = MagicMock()
+        sh.mysqldump.side_effect = lambda *args, **kwargs: kwargs['_out'].write(b'CREATE TABLE fnord;')
+        dump = MySQLDump(tempdir.path, dict(), sh=sh)
+        dump.dump()
+        dump.write_dump_config()
+        
+        entries = list(read_manifest(tempdir.path))
+        expect(entries).has_length(1)
+        expect(entries[0]).has_subdict(
+            path='dump.sql', size=19,
+            sha256=hashlib.sha256(b'CREATE TABLE fnord;').hexdigest(),
+        )
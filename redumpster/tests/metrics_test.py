@@ -0,0 +1,51 @@
+from ..metrics import *
+
+from os.path import join
+import json
+import sh
+
+from pyexpect import expect
+import unittest
+from testfixtures import tempdir
+
+
+class MetricsTest(unittest.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.metrics = Metrics()
+    
+    @tempdir()
+    def test_should_measure_size_and_child_usage_of_stage(self, tempdir):
+        tempdir.write('dump.sql', b'CREATE TABLE fnord;')
+        with self.metrics.measure('mysql-fnord', 'dump', tempdir.path, 'mysql'):
+            sh.true()
+        
+        entry, = self.metrics.stages
+        expect(entry).has_subdict(backup_name='mysql-fnord', stage='dump', interface='mysql',
+            bytes=19, files=1, success=1, exit_status=0)
+        expect(entry['seconds'] > 0) == True
+        expect(entry['child_cpu_seconds'] >= 0) == True
+    
+    def test_should_record_exit_status_of_failed_stage(self):
+        def fail():
+            with self.metrics.measure('mysql-fnord', 'restore'):
+                sh.false()
+        expect(fail).raises(sh.ErrorReturnCode)
+        
+        expect(self.metrics.stages[0]).has_subdict(success=0, exit_status=1, bytes=None)
+        expect(self.metrics.summary()['failed']) == 1
+    
+    @tempdir()
+    def test_should_write_json_and_prometheus_textfile(self, tempdir):
+        with self.metrics.measure('mysql-fnord', 'dump', interface='mysql'):
+            pass
+        self.metrics.write_json(join(tempdir.path, 'metrics.json'))
+        self.metrics.write_prometheus_textfile(join(tempdir.path, 'redumpster.prom'))
+        
+        summary = json.loads(tempdir.read('metrics.json').decode())
+        expect(summary['stages'][0]['backup_name']) == 'mysql-fnord'
+        text = tempdir.read('redumpster.prom').decode()
+        expect(text).contains('# TYPE redumpster_stage_duration_seconds gauge\n')
+        expect(text).contains('redumpster_stage_success{backup_name="mysql-fnord",interface="mysql",stage="dump"} 1\n')
+        expect(text).does_not.contain('redumpster_stage_bytes{')
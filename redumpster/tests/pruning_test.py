@@ -0,0 +1,115 @@
+from ..pruning import *
+
+from os.path import exists, join
+import os
+
+from pyexpect import expect
+import unittest
+from testfixtures import tempdir
+from unittest.mock import MagicMock
+
+def backup(day, hour=0, series='mysql-db'):
+    return '%s-2020-%s_%02d-00-00' % (series, day, hour)
+
+class RetentionPolicyTest(unittest.TestCase):
+
+    def test_should_keep_latest_backup_per_day(self):
+        names = [backup('03-01', 1), backup('03-01', 12), backup('03-02'), backup('03-03'), backup('03-04')]
+        plans, others = plan(names, RetentionPolicy(daily=2))
+        expect(plans) == {'mysql-db-': ([backup('03-03'), backup('03-04')],
+            [backup('03-01', 1), backup('03-01', 12), backup('03-02')])}
+        expect(others) == []
+    
+    def test_should_apply_rules_one_after_the_other(self):
+        # 2020-03-01 is a sunday, the last day of its ISO week
+        names = [backup('02-15'), backup('02-29'), backup('03-01'), backup('03-02'), backup('03-03')]
+        kept, pruned = plan(names, RetentionPolicy(daily=2, weekly=1, monthly=2))[0]['mysql-db-']
+        expect(kept) == [backup('02-29'), backup('03-01'), backup('03-02'), backup('03-03')]
+        expect(pruned) == [backup('02-15')]
+    
+    def test_should_plan_series_and_sessions_separately_and_keep_other_names(self):
+        names = [backup('03-01'), backup('03-02'), backup('03-01', series='mysql-db-replica'),
+            'session.2020-03-01_00-00-00', 'session.2020-03-02_00-00-00', 'journal.jsonl', backup('03-01') + '.old']
+        plans, others = plan(names, RetentionPolicy(daily=1))
+        expect(plans['mysql-db-'][1]) == [backup('03-01')]
+        expect(plans['mysql-db-replica-']) == ([backup('03-01', series='mysql-db-replica')], [])
+        expect(plans['session.'][1]) == ['session.2020-03-01_00-00-00']
+        expect(others) == ['journal.jsonl', backup('03-01') + '.old']
+    
+    def test_should_refuse_to_keep_nothing(self):
+        expect(lambda: RetentionPolicy()).to_raise(AssertionError)
+
+
+class DirectoryPrunerTest(unittest.TestCase):
+
+    def make_backups(self, tempdir):
+        tempdir.write(join(backup('03-01'), 'only_in_old'), b'x' * 10000)
+        tempdir.write(join(backup('03-01'), 'nested', 'shared'), b'y' * 10000)
+        tempdir.write(join(backup('03-02'), 'dump.conf'), b'')
+        tempdir.makedir(join(backup('03-02'), 'nested'))
+        os.link(tempdir.getpath(join(backup('03-01'), 'nested', 'shared')),
+            tempdir.getpath(join(backup('03-02'), 'nested', 'shared')))
+        tempdir.write('unrelated', b'')
+    
+    @tempdir()
+    def test_should_only_report_in_dry_run(self, tempdir):
+        self.make_backups(tempdir)
+        result = DirectoryPruner(tempdir.path, RetentionPolicy(daily=1)).prune(dry_run=True)
+        expect(result.kept) == [backup('03-02')]
+        expect(result.pruned) == [backup('03-01')]
+        # the hard linked file stays with the kept backup
+        only_in_old = os.lstat(tempdir.getpath(join(backup('03-01'), 'only_in_old'))).st_blocks * 512
+        directories = sum(os.lstat(tempdir.getpath(path)).st_blocks * 512
+            for path in (backup('03-01'), join(backup('03-01'), 'nested')))
+        expect(result.reclaimable_bytes) == only_in_old + directories
+        expect(exists(tempdir.getpath(backup('03-01')))).is_true()
+    
+    @tempdir()
+    def test_should_remove_pruned_backups(self, tempdir):
+        self.make_backups(tempdir)
+        catalog = MagicMock()
+        result = DirectoryPruner(tempdir.path, RetentionPolicy(daily=1), jobs=3, catalog=catalog).prune()
+        expect(result.pruned) == [backup('03-01')]
+        expect(sorted(os.listdir(tempdir.path))) == [backup('03-02'), 'unrelated']
+        expect(open(tempdir.getpath(join(backup('03-02'), 'nested', 'shared')), 'rb').read()) == b'y' * 10000
+        catalog.forget.assert_called_once_with(tempdir.path, backup('03-01'))
+    
+    @tempdir()
+    def test_should_finish_interrupted_prunes(self, tempdir):
+        tempdir.write(join(PRUNING_PREFIX + backup('03-01'), 'half', 'removed'), b'')
+        tempdir.makedir(backup('03-02'))
+        DirectoryPruner(tempdir.path, RetentionPolicy(daily=1)).prune()
+        expect(os.listdir(tempdir.path)) == [backup('03-02')]
+
+
+class AtticPrunerTest(unittest.TestCase):
+
+    def attic(self, archives):
+        sh = MagicMock()
+        sh.attic.side_effect = lambda command, *arguments: '\n'.join(
+            '%s  Sun Mar  1 00:00:00 2020' % name for name in archives) if command == 'list' else ''
+        return sh
+    
+    def test_should_prune_series_with_attic_prune(self):
+        sh = self.attic([backup('03-01'), backup('03-02'), 'session.2020-03-01_00-00-00'])
+        result = AtticPruner('/repository', RetentionPolicy(daily=1, monthly=3), sh=sh).prune()
+        expect(result.pruned) == [backup('03-01')]
+        expect(result.reclaimable_bytes).is_none()
+        sh.attic.assert_any_call('prune', '/repository', '--prefix=mysql-db-', '--keep-daily=1', '--keep-monthly=3')
+        expect(sh.attic.call_count) == 2
+    
+    def test_should_delete_archives_of_series_sharing_a_prefix(self):
+        sh = self.attic([backup('03-01'), backup('03-02'), backup('03-01', series='mysql-db-replica')])
+        AtticPruner('/repository', RetentionPolicy(daily=1), sh=sh).prune()
+        sh.attic.assert_called_with('delete', '/repository::' + backup('03-01'))
+    
+    def test_should_not_touch_the_repository_in_dry_run(self):
+        sh = self.attic([backup('03-01'), backup('03-02')])
+        result = AtticPruner('/repository', RetentionPolicy(daily=1), sh=sh).prune(dry_run=True)
+        expect(result.pruned) == [backup('03-01')]
+        expect(sh.attic.call_count) == 1
+    
+    def test_should_report(self):
+        lines = format_report(PruneResult([backup('03-02')], [backup('03-01')], 1 << 30), dry_run=True)
+        expect(lines) == ['would prune ' + backup('03-01'),
+            'Would prune 1 of 2 backups, reclaimable: 1073741824 bytes (1.0 GiB)']
@@ -0,0 +1,61 @@
+from ..registry import *
+from ..sql_dumps import MySQLDump
+
+from os.path import dirname
+import subprocess
+import sys
+
+from pyexpect import expect
+import unittest
+from unittest.mock import patch, MagicMock
+
+# redumpster runs from many short cron jobs, its own imports must stay cheap
+IMPORT_TIME_BUDGET_MICROSECONDS = 100000
+DEFERRED_MODULES = ('sh', 'asyncio', 'importlib.metadata',
+    'redumpster.sql_dumps', 'redumpster.copy_directory', 'redumpster.copying', 'redumpster.throttle')
+REPOSITORY = dirname(dirname(dirname(__file__)))
+
+def import_main(*options):
+    return subprocess.run([sys.executable] + list(options) + ['-c',
+        'import sys, redumpster.main; print(" ".join(sorted(sys.modules)))'],
+        cwd=REPOSITORY, capture_output=True, text=True, check=True)
+
+class DataInterfaceRegistryTest(unittest.TestCase):
+
+    def test_should_load_builtin_interfaces_without_scanning_entry_points(self):
+        registry = DataInterfaceRegistry()
+        with patch('importlib.metadata.entry_points') as entry_points:
+            expect(registry['mysql']) == MySQLDump
+            expect('postgres' in registry) == True
+        expect(entry_points.called) == False
+    
+    def test_should_load_interfaces_from_entry_points(self):
+        entry_point = MagicMock(value='redumpster.sql_dumps:MySQLDump')
+        entry_point.name = 'mariadb'
+        registry = DataInterfaceRegistry()
+        with patch('importlib.metadata.entry_points', return_value=[entry_point]) as entry_points:
+            expect(registry['mariadb']) == MySQLDump
+            expect(list(registry)) == ['copydir', 'mariadb', 'mysql', 'noop', 'postgres']
+        entry_points.assert_called_once_with(group=ENTRY_POINT_GROUP)
+        expect(lambda: registry['fnord']).raises(KeyError)
+    
+    def test_should_still_import_builtin_interfaces_from_data_interfaces(self):
+        from .. import data_interfaces, copy_directory
+        expect(data_interfaces.MySQLDump) == MySQLDump
+        expect(data_interfaces.CopyDirectory) == copy_directory.CopyDirectory
+        expect(lambda: data_interfaces.fnord).raises(AttributeError)
+
+class StartupTest(unittest.TestCase):
+
+    def test_should_not_import_heavy_modules_on_startup(self):
+        modules = import_main().stdout.split()
+        for module in DEFERRED_MODULES:
+            expect(modules).does_not.contain(module)
+    
+    def test_should_import_within_budget(self):
+        def import_time():
+            lines = import_main('-X', 'importtime').stderr.splitlines()
+            line, = [line for line in lines if line.endswith('| redumpster.main')]
+            return int(line.split('|')[1])
+        # the best of a few runs, a busy machine shouldn't fail the test
+        expect(min(import_time() for _ in range(3)) < IMPORT_TIME_BUDGET_MICROSECONDS) == True
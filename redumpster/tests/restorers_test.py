@@ -6,7 +6,7 @@ from textwrap import dedent
 from pyexpect import expect
 import unittest
 from testfixtures import tempdir
-from unittest.mock import MagicMock
+from unittest.mock import MagicMock, patch
 
 
 '''
@@ -127,14 +127,14 @@ class RestoreFromAtticTest(unittest.TestCase):
         expect(args).has_length(2)
         expect(args[0]) == '-u'
         expect(args[1].endswith('/restore_from')) == True
-    
+
 
 from ..archivers import Archiver, AtticArchiver
 from nose.plugins.attrib import attr
 
 @attr('slow')
 class RoundTripIntegrationTest(unittest.TestCase):
-    
+
     def _assert_can_restore_file_with(self, archiver, restorer, tempdir):
         backup_dir = os.path.join(tempdir.path, 'backup_dir')
         actual_data = join(tempdir.path, 'actual_dir')
@@ -145,7 +145,7 @@ class RoundTripIntegrationTest(unittest.TestCase):
         
         archiver = archiver.with_data_interfaces(backup_dir,
             copydir=dict(source=actual_data, name='test'))
-
+        
         archiver.dump_all()
         archiver.commit()
         
@@ -166,7 +166,7 @@ class RoundTripIntegrationTest(unittest.TestCase):
         
         expect(os.path.exists(important_file)) == True
         expect(open(important_file).read()) == 'hello world'
-
+    
     @tempdir()
     def test_should_round_trip_on_directory(self, tempdir):
         self._assert_can_restore_file_with(
@@ -183,3 +183,127 @@ class RoundTripIntegrationTest(unittest.TestCase):
             tempdir=tempdir,
         )
 '''
+
+class AtticSessionRestoreTest(unittest.TestCase):
+
+    def test_should_restore_from_session(self):
+        sh = MagicMock()
+        def attic(command, *args, **kwargs):
+            if command == 'list':
+                return 'noop--2015-01-20_13-24-29  Tue Jan 20 15:24:49 2015\nsession.2015-01-20_14-24-29  Tue Jan 20 15:24:49 2015\n'
+            if command == 'extract' and args[1:] == ('session.json',):
+                with open('session.json', 'w') as index:
+                    index.write('["copydir-test-2015-01-20_14-24-29"]')
+        sh.attic.side_effect = attic
+        expect(RestoreFromAttic._backups_in_directory('/backup_dir', sh=sh)) == [
+            'copydir-test-2015-01-20_14-24-29', 'noop--2015-01-20_13-24-29']
+        
+        restorer = RestoreFromAttic('/backup_dir', 'copydir-test-2015-01-20_14-24-29', sh=sh)
+        restorer._restore_backup_to_tempdir(should_mount=False)
+        extract_calls = [call[0] for call in sh.attic.call_args_list if call[0][0] == 'extract']
+        expect(extract_calls[-2:]) == [
+            ('extract', '/backup_dir::session.2015-01-20_14-24-29', 'copydir-test-2015-01-20_14-24-29/dump.conf'),
+            ('extract', '/backup_dir::session.2015-01-20_14-24-29', 'copydir-test-2015-01-20_14-24-29'),
+        ]
+        expect(restorer.data_interface.directory.endswith('/restore_from/copydir-test-2015-01-20_14-24-29')) == True
+
+class RestoreStagingTest(unittest.TestCase):
+
+    def _backup(self, tempdir):
+        backup_dir = os.path.join(tempdir.path, 'noop--2015-01-20_16-24-29')
+        os.mkdir(backup_dir)
+        with open(os.path.join(backup_dir, 'dump.conf'), 'w') as dump_conf:
+            dump_conf.write('[options]\n  foo=bar\n')
+        return backup_dir
+    
+    @tempdir()
+    def test_should_restore_in_place_by_default(self, tempdir):
+        backup_dir = self._backup(tempdir)
+        restorer = RestoreFromDirectory(tempdir.path, 'noop--2015-01-20_16-24-29')
+        restorer.restore()
+        expect(restorer.data_interface.directory) == backup_dir
+        expect(restorer.data_interface.config['options']['foo']) == 'bar'
+    
+    @tempdir()
+    def test_should_hard_link_backup(self, tempdir):
+        backup_dir = self._backup(tempdir)
+        restorer = RestoreFromDirectory(tempdir.path, 'noop--2015-01-20_16-24-29', staging='hardlink')
+        restorer._restore_backup_to_tempdir()
+        expect(os.stat(os.path.join(backup_dir, 'dump.conf')).st_nlink) == 2
+    
+    @tempdir()
+    def test_should_copy_backup(self, tempdir):
+        backup_dir = self._backup(tempdir)
+        for staging in ('reflink', 'copy'):
+            restorer = RestoreFromDirectory(tempdir.path, 'noop--2015-01-20_16-24-29', staging=staging)
+            restorer.restore()
+            staged_dump_conf = os.path.join(restorer.data_interface.directory, 'dump.conf')
+            expect(restorer.data_interface.directory) != backup_dir
+            expect(os.stat(staged_dump_conf).st_nlink) == 1
+            expect(open(staged_dump_conf).read()) == '[options]\n  foo=bar\n'
+    
+    @tempdir()
+    def test_should_not_share_inodes_with_writing_restores(self, tempdir):
+        backup_dir = self._backup(tempdir)
+        dump_conf = os.path.join(backup_dir, 'dump.conf')
+        inode = os.stat(dump_conf).st_ino
+        def restore(data_interface):
+            with open(os.path.join(data_interface.directory, 'dump.conf'), 'r+') as staged:
+                staged.write('[fnord]')
+        
+        with patch.object(NoOp, 'RESTORE_READS_ONLY', False), patch.object(NoOp, 'restore', restore):
+            restorer = RestoreFromDirectory(tempdir.path, 'noop--2015-01-20_16-24-29')
+            restorer.restore()
+        
+        expect(restorer.data_interface.directory) != backup_dir
+        expect(os.stat(dump_conf).st_ino) == inode
+        expect(os.stat(dump_conf).st_nlink) == 1
+        expect(open(dump_conf).read()) == '[options]\n  foo=bar\n'
+    
+    @tempdir()
+    def test_should_only_reflink_writing_restores_on_the_same_file_system(self, tempdir):
+        restorer = RestoreFromDirectory(tempdir.path, 'noop--2015-01-20_16-24-29')
+        with patch.object(NoOp, 'RESTORE_READS_ONLY', False):
+            with patch('redumpster.restorers.same_file_system', return_value=True):
+                expect(restorer._staging_strategy()) == 'reflink'
+            with patch('redumpster.restorers.same_file_system', return_value=False):
+                expect(restorer._staging_strategy()) == 'copy'
+    
+    def test_should_reject_unknown_staging_strategy(self):
+        expect(lambda: RestoreFromDirectory('.', 'noop--2015-01-20_16-24-29', staging='fnord')).raises(AssertionError)
+
+class RestoreFromAtticExtractionTest(unittest.TestCase):
+
+    def _extracted_paths(self, sh):
+        return [call[0][2:] for call in sh.attic.call_args_list if call[0][0] == 'extract']
+    
+    def test_should_only_extract_dump_config_for_noop(self):
+        sh = MagicMock()
+        attic = RestoreFromAttic('/backup_dir', 'noop--2015-01-20_13-24-29', sh=sh)
+        attic._restore_backup_to_tempdir(should_mount=False)
+        expect(self._extracted_paths(sh)) == [('dump.conf',)]
+    
+    def test_should_only_extract_dump_needed_by_interface(self):
+        sh = MagicMock()
+        attic = RestoreFromAttic('/backup_dir', 'mysql-shop-2015-01-20_13-24-29', sh=sh)
+        def extract(command, source, *paths):
+            if paths == ('dump.conf',):
+                with open('dump.conf', 'w') as dump_conf:
+                    dump_conf.write('[options]\n  compression=zstd\n')
+        sh.attic.side_effect = extract
+        attic._restore_backup_to_tempdir(should_mount=False)
+        expect(self._extracted_paths(sh)) == [('dump.conf',), ('dump.sql.zst',)]
+    
+    def test_should_extract_everything_for_directory_copies(self):
+        sh = MagicMock()
+        attic = RestoreFromAttic('/backup_dir', 'copydir-uploads-2015-01-20_13-24-29', sh=sh)
+        attic._restore_backup_to_tempdir(should_mount=False)
+        expect(self._extracted_paths(sh)) == [('dump.conf',), ()]
+    
+    @tempdir()
+    def test_should_wait_until_mounted(self, tempdir):
+        attic = RestoreFromAttic('/backup_dir', 'noop--2015-01-20_13-24-29', sh=MagicMock(), mount_timeout=0.2)
+        expect(lambda: attic._wait_until_mounted(tempdir.path)).raises(AtticMountError)
+        
+        open(os.path.join(tempdir.path, 'dump.conf'), 'w').close()
+        attic._wait_until_mounted(tempdir.path)
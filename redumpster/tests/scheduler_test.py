@@ -0,0 +1,70 @@
+from ..scheduler import *
+from ..data_interfaces import NoOp
+
+import threading
+import time
+
+from pyexpect import expect
+import unittest
+
+
+class SchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.lock = threading.Lock()
+        self.running = dict()
+        self.max_running = dict()
+    
+    def _interface(self, name, **options):
+        return NoOp('container/%s' % name, options)
+    
+    def _track(self, interface):
+        group = interface.concurrency_group()
+        with self.lock:
+            self.running[group] = self.running.get(group, 0) + 1
+            self.running['total'] = self.running.get('total', 0) + 1
+            for key in (group, 'total'):
+                self.max_running[key] = max(self.max_running.get(key, 0), self.running[key])
+        time.sleep(0.05)
+        with self.lock:
+            self.running[group] -= 1
+            self.running['total'] -= 1
+    
+    def test_should_run_all_interfaces_in_order_with_one_job(self):
+        called = []
+        interfaces = [self._interface(name) for name in ('a', 'b', 'c')]
+        failures = Scheduler(jobs=1).run(interfaces, lambda interface: called.append(interface.backup_name))
+        expect(failures) == dict()
+        expect(called) == ['a', 'b', 'c']
+    
+    def test_should_run_interfaces_concurrently(self):
+        interfaces = [self._interface(name) for name in 'abcdef']
+        Scheduler(jobs=3).run(interfaces, self._track)
+        expect(self.max_running['total']) == 3
+    
+    def test_should_limit_concurrency_per_group(self):
+        interfaces = [self._interface(name, dump_command_prefix='ssh db1') for name in 'abcd']
+        interfaces += [self._interface(name, dump_command_prefix='ssh db2') for name in 'efgh']
+        Scheduler(jobs=8, group_limit=2).run(interfaces, self._track)
+        expect(self.max_running['ssh db1']) == 2
+        expect(self.max_running['ssh db2']) == 2
+        expect(self.max_running['total']) == 4
+    
+    def test_should_prefer_interface_concurrency_limit(self):
+        interfaces = [self._interface(name, concurrency_group='db', concurrency_limit='1') for name in 'abc']
+        Scheduler(jobs=3, group_limit=3).run(interfaces, self._track)
+        expect(self.max_running['db']) == 1
+    
+    def test_should_collect_failures_and_continue(self):
+        called = []
+        def action(interface):
+            called.append(interface.backup_name)
+            if interface.backup_name == 'b':
+                raise ValueError('fnord')
+        
+        interfaces = [self._interface(name) for name in ('a', 'b', 'c')]
+        failures = Scheduler(jobs=2).run(interfaces, action)
+        expect(sorted(called)) == ['a', 'b', 'c']
+        expect(list(failures.keys())) == ['b']
+        expect(failures['b']).isinstance(ValueError)
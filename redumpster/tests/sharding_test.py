@@ -0,0 +1,70 @@
+from ..sharding import *
+from ..copy_directory import CopyDirectory
+
+from os.path import join
+
+from pyexpect import expect
+import unittest
+from testfixtures import tempdir
+from unittest.mock import MagicMock
+
+STATS = """
+Number of files: 1,234 (reg: 1,000, dir: 234)
+Number of regular files transferred: 10
+Total transferred file size: 1,048,576 bytes
+File list generation time: 0.5 seconds
+
+sent 1,049,000 bytes  received 200 bytes  699,466.67 bytes/sec
+"""
+
+class PartitionTreeTest(unittest.TestCase):
+
+    @tempdir()
+    def test_should_split_large_directories_into_balanced_shards(self, tempdir):
+        tempdir.write('big/a', b'x' * 400)
+        tempdir.write('big/b', b'x' * 300)
+        tempdir.write('big/nested/c', b'x' * 300)
+        tempdir.write('small', b'x' * 100)
+        tempdir.write('dump.conf', b'x' * 1000)
+        shards = partition_tree(tempdir.path, 3, exclude=['dump.conf'])
+        expect(shards) == [['big/a'], ['big/b', 'small'], ['big/nested']]
+    
+    @tempdir()
+    def test_should_split_by_top_level_entries(self, tempdir):
+        for name in 'abcde':
+            tempdir.write(name, b'')
+        expect(partition_tree(tempdir.path, 2, by='top')) == [['a', 'c', 'e'], ['b', 'd']]
+        expect(partition_tree(tempdir.path, 10, by='top')) == [['a'], ['b'], ['c'], ['d'], ['e']]
+    
+    def test_should_merge_rsync_stats(self):
+        stats = parse_rsync_stats(STATS)
+        expect(stats) == dict(number_of_files=1234, number_of_regular_files_transferred=10,
+            total_transferred_file_size=1048576, file_list_generation_time=0.5)
+        expect(merge_stats([stats, stats])['number_of_regular_files_transferred']) == 20
+
+class ShardedCopyDirectoryTest(unittest.TestCase):
+
+    @tempdir()
+    def test_should_copy_shards_and_delete_for_the_whole_tree(self, tempdir):
+        for name in ('a', 'b', 'c'):
+            tempdir.write(join('production', name), b'x' * 100)
+        file_lists = []
+        def rsync(*args, **kwargs):
+            file_list, = [arg[len('--files-from='):] for arg in args if arg.startswith('--files-from=')] or [None]
+            if file_list is not None:
+                with open(file_list, 'rb') as stream:
+                    file_lists.append(stream.read().split(b'\0')[:-1])
+            return STATS
+        sh = MagicMock()
+        sh.rsync.side_effect = rsync
+        dump = CopyDirectory(directory=join(tempdir.path, 'backup'), options=dict(
+            source=join(tempdir.path, 'production'), shards='2', previous_dumps=''), sh=sh)
+        
+        dump.dump()
+        expect(sorted(file_lists)) == [[b'a', b'c'], [b'b']]
+        *shard_calls, delete_call = sh.rsync.call_args_list
+        for call in shard_calls:
+            expect(call[1]).has_subdict(recursive=True, archive=True, stats=True)
+            expect(call[1]).does_not.contain('delete_after')
+        expect(delete_call[0]) == (join(tempdir.path, 'production') + '/', join(tempdir.path, 'backup'))
+        expect(delete_call[1]) == dict(recursive=True, delete_after=True, existing=True, ignore_existing=True, stats=True)
@@ -0,0 +1,39 @@
+from ..tags import *
+
+from pyexpect import expect
+import unittest
+
+class TagExpressionTest(unittest.TestCase):
+
+    def test_should_parse_with_precedence(self):
+        expect(parse_tag_expression('a or b and not c')) == \
+            ('or', ('tag', 'a'), ('and', ('tag', 'b'), ('not', ('tag', 'c'))))
+        expect(parse_tag_expression('(a or b) and c')) == \
+            ('and', ('or', ('tag', 'a'), ('tag', 'b')), ('tag', 'c'))
+    
+    def test_should_reject_broken_expressions(self):
+        for expression in ('', 'a and', '(a or b', 'a b', 'not', 'a )'):
+            expect(lambda: parse_tag_expression(expression)).raises(TagExpressionError)
+    
+    def test_should_match_globs(self):
+        expect(matches(parse_tag_expression('tenant-* and not staging'), ['db', 'tenant-42'])) == True
+        expect(matches(parse_tag_expression('tenant-* and not staging'), ['staging', 'tenant-42'])) == False
+
+class TagIndexTest(unittest.TestCase):
+
+    def test_should_select_positions_in_order(self):
+        index = TagIndex([('db', 'tenant-1'), ('db', 'staging'), ('web',), ()])
+        expect(index.select('')) == range(4)
+        expect(index.select('db')) == [0, 1]
+        expect(index.select('db and not staging')) == [0]
+        expect(index.select('tenant-* or web')) == [0, 2]
+        expect(index.select('not db')) == [2, 3]
+        expect(index.select('fnord')) == []
+    
+    def test_should_agree_with_matches(self):
+        sections = [('db', 'tenant-1'), ('db', 'staging'), ('web', 'tenant-2'), ()]
+        index = TagIndex(sections)
+        for expression in ('db or web and tenant-*', 'not (db or tenant-?)', 'tenant-[12] and not db'):
+            node = parse_tag_expression(expression)
+            expect(index.select(expression)) == \
+                [position for position, tags in enumerate(sections) if matches(node, tags)]
@@ -0,0 +1,93 @@
+from ..throttle import *
+
+from pyexpect import expect
+import unittest
+from testfixtures import tempdir
+from unittest.mock import MagicMock, patch
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.0
+    
+    def __call__(self):
+        return self.now
+    
+    def sleep(self, seconds):
+        self.now += seconds
+
+class ResourcePolicyTest(unittest.TestCase):
+
+    def test_should_parse_options(self):
+        policy = ResourcePolicy.from_options(dict(
+            ionice_class='best-effort', ionice_level='7', nice='10', rate_limit='1.5M', mysql_user='fnord'))
+        expect(policy.command_prefix()) == ['ionice', '-c', '2', '-n', '7', 'nice', '-n', '10']
+        expect(policy.rate_limit) == 3 << 19
+        expect(policy.rsync_arguments()) == ['--bwlimit=1536']
+        expect(parse_rate('500k')) == 500 << 10
+        expect(lambda: parse_rate('fast')).raises(ValueError)
+        expect(lambda: ResourcePolicy.from_options(dict(ionice_class='fnord'))).raises(ValueError)
+    
+    def test_should_not_wrap_without_policy(self):
+        sh = MagicMock()
+        policy = ResourcePolicy.from_options(dict())
+        expect(policy.wrap(sh)).is_(sh)
+        expect(policy.throttle()).is_none()
+    
+    @tempdir()
+    def test_should_run_commands_in_cgroup(self, tempdir):
+        tempdir.write('cgroup.controllers', b'cpu io memory\n')
+        sh = MagicMock()
+        policy = ResourcePolicy.from_options(dict(nice='19', cgroup='backup/redumpster'))
+        with patch('redumpster.throttle.CGROUP_ROOT', tempdir.path):
+            policy.wrap(sh).mysqldump('--all-databases')
+        sh.Command.assert_called_once_with('nice')
+        sh.Command('nice').bake.assert_called_once_with('-n', '19', 'mysqldump')
+        (preexec_fn,), = [call[1].values() for call in sh.Command('nice').bake().bake.call_args_list]
+        preexec_fn()
+        expect(tempdir.read('backup/redumpster/cgroup.procs')) == str(os.getpid()).encode()
+
+class RateLimiterTest(unittest.TestCase):
+
+    def test_should_hold_writes_to_rate(self):
+        clock = FakeClock()
+        limiter = RateLimiter(1000, clock=clock, sleep=clock.sleep)
+        for _ in range(10):
+            limiter.throttle(500)
+        expect(clock.now) == 5.0
+        limiter.rate = None
+        limiter.throttle(10 ** 9)
+        expect(clock.now) == 5.0
+        expect(limiter.observed_rate) == 1000.0
+
+class LatencyGovernorTest(unittest.TestCase):
+
+    def test_should_back_off_and_recover(self):
+        limiter = RateLimiter(None)
+        limiter.observed_rate = 80 << 20
+        governor = LatencyGovernor(limiter, 'probe', ceiling=None, floor=10 << 20)
+        governor.adjust(True)
+        expect(limiter.rate) == 40 << 20
+        governor.adjust(True)
+        governor.adjust(True)
+        expect(limiter.rate) == 10 << 20
+        for _ in range(20):
+            governor.adjust(False)
+        expect(limiter.rate).is_none()
+    
+    def test_should_read_latency_from_probe(self):
+        governor = LatencyGovernor(RateLimiter(), ['echo', '42.5'], threshold=50)
+        expect(governor.is_degraded()) == False
+        governor.threshold = 40
+        expect(governor.is_degraded()) == True
+        expect(LatencyGovernor(RateLimiter(), 'false').is_degraded()) == True
+    
+    def test_should_only_probe_while_streams_are_open(self):
+        governor = MagicMock()
+        throttle = Throttle(RateLimiter(), governor)
+        first, second = throttle.open(MagicMock()), throttle.open(MagicMock())
+        governor.start.assert_called_once_with()
+        first.close()
+        expect(governor.stop.called) == False
+        second.close()
+        second.close()
+        governor.stop.assert_called_once_with()
@@ -0,0 +1,79 @@
+from ..verification import *
+from ..manifest import ManifestWriter
+
+from os.path import join
+import hashlib
+import os
+
+from pyexpect import expect
+import unittest
+from testfixtures import tempdir
+from unittest.mock import patch, MagicMock
+
+def make_dump(tempdir, name, files):
+    directory = tempdir.makedir(name)
+    for path, content in files.items():
+        tempdir.write(join(name, path), content)
+    manifest = ManifestWriter(directory)
+    manifest.add_tree(directory)
+    manifest.close()
+    tempdir.write(join(name, 'dump.conf'), b'')
+    return directory
+
+class HashMappedTest(unittest.TestCase):
+
+    @tempdir()
+    def test_should_hash_in_blocks_through_the_limiter(self, tempdir):
+        content = os.urandom(1000)
+        path = tempdir.write('data', content)
+        limiter = MagicMock()
+        with patch('redumpster.verification.VERIFY_BLOCK_SIZE', 300):
+            expect(hash_mapped(path, limiter)) == hashlib.sha256(content).hexdigest()
+        expect([each[0][0] for each in limiter.throttle.call_args_list]) == [300, 300, 300, 100]
+        expect(hash_mapped(tempdir.write('empty', b''))) == hashlib.sha256(b'').hexdigest()
+
+
+class VerifierTest(unittest.TestCase):
+
+    @tempdir()
+    def test_should_find_missing_and_corrupt_files(self, tempdir):
+        directory = make_dump(tempdir, 'mysql-db-2020-03-01_00-00-00',
+            {'ok.sql': b'fine', 'nested/flipped.sql': b'abcd', 'truncated.sql': b'long', 'gone.sql': b''})
+        tempdir.write(join(directory, 'nested', 'flipped.sql'), b'abce')
+        tempdir.write(join(directory, 'truncated.sql'), b'lo')
+        os.unlink(join(directory, 'gone.sql'))
+        
+        result, = Verifier(jobs=2, cache_directory=tempdir.getpath('cache')).verify([directory])
+        expect(result.ok).is_false()
+        expect(result.missing) == ['gone.sql']
+        expect(sorted(result.corrupt)) == ['nested/flipped.sql', 'truncated.sql']
+        expect(result.files) == 4
+        expect(result.report()[-1]).to_contain('FAILED')
+    
+    @tempdir()
+    def test_should_only_hash_files_changed_since_the_last_verification(self, tempdir):
+        directory = make_dump(tempdir, 'mysql-db-2020-03-01_00-00-00', {'a.sql': b'aaaa', 'b.sql': b'bb'})
+        verifier = Verifier(jobs=1, cache_directory=tempdir.getpath('cache'))
+        first, = verifier.verify([directory])
+        expect(first.ok).is_true()
+        expect((first.cached, first.hashed_bytes)) == (0, 6)
+        
+        os.utime(join(directory, 'b.sql'), ns=(0, 0))
+        second, = verifier.verify([directory])
+        expect((second.cached, second.hashed_bytes)) == (1, 2)
+        
+        full, = Verifier(jobs=1, cache_directory=tempdir.getpath('cache'), full=True).verify([directory])
+        expect((full.cached, full.hashed_bytes)) == (0, 6)
+    
+    @tempdir()
+    def test_should_verify_containers_of_dumps(self, tempdir):
+        make_dump(tempdir, join('container', 'mysql-db-2020-03-01_00-00-00'), {'dump.sql': b'data'})
+        tempdir.makedir(join('container', 'mysql-db-2020-03-02_00-00-00'))
+        tempdir.makedir(join('container', '.prune-mysql-db-2020-02-01_00-00-00'))
+        directories = dump_directories(tempdir.getpath('container'))
+        expect(directories) == [tempdir.getpath(join('container', name))
+            for name in ('mysql-db-2020-03-01_00-00-00', 'mysql-db-2020-03-02_00-00-00')]
+        
+        results = Verifier(jobs=1, cache_directory=None).verify(directories)
+        expect([result.ok for result in results]) == [True, False]
+        expect(results[1].missing) == [MANIFEST_FILE]
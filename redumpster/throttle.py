@@ -0,0 +1,331 @@
+"""
+Keeps dumps from hurting the production systems they read from.
+
+Every data interface can set these options in its config section:
+
+    ionice_class = idle             # or best-effort, realtime, or 1 to 3
+    ionice_level = 7                # 0 (highest) to 7, not for idle
+    nice = 19
+    rate_limit = 20M                # bytes per second written to the dump, k, M and G are powers of 1024
+    cgroup = backup.slice/redumpster  # a cgroup v2 below /sys/fs/cgroup to run the tools in
+    latency_probe = /usr/local/bin/p99-latency-ms
+    latency_threshold = 50          # the probe prints a number, above this the dump backs off
+    latency_probe_interval = 10     # seconds
+    min_rate_limit = 1M             # backing off never goes below this
+
+ionice and nice prefix the tools. With a dump_command_prefix they are added after it,
+so they apply to the tools on the database host. The cgroup only applies to local tools.
+
+With a latency probe, the rate of the dump stream follows the probe: it is halved
+whenever the probe exits with an error or prints a latency above the threshold, and
+grows back (up to rate_limit, if set) while it doesn't.
+"""
+
+from collections import namedtuple
+from contextlib import contextmanager
+from logging import getLogger
+from os.path import join, isfile
+import os
+import re
+import shlex
+import subprocess
+import threading
+import time
+
+CGROUP_ROOT = '/sys/fs/cgroup'
+IONICE_CLASSES = {'realtime': 1, 'best-effort': 2, 'best_effort': 2, 'idle': 3, '1': 1, '2': 2, '3': 3}
+RATE = re.compile(r'^\s*(\d+(?:\.\d+)?)\s*([kmg]?)i?b?\s*$', re.IGNORECASE)
+RATE_UNITS = {'': 1, 'k': 1 << 10, 'm': 1 << 20, 'g': 1 << 30}
+# chunks written through a rate limited stream, small enough to keep the rate smooth
+THROTTLED_BUFFER_SIZE = 1 << 16
+DEFAULT_PROBE_INTERVAL = 10
+DEFAULT_MIN_RATE = 1 << 20
+BACK_OFF_FACTOR = 0.5
+RECOVERY_FACTOR = 1.25
+
+def parse_rate(value):
+    # bytes per second, None for no limit
+    if value is None or str(value).strip() == '':
+        return None
+    match = RATE.match(str(value))
+    if match is None:
+        raise ValueError("Can't parse rate %r, expected e.g. 500k or 20M" % value)
+    return int(float(match.group(1)) * RATE_UNITS[match.group(2).lower()])
+
+def _option(options, name):
+    value = options.get(name)
+    if value is None or str(value).strip() == '':
+        return None
+    return str(value).strip()
+
+def cgroup_v2_available(root):
+    return isfile(join(root, 'cgroup.controllers'))
+
+def _join_cgroup(path):
+    # runs in the child between fork and exec, so the tool and everything it starts
+    # is accounted to the cgroup from the start
+    with open(join(path, 'cgroup.procs'), 'w') as procs:
+        procs.write(str(os.getpid()))
+
+
+class ResourcePolicy(namedtuple('ResourcePolicy',
+        'ionice_class ionice_level nice rate_limit cgroup latency_probe latency_threshold probe_interval min_rate')):
+    __slots__ = ()
+    
+    @classmethod
+    def from_options(cls, options):
+        ionice_class = _option(options, 'ionice_class')
+        if ionice_class is not None:
+            if ionice_class.lower() not in IONICE_CLASSES:
+                raise ValueError("Unknown ionice_class %r" % ionice_class)
+            ionice_class = IONICE_CLASSES[ionice_class.lower()]
+        as_int = lambda value: None if value is None else int(value)
+        as_float = lambda value: None if value is None else float(value)
+        return cls(
+            ionice_class=ionice_class,
+            ionice_level=as_int(_option(options, 'ionice_level')),
+            nice=as_int(_option(options, 'nice')),
+            rate_limit=parse_rate(_option(options, 'rate_limit')),
+            cgroup=_option(options, 'cgroup'),
+            latency_probe=_option(options, 'latency_probe'),
+            latency_threshold=as_float(_option(options, 'latency_threshold')),
+            probe_interval=as_float(_option(options, 'latency_probe_interval')) or DEFAULT_PROBE_INTERVAL,
+            min_rate=parse_rate(_option(options, 'min_rate_limit')) or DEFAULT_MIN_RATE,
+        )
+    
+    def command_prefix(self):
+        prefix = []
+        if self.ionice_class is not None or self.ionice_level is not None:
+            prefix += ['ionice']
+            if self.ionice_class is not None:
+                prefix += ['-c', str(self.ionice_class)]
+            if self.ionice_level is not None:
+                prefix += ['-n', str(self.ionice_level)]
+        if self.nice is not None:
+            prefix += ['nice', '-n', str(self.nice)]
+        return prefix
+    
+    def preexec_fn(self, root=None):
+        if self.cgroup is None:
+            return None
+        root = root or CGROUP_ROOT
+        if not cgroup_v2_available(root):
+            getLogger(__name__).warning("No cgroup v2 hierarchy at %s, not placing tools in %s.", root, self.cgroup)
+            return None
+        path = join(root, self.cgroup.lstrip('/'))
+        os.makedirs(path, exist_ok=True)
+        return lambda: _join_cgroup(path)
+    
+    def wrap(self, sh):
+        # sh (or AsyncSh) running every command under this policy
+        if not self.command_prefix() and self.cgroup is None:
+            return sh
+        return ThrottledSh(sh, self)
+    
+    def rsync_arguments(self):
+        if self.rate_limit is None:
+            return []
+        # rsync counts in KiB per second
+        return ['--bwlimit=%d' % max(1, self.rate_limit // 1024)]
+    
+    def throttle(self):
+        # None if the dump stream can be written at full speed
+        if self.rate_limit is None and self.latency_probe is None:
+            return None
+        governor = None
+        limiter = RateLimiter(self.rate_limit)
+        if self.latency_probe is not None:
+            governor = LatencyGovernor(limiter, self.latency_probe, self.latency_threshold,
+                interval=self.probe_interval, ceiling=self.rate_limit, floor=self.min_rate)
+        return Throttle(limiter, governor)
+
+
+class ThrottledSh(object):
+    # Looks like sh, but commands run prefixed with ionice and nice, inside the cgroup
+    
+    def __init__(self, sh, policy):
+        self.sh = sh
+        self.policy = policy
+    
+    def Command(self, name):
+        prefix = self.policy.command_prefix()
+        if prefix:
+            command = self.sh.Command(prefix[0]).bake(*prefix[1:] + [name])
+        else:
+            command = self.sh.Command(name)
+        preexec_fn = self.policy.preexec_fn()
+        if preexec_fn is not None:
+            command = command.bake(_preexec_fn=preexec_fn)
+        return command
+    
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self.Command(name)
+
+
+class RateLimiter(object):
+    # Token bucket over bytes, with at most a second worth of burst. rate may be changed
+    # at any time, None means unlimited. Also measures the rate actually written.
+    
+    def __init__(self, rate=None, clock=None, sleep=None):
+        self.rate = rate
+        self.observed_rate = None
+        self._clock = clock or time.monotonic
+        self._sleep = sleep or time.sleep
+        self._lock = threading.Lock()
+        self._tokens = 0
+        self._last = self._clock()
+        self._window_start, self._window_bytes = self._last, 0
+    
+    def _observe(self, now, size):
+        if now - self._window_start >= 1:
+            self.observed_rate = self._window_bytes / (now - self._window_start)
+            self._window_start, self._window_bytes = now, 0
+        self._window_bytes += size
+    
+    def throttle(self, size):
+        # blocks until size bytes may be written
+        with self._lock:
+            now = self._clock()
+            self._observe(now, size)
+            rate = self.rate
+            if rate is None:
+                self._last = now
+                return
+            self._tokens = min(rate, self._tokens + (now - self._last) * rate) - size
+            self._last = now
+            delay = -self._tokens / rate if self._tokens < 0 else 0
+        if delay > 0:
+            self._sleep(delay)
+
+
+class RateLimitedWriter(object):
+    # Wraps a writer without fileno(), so sh hands the output to write()
+    
+    def __init__(self, writer, limiter, on_close=None):
+        self.writer = writer
+        self.limiter = limiter
+        self._on_close = on_close
+    
+    def write(self, data):
+        self.limiter.throttle(len(data))
+        self.writer.write(data)
+    
+    def close(self):
+        try:
+            self.writer.close()
+        finally:
+            if self._on_close is not None:
+                self._on_close, on_close = None, self._on_close
+                on_close()
+    
+    def __getattr__(self, name):
+        # path, size, hexdigest() of the wrapped writer
+        return getattr(self.writer, name)
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class LatencyGovernor(object):
+    # Runs the probe every interval seconds in a thread and adjusts the limiter: halves the
+    # rate when the probe reports degradation, lets it grow back while it doesn't.
+    
+    def __init__(self, limiter, probe, threshold=None, interval=DEFAULT_PROBE_INTERVAL,
+            ceiling=None, floor=DEFAULT_MIN_RATE):
+        self.log = getLogger(__name__)
+        self.limiter = limiter
+        self.probe = shlex.split(probe) if isinstance(probe, str) else list(probe)
+        self.threshold = threshold
+        self.interval = interval
+        self.ceiling = ceiling
+        self.floor = floor
+        self._stopped = threading.Event()
+        self._thread = None
+    
+    def is_degraded(self):
+        try:
+            result = subprocess.run(self.probe, capture_output=True, text=True, timeout=self.interval)
+        except (OSError, subprocess.TimeoutExpired) as error:
+            self.log.warning("Latency probe %s failed: %s", self.probe[0], error)
+            return True
+        if result.returncode != 0:
+            return True
+        if self.threshold is None:
+            return False
+        try:
+            return float(result.stdout.split()[0]) > self.threshold
+        except (IndexError, ValueError):
+            self.log.warning("Latency probe %s printed no number: %r", self.probe[0], result.stdout)
+            return True
+    
+    def adjust(self, degraded):
+        limiter = self.limiter
+        if degraded:
+            current = limiter.rate or limiter.observed_rate or self.ceiling or self.floor
+            limiter.rate = max(self.floor, int(current * BACK_OFF_FACTOR))
+            self.log.info("Latency degraded, limiting dump to %d bytes/s.", limiter.rate)
+        elif limiter.rate is not None and limiter.rate != self.ceiling:
+            rate = int(limiter.rate * RECOVERY_FACTOR)
+            if self.ceiling is not None:
+                limiter.rate = min(rate, self.ceiling)
+            elif limiter.observed_rate is not None and rate > 2 * limiter.observed_rate:
+                # the limit no longer holds the dump back
+                limiter.rate = None
+            else:
+                limiter.rate = rate
+    
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self.adjust(self.is_degraded())
+    
+    def start(self):
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name='latency-governor', daemon=True)
+        self._thread.start()
+    
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+
+class Throttle(object):
+    # The rate limit of one data interface, shared by all its dump streams. The governor
+    # only probes while at least one stream is open.
+    
+    def __init__(self, limiter, governor=None):
+        self.limiter = limiter
+        self.governor = governor
+        self._lock = threading.Lock()
+        self._open_streams = 0
+    
+    def _opened(self):
+        with self._lock:
+            if self._open_streams == 0 and self.governor is not None:
+                self.governor.start()
+            self._open_streams += 1
+    
+    def _closed(self):
+        with self._lock:
+            self._open_streams -= 1
+            if self._open_streams == 0 and self.governor is not None:
+                self.governor.stop()
+    
+    def open(self, writer):
+        self._opened()
+        return RateLimitedWriter(writer, self.limiter, on_close=self._closed)
+    
+    @contextmanager
+    def active(self):
+        # for copies that call the limiter themselves instead of writing through open()
+        self._opened()
+        try:
+            yield self.limiter
+        finally:
+            self._closed()
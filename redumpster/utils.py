@@ -1,8 +1,15 @@
+import fcntl
 import os
+import select
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
 from os.path import join, exists
 from itertools import tee, filterfalse
 
+from .datapath import copy_stream
+
 # from https://docs.python.org/3/library/itertools.html#itertools-recipes
 def partition(pred, iterable):
     'Use a predicate to partition entries into false entries and true entries'
@@ -11,18 +18,81 @@ def partition(pred, iterable):
     return filterfalse(pred, t1), filter(pred, t2)
 
 
+def default_sh():
+    # sh takes longer to import than the rest of redumpster (it pulls in asyncio), so it
+    # is only imported once something is about to run a tool
+    import sh
+    return sh
+
+def as_list(value):
+    # config values are lists when read by ConfigObj, but plain strings when passed in as dicts
+    if isinstance(value, (list, tuple)):
+        return list(value)
+    return [each.strip() for each in (value or '').split(',') if each.strip()]
+
+def run_in_parallel(function, items, jobs):
+    # raises the first exception, but only after all items have been processed
+    with ThreadPoolExecutor(max_workers=max(1, int(jobs))) as executor:
+        return list(executor.map(function, items))
+
+
 # REFACT: rename changeD_work*
 @contextmanager
 def change_working_directory_to(directory):
     old_cwd = os.getcwd()
     os.chdir(directory)
-    yield
-    os.chdir(old_cwd)
+    try:
+        yield
+    finally:
+        os.chdir(old_cwd)
 
 def looks_like_attic_directory(directory):
     return exists(join(directory, 'README')) and exists(join(directory, 'config'))
 
+def wait_for_mount(condition, timeout, mount_table='/proc/self/mountinfo'):
+    # The kernel flags the mount table with POLLPRI whenever something gets (un)mounted,
+    # so we sleep until that happens instead of polling. Still re-check every second, as
+    # a FUSE file system may only answer a little after it shows up in the table.
+    deadline = time.monotonic() + timeout
+    try:
+        table = open(mount_table)
+    except OSError:
+        table = None
+    
+    try:
+        poller = select.poll()
+        if table is not None:
+            poller.register(table, select.POLLPRI | select.POLLERR)
+        while not condition():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            if table is None:
+                time.sleep(min(remaining, 0.1))
+            elif poller.poll(min(remaining, 1.0) * 1000):
+                # reading the table resets the event
+                table.seek(0)
+                table.read()
+        return True
+    finally:
+        if table is not None:
+            table.close()
+
 def same_file_system(path1, path2):
     dev1 = os.stat(path1).st_dev
     dev2 = os.stat(path2).st_dev
     return dev1 == dev2
+
+# from linux/fs.h
+FICLONE = 0x40049409
+
+def clone_file(source, destination):
+    # Shares the data blocks (reflink) where the file system supports it, otherwise the
+    # kernel copies the data without passing it through user space.
+    with open(source, 'rb') as source_file, open(destination, 'wb') as destination_file:
+        try:
+            fcntl.ioctl(destination_file.fileno(), FICLONE, source_file.fileno())
+        except OSError:
+            copy_stream(source_file.fileno(), destination_file.fileno())
+    shutil.copystat(source, destination)
+    return destination
@@ -0,0 +1,192 @@
+"""
+Checks dumps on disk against the manifest written when they were dumped.
+
+Every dump directory (a dump --to directory, or a container the directory archiver
+committed dumps to) lists its files with size and sha256 in manifest.jsonl. A pool of
+processes hashes the files, so large dumps use all cores. Files are mapped into memory
+and hashed in large sequential blocks, the kernel reads ahead and no data is copied
+into Python.
+
+Results are cached per dump directory. A later run only hashes files whose size or
+mtime changed since they last matched the manifest, pass full=True to hash everything.
+A rate limit is split evenly between the processes.
+"""
+
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from logging import getLogger
+from os.path import abspath, expanduser, isdir, join
+import hashlib
+import json
+import mmap
+import os
+import tempfile
+
+from .manifest import MANIFEST_FILE, has_manifest, read_manifest
+from .throttle import RateLimiter
+from .utils import looks_like_attic_directory
+
+DEFAULT_CACHE_DIRECTORY = '~/.cache/redumpster/verify'
+# bump when the cache changes, older caches are ignored then
+CACHE_FORMAT = 1
+VERIFY_BLOCK_SIZE = 8 << 20
+# tasks handed to a process at once, files are mostly small
+TASKS_PER_BATCH = 64
+OK, CACHED, MISSING, CORRUPT = 'ok', 'cached', 'missing', 'corrupt'
+
+# the rate limit of a worker process, set by _initialize_worker
+_limiter = None
+
+def _initialize_worker(rate):
+    global _limiter
+    _limiter = RateLimiter(rate) if rate is not None else None
+
+def hash_mapped(path, limiter=None):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as source:
+        size = os.fstat(source.fileno()).st_size
+        if size == 0:
+            # empty files can't be mapped
+            return digest.hexdigest()
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(source.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        with mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            if hasattr(mapped, 'madvise'):
+                mapped.madvise(mmap.MADV_SEQUENTIAL)
+            with memoryview(mapped) as view:
+                for offset in range(0, size, VERIFY_BLOCK_SIZE):
+                    block = view[offset:offset + VERIFY_BLOCK_SIZE]
+                    if limiter is not None:
+                        limiter.throttle(len(block))
+                    digest.update(block)
+                    block.release()
+    return digest.hexdigest()
+
+def _verify_file(task):
+    # (state, size, mtime_ns, hashed bytes) of one manifest entry
+    path, size, sha256, cached = task
+    try:
+        status = os.stat(path)
+    except FileNotFoundError:
+        return MISSING, None, None, 0
+    current = (status.st_size, status.st_mtime_ns)
+    if cached is not None and current == tuple(cached):
+        return CACHED, status.st_size, status.st_mtime_ns, 0
+    if status.st_size != size:
+        return CORRUPT, status.st_size, status.st_mtime_ns, 0
+    state = OK if hash_mapped(path, _limiter) == sha256 else CORRUPT
+    return state, status.st_size, status.st_mtime_ns, status.st_size
+
+
+class VerificationResult(namedtuple('VerificationResult', 'directory files cached hashed_bytes missing corrupt')):
+    # missing and corrupt are paths relative to directory
+    __slots__ = ()
+    
+    @property
+    def ok(self):
+        return not self.missing and not self.corrupt
+    
+    def report(self):
+        lines = ['%s %s: %s' % (state, self.directory, path)
+            for state, paths in ((MISSING, self.missing), (CORRUPT, self.corrupt)) for path in paths]
+        lines.append('%s %s: %d files, %d unchanged since the last verification, %d bytes hashed' % (
+            'OK' if self.ok else 'FAILED', self.directory, self.files, self.cached, self.hashed_bytes))
+        return lines
+
+
+class VerificationCache(object):
+    # {path: (size, mtime_ns, sha256)} of the files of one dump directory as they last
+    # matched its manifest
+    
+    def __init__(self, directory, cache_directory=DEFAULT_CACHE_DIRECTORY):
+        self.directory = abspath(directory)
+        key = hashlib.sha256(self.directory.encode()).hexdigest()
+        self.path = join(expanduser(cache_directory), key + '.json') if cache_directory is not None else None
+    
+    def load(self):
+        if self.path is None:
+            return dict()
+        try:
+            with open(self.path) as cache:
+                cached = json.load(cache)
+        except (OSError, ValueError):
+            return dict()
+        if (cached.get('format'), cached.get('directory')) != (CACHE_FORMAT, self.directory):
+            return dict()
+        return cached['files']
+    
+    def save(self, files):
+        # the cache is only an optimization, failing to write it must not fail the verification
+        if self.path is None:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            descriptor, temporary_path = tempfile.mkstemp(dir=os.path.dirname(self.path), prefix='.partial-')
+            with os.fdopen(descriptor, 'w') as cache:
+                json.dump(dict(format=CACHE_FORMAT, directory=self.directory, files=files), cache)
+            os.replace(temporary_path, self.path)
+        except OSError:
+            pass
+
+
+def dump_directories(directory):
+    # a dump directory, or the dump directories in a container of them
+    assert not looks_like_attic_directory(directory), \
+        "%s is an attic repository, attic check verifies those" % directory
+    if has_manifest(directory) or os.path.isfile(join(directory, 'dump.conf')):
+        return [directory]
+    return sorted(join(directory, name) for name in os.listdir(directory)
+        if not name.startswith('.') and isdir(join(directory, name)))
+
+
+class Verifier(object):
+
+    def __init__(self, jobs=None, rate_limit=None, cache_directory=DEFAULT_CACHE_DIRECTORY, full=False):
+        self.log = getLogger(__name__)
+        self.jobs = int(jobs or 0) or os.cpu_count() or 1
+        self.rate_limit = rate_limit
+        self.cache_directory = cache_directory
+        self.full = full
+    
+    def _tasks(self, directory, cache):
+        known = dict() if self.full else cache.load()
+        for entry in read_manifest(directory):
+            cached = known.get(entry['path'])
+            # cached results only count for the hash the manifest expects
+            if cached is not None and cached[2] != entry['sha256']:
+                cached = None
+            yield entry, (join(directory, entry['path']), entry['size'], entry['sha256'],
+                cached[:2] if cached is not None else None)
+    
+    def verify(self, directories):
+        # one VerificationResult per dump directory
+        per_process_rate = self.rate_limit / self.jobs if self.rate_limit is not None else None
+        results = []
+        with ProcessPoolExecutor(max_workers=self.jobs, initializer=_initialize_worker,
+                initargs=(per_process_rate,)) as pool:
+            for directory in directories:
+                results.append(self._verify_directory(pool, directory))
+        return results
+    
+    def _verify_directory(self, pool, directory):
+        if not has_manifest(directory):
+            self.log.warning("%s has no manifest, it can't be verified.", directory)
+            return VerificationResult(directory, 0, 0, 0, [MANIFEST_FILE], [])
+        
+        cache = VerificationCache(directory, self.cache_directory)
+        pairs = list(self._tasks(directory, cache))
+        entries, tasks = [entry for entry, _ in pairs], [task for _, task in pairs]
+        files, missing, corrupt = dict(), [], []
+        cached = hashed_bytes = 0
+        for entry, (state, size, mtime_ns, hashed) in zip(entries,
+                pool.map(_verify_file, tasks, chunksize=TASKS_PER_BATCH)):
+            hashed_bytes += hashed
+            if state == MISSING:
+                missing.append(entry['path'])
+            elif state == CORRUPT:
+                corrupt.append(entry['path'])
+            else:
+                cached += state == CACHED
+                files[entry['path']] = (size, mtime_ns, entry['sha256'])
+        cache.save(files)
+        return VerificationResult(directory, len(entries), cached, hashed_bytes, missing, corrupt)
@@ -22,6 +22,12 @@ setup(
     entry_points="""\
         [console_scripts]
         redumpster = redumpster.main:main
+        
+        [redumpster.data_interfaces]
+        noop = redumpster.data_interfaces:NoOp
+        mysql = redumpster.sql_dumps:MySQLDump
+        postgres = redumpster.sql_dumps:PostgreSQLDump
+        copydir = redumpster.copy_directory:CopyDirectory
     """
 
 )